@@ -0,0 +1,159 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from cache import LRUCache
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Admission decisions
+ACCEPT = 'accept'
+DEGRADE = 'degrade'            # analyse with the CNN only, skip Gemini
+RATE_LIMITED = 'rate_limited'  # this chat is over its own limit
+BUSY = 'busy'                  # shed: the bot as a whole is overloaded
+
+DECISIONS = REGISTRY.counter('admission_decisions_total', 'Photo admission decisions', labelnames=('decision',))
+
+
+class TokenBucket:
+    """Classic token bucket: ``rate`` tokens per second, holding at most ``burst``"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens=1.0):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+
+class AdmissionController:
+    """Decides whether a photo analysis may run, and bounds how many run at once.
+
+    Checks, in order: the chat's own token bucket (``RATE_LIMITED``), the
+    bounded work queue (``BUSY`` when full), then the global token bucket and
+    the queue's soft limit, where ``ADMISSION_SHED_POLICY`` picks between
+    replying busy and degrading to the basic analysis without Gemini.
+    Admitted work then waits for one of ``max_concurrency`` slots.
+
+    The queue depth is the photos waiting for a slot plus ``backlog()``. In
+    webhook mode, photos wait in the webhook queue instead of at the slots.
+    ``WebhookRuntime`` therefore points ``backlog`` at that queue and decides
+    admission when a photo is queued (``decide``). The handler then picks the
+    decision up with ``take_decision``. Decisions nobody picks up (updates
+    dropped on shutdown or failing early) are discarded by the consumer, and
+    at most ``max_decided`` are kept in any case.
+    """
+
+    def __init__(self, chat_rate=None, chat_burst=None, global_rate=None, global_burst=None,
+                 max_concurrency=None, max_queue=None, degrade_queue=None, shed_policy=None):
+        self.chat_rate = chat_rate or float(os.getenv('ADMISSION_CHAT_RATE', 0.5))
+        self.chat_burst = chat_burst or float(os.getenv('ADMISSION_CHAT_BURST', 5))
+        self.global_rate = global_rate or float(os.getenv('ADMISSION_GLOBAL_RATE', 50))
+        self.global_burst = global_burst or float(os.getenv('ADMISSION_GLOBAL_BURST', 100))
+        self.max_concurrency = max_concurrency or int(os.getenv('ADMISSION_MAX_CONCURRENCY', 32))
+        self.max_queue = max_queue or int(os.getenv('ADMISSION_MAX_QUEUE', 256))
+        self.degrade_queue = degrade_queue or int(os.getenv('ADMISSION_DEGRADE_QUEUE', self.max_queue // 2))
+        self.shed_policy = (shed_policy or os.getenv('ADMISSION_SHED_POLICY', 'degrade')).lower()
+        if self.shed_policy not in ('busy', 'degrade'):
+            raise ValueError(f"Unknown ADMISSION_SHED_POLICY: {self.shed_policy}")
+
+        self.global_bucket = TokenBucket(self.global_rate, self.global_burst)
+        self.chat_buckets = LRUCache(max_entries=int(os.getenv('ADMISSION_MAX_CHATS', 10000)), ttl=3600)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.waiting = 0
+        self.active = 0
+        self.backlog = lambda: 0  # photos queued before reaching the slots (the webhook queue)
+        self._decided = OrderedDict()  # update_id -> decision made when the update was queued, oldest first
+        self.max_decided = self.max_queue + self.max_concurrency
+        self.counts = {ACCEPT: 0, DEGRADE: 0, RATE_LIMITED: 0, BUSY: 0}
+        REGISTRY.gauge('admission_queue_depth', 'Admitted photos waiting to be processed', self.queued)
+        REGISTRY.gauge('admission_in_flight', 'Photos currently being processed', lambda: self.active)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets.put(chat_id, bucket)
+        return bucket
+
+    def _shed(self):
+        return DEGRADE if self.shed_policy == 'degrade' else BUSY
+
+    def queued(self):
+        """Admitted photos not yet being processed"""
+        return self.waiting + self.backlog()
+
+    def check(self, chat_id):
+        """Admission decision for one photo from ``chat_id``"""
+        queued = self.queued()
+        if not self._chat_bucket(chat_id).try_acquire():
+            decision = RATE_LIMITED
+        elif queued >= self.max_queue:
+            decision = BUSY
+        elif not self.global_bucket.try_acquire():
+            decision = self._shed()
+        elif queued >= self.degrade_queue:
+            decision = self._shed()
+        else:
+            decision = ACCEPT
+        self.counts[decision] += 1
+        DECISIONS.inc(decision)
+        if decision in (BUSY, RATE_LIMITED):
+            logger.info(f"Photo from chat {chat_id} not admitted: {decision}")
+        return decision
+
+    def decide(self, update_id, chat_id):
+        """Decide for a photo update as it is queued; the handler gets the result from ``take_decision``"""
+        decision = self.check(chat_id)
+        self._decided[update_id] = decision
+        while len(self._decided) > self.max_decided:
+            self._decided.popitem(last=False)
+        return decision
+
+    def take_decision(self, update_id):
+        """Decision made by ``decide`` for this update, or None if it has not been decided yet"""
+        return self._decided.pop(update_id, None)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the ``max_concurrency`` processing slots"""
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "waiting": self.queued(),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "degrade_queue": self.degrade_queue,
+            "shed_policy": self.shed_policy,
+            "chat_rate": self.chat_rate,
+            "chat_burst": self.chat_burst,
+            "global_rate": self.global_rate,
+            "global_burst": self.global_burst,
+            **self.counts,
+        }
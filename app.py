@@ -1,7 +1,10 @@
-from flask import Flask, request, jsonify
-import asyncio
+from flask import Flask, Response, request, jsonify
+import atexit
 import logging
+import threading
 from bot import StockAnalysisBot
+from webhook import WebhookRuntime
+from metrics import REGISTRY
 import os
 from dotenv import load_dotenv
 
@@ -14,14 +17,21 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# Global bot instance
+# Global bot instance and its long-lived webhook event loop
 bot = None
+runtime = None
+_init_lock = threading.Lock()
 
 def create_bot():
     """Create and return bot instance"""
-    global bot
-    if bot is None:
-        bot = StockAnalysisBot()
+    global bot, runtime
+    with _init_lock:
+        if bot is None:
+            bot = StockAnalysisBot()
+        if runtime is None:
+            runtime = WebhookRuntime(bot)
+            runtime.start()
+            atexit.register(runtime.stop)
     return bot
 
 @app.route('/')
@@ -33,18 +43,67 @@ def home():
         "endpoints": {
             "/": "API information",
             "/webhook": "Telegram webhook endpoint",
-            "/health": "Health check"
+            "/health": "Health check",
+            "/metrics": "Prometheus metrics",
+            "/model": "Active model version (POST /model/reload, /model/rollback)"
         }
     })
 
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
+    model_ready = bot is not None and bot.is_model_ready()
     return jsonify({
         "status": "healthy",
+        "model_ready": model_ready,
+        "model_version": bot.model_manager.current.version if model_ready else None,
+        "webhook_queue_depth": runtime.queue_depth() if runtime else 0,
         "bot_token_configured": bool(os.getenv('TELEGRAM_BOT_TOKEN'))
     })
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus text-format metrics endpoint"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+def _model_admin_allowed():
+    """MODEL_ADMIN_TOKEN must be sent as X-Admin-Token; without one configured, only local callers"""
+    token = os.getenv('MODEL_ADMIN_TOKEN')
+    if token:
+        return request.headers.get('X-Admin-Token') == token
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+@app.route('/model')
+def model_info():
+    """Active model version, load time and rollback history"""
+    return jsonify(create_bot().model_manager.stats())
+
+@app.route('/model/reload', methods=['POST'])
+def model_reload():
+    """Load the newest watched weights now instead of waiting for the next poll"""
+    if not _model_admin_allowed():
+        return jsonify({"error": "Forbidden"}), 403
+    manager = create_bot().model_manager
+    version = manager.reload()
+    if version is None and manager.last_error:
+        return jsonify({"error": manager.last_error, **manager.stats()}), 500
+    return jsonify({"reloaded": version is not None, **manager.stats()})
+
+@app.route('/model/rollback', methods=['POST'])
+def model_rollback():
+    """Switch back to the previously active model version"""
+    if not _model_admin_allowed():
+        return jsonify({"error": "Forbidden"}), 403
+    manager = create_bot().model_manager
+    try:
+        version = manager.rollback()
+    except Exception as e:
+        logger.error(f"Model rollback failed: {e}")
+        return jsonify({"error": str(e)}), 500
+    if version is None:
+        return jsonify({"error": "No previous model version to roll back to"}), 409
+    return jsonify(manager.stats())
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Telegram webhook endpoint"""
@@ -56,10 +115,12 @@ def webhook():
             return jsonify({"error": "No data received"}), 400
         
         # Create bot instance if not exists
-        bot_instance = create_bot()
+        create_bot()
         
-        # Process the update asynchronously
-        asyncio.run(bot_instance.application.process_update(update_data))
+        # Queue the update for the background event loop and acknowledge immediately
+        if not runtime.submit(update_data):
+            logger.warning("Webhook queue full, asking Telegram to retry later")
+            return jsonify({"error": "Queue full"}), 503
         
         return jsonify({"status": "ok"}), 200
         
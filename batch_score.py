@@ -0,0 +1,205 @@
+"""Offline batch scoring of candlestick chart images.
+
+Walks a directory tree, decodes images in a thread pool while the previous
+batch is being scored, runs the model on large batches and streams one
+result row per image to CSV or JSONL. When images sit under ``UP``/``DOWN``
+folders (any case, any depth) the labels are used to report accuracy and a
+confusion matrix alongside throughput.
+
+Usage:
+    python batch_score.py img_candel_stick/Test --output test_scores.csv
+    python batch_score.py /archive/charts --output scores.jsonl --batch-size 512 --backend numpy
+"""
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from inference import load_model
+from preprocessing import read, resize, to_tensor, BatchBuffer
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+LABELS = {'down': 0, 'up': 1}
+FIELDS = ['path', 'label', 'score', 'prediction', 'confidence', 'error']
+
+
+def iter_images(root):
+    """Yield (path, label) for every image under ``root``; label comes from the nearest UP/DOWN folder"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        label = None
+        for part in reversed(os.path.relpath(dirpath, root).split(os.sep)):
+            if part.lower() in LABELS:
+                label = LABELS[part.lower()]
+                break
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(dirpath, filename), label
+
+
+def load_into(path, out):
+    """Read one image straight into its batch slot ``out``; False if it cannot be decoded"""
+    img, _ = read(path)
+    if img is None:
+        return False
+    to_tensor(resize(img), out)
+    return True
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ResultWriter:
+    """Stream result rows to a CSV or JSONL file (format picked from the extension)"""
+
+    def __init__(self, path, fmt=None):
+        self.fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        self.file = sys.stdout if path == '-' else open(path, 'w', newline='')
+        if self.fmt == 'csv':
+            self._csv = csv.DictWriter(self.file, fieldnames=FIELDS)
+            self._csv.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            if self.fmt == 'csv':
+                self._csv.writerow(row)
+            else:
+                self.file.write(json.dumps(row) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class EvaluationReport:
+    """Running counts, accuracy and confusion matrix over labelled images"""
+
+    def __init__(self):
+        self.scored = 0
+        self.failed = 0
+        self.confusion = np.zeros((2, 2), dtype=np.int64)  # rows: actual DOWN/UP, cols: predicted DOWN/UP
+
+    def update(self, labels, predictions):
+        for label, prediction in zip(labels, predictions):
+            if label is not None:
+                self.confusion[label, prediction] += 1
+
+    def summary(self, elapsed):
+        labelled = int(self.confusion.sum())
+        summary = {
+            "images": self.scored + self.failed,
+            "scored": self.scored,
+            "failed": self.failed,
+            "seconds": round(elapsed, 3),
+            "images_per_sec": round(self.scored / elapsed, 1) if elapsed else 0.0,
+            "labelled": labelled,
+        }
+        if labelled:
+            tn, fp, fn, tp = (int(v) for v in self.confusion.ravel())
+            summary.update(
+                accuracy=(tp + tn) / labelled,
+                precision_up=tp / (tp + fp) if tp + fp else 0.0,
+                recall_up=tp / (tp + fn) if tp + fn else 0.0,
+                confusion_matrix={"actual_down": {"pred_down": tn, "pred_up": fp},
+                                  "actual_up": {"pred_down": fn, "pred_up": tp}},
+            )
+        return summary
+
+
+def score_directory(root, writer, model, batch_size=256, workers=None, threshold=0.5):
+    """Score every image under ``root``, streaming rows to ``writer``; returns the summary dict"""
+    report = EvaluationReport()
+    start = time.perf_counter()
+
+    # Two buffers: decode threads fill one while the model scores the other
+    buffers = [BatchBuffer(batch_size), BatchBuffer(batch_size)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        def decode(chunk, buffer):
+            # cv2 releases the GIL, so decoding runs in parallel and overlaps scoring
+            return chunk, buffer, [pool.submit(load_into, path, buffer.array[i]) for i, (path, _) in enumerate(chunk)]
+
+        chunks = _chunks(iter_images(root), batch_size)
+        turn = 0
+        pending = next((decode(chunk, buffers[0]) for chunk in chunks), None)
+        while pending is not None:
+            chunk, buffer, futures = pending
+            turn += 1
+            pending = next((decode(c, buffers[turn % 2]) for c in chunks), None)  # queue the next chunk first
+
+            rows = []
+            scored = []
+            ok = np.array([future.result() for future in futures])
+            for (path, label), decoded in zip(chunk, ok):
+                if not decoded:
+                    report.failed += 1
+                    rows.append({"path": path, "label": label, "score": None, "prediction": None,
+                                 "confidence": None, "error": "decode failed"})
+                    continue
+                scored.append((path, label))
+
+            if scored:
+                batch = buffer.array[:len(chunk)]
+                scores = model.predict(batch if ok.all() else batch[ok])[:, 0]
+                predictions = (scores > threshold).astype(np.int64)
+                report.update([label for _, label in scored], predictions)
+                report.scored += len(scored)
+                for (path, label), score, prediction in zip(scored, scores, predictions):
+                    rows.append({"path": path, "label": label, "score": round(float(score), 6),
+                                 "prediction": "UP" if prediction else "DOWN",
+                                 "confidence": round(abs(float(score) - 0.5) * 2, 6), "error": None})
+            writer.write(rows)
+            logger.info(f"Scored {report.scored} images ({report.failed} failed)")
+
+    return report.summary(time.perf_counter() - start)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Batch-score candlestick chart images")
+    parser.add_argument('root', nargs='?', default='./img_candel_stick/Test',
+                        help="Directory to walk (UP/DOWN folder names are used as labels)")
+    parser.add_argument('--output', default='-', help="Results file (.csv or .jsonl), '-' for stdout")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default=None)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None, help="Decode threads (default: CPU count)")
+    parser.add_argument('--backend', default=None, help="keras, numpy or tflite (default: MODEL_BACKEND)")
+    parser.add_argument('--weights', default=None, help="Weights file (default: MODEL_WEIGHTS_PATH)")
+    parser.add_argument('--summary', default=None, help="Also write the summary JSON to this file")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args = parse_args()
+
+    model = load_model(args.backend, args.weights)
+    model.warmup(batch_sizes=(args.batch_size,))
+
+    writer = ResultWriter(args.output, args.format)
+    try:
+        summary = score_directory(args.root, writer, model, args.batch_size, args.workers)
+    finally:
+        writer.close()
+
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, InvalidStateError
+import numpy as np
+from preprocessing import BatchBuffer
+from metrics import ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+class BatchPredictor:
+    """Gather concurrent single-image requests into one model forward pass.
+
+    Callers submit one preprocessed (64, 64, 3) tensor each. A background
+    thread waits up to ``window_ms`` after the first request (or until
+    ``max_batch_size`` requests are queued), copies them into a reusable
+    batch buffer, runs a single
+    ``predict_fn`` call and hands every caller back its own score.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=None, window_ms=None):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size or int(os.getenv('BATCH_MAX_SIZE', 32))
+        if window_ms is None:
+            window_ms = float(os.getenv('BATCH_WINDOW_MS', 10))
+        self.window = window_ms / 1000.0
+
+        self._queue = queue.Queue()
+        self._buffer = BatchBuffer(self.max_batch_size)  # only touched by the worker thread
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+        self._running = True
+        self._thread = threading.Thread(target=self._worker, name="batch-predictor", daemon=True)
+        self._thread.start()
+        logger.info(f"Batch predictor started (max batch: {self.max_batch_size}, window: {window_ms}ms)")
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._items = 0
+        self._max_batch_seen = 0
+        self._batch_size_counts = {}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def submit(self, tensor):
+        """Queue one preprocessed image and return a Future for its row of model outputs"""
+        future = Future()
+        self._queue.put((tensor, future, time.perf_counter()))
+        return future
+
+    def predict(self, tensor):
+        """Blocking single-image prediction (for synchronous callers such as Streamlit)"""
+        return self.submit(tensor).result()[0]
+
+    async def predict_async(self, tensor):
+        """Awaitable single-image prediction (for the Telegram handlers)"""
+        return (await asyncio.wrap_future(self.submit(tensor)))[0]
+
+    async def score_async(self, tensor):
+        """Awaitable (score, spread); the spread is 0.0 unless test-time augmentation/ensembles are enabled"""
+        row = await asyncio.wrap_future(self.submit(tensor))
+        return row[0], (row[1] if len(row) > 1 else 0.0)
+
+    def queue_depth(self):
+        """Number of requests waiting for the next batch"""
+        return self._queue.qsize()
+
+    def _collect_batch(self):
+        """Block for the first request, then gather more until the window closes or the batch is full.
+
+        Requests whose caller has gone away (cancelled futures) are dropped. The
+        rest are marked running, so they can no longer be cancelled before their
+        result is set.
+        """
+        batch = []
+        while not batch:
+            first = self._queue.get()
+            if first is None:
+                return None
+            if first[1].set_running_or_notify_cancel():
+                batch.append(first)
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Shutdown requested - flush what we have, then stop
+                self._running = False
+                break
+            if item[1].set_running_or_notify_cancel():
+                batch.append(item)
+        return batch
+
+    def _worker(self):
+        while self._running:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+
+            started = time.perf_counter()
+            tensors, futures, enqueued = zip(*batch)
+            try:
+                rows = np.asarray(self.predict_fn(self._buffer.fill(tensors))).reshape(len(batch), -1)
+            except Exception as e:
+                logger.error(f"Batch prediction failed: {e}")
+                ERRORS.inc('predict')
+                for future in futures:
+                    self._settle(future, error=e)
+                continue
+
+            for future, row in zip(futures, rows):
+                self._settle(future, row)
+            self._record(len(batch), [started - t for t in enqueued])
+
+    @staticmethod
+    def _settle(future, row=None, error=None):
+        """Complete one request; a future that cannot take its result must not stop the worker thread"""
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(row)
+        except InvalidStateError as e:
+            logger.warning(f"Dropped a prediction nobody is waiting for: {e}")
+
+    def _record(self, size, waits):
+        with self._stats_lock:
+            self._batches += 1
+            self._items += size
+            self._max_batch_seen = max(self._max_batch_seen, size)
+            self._batch_size_counts[size] = self._batch_size_counts.get(size, 0) + 1
+            self._wait_total += sum(waits)
+            self._wait_max = max(self._wait_max, max(waits))
+
+    def stats(self, reset=False):
+        """Return batch-size and queue-wait statistics"""
+        with self._stats_lock:
+            stats = {
+                "batches": self._batches,
+                "items": self._items,
+                "avg_batch_size": self._items / self._batches if self._batches else 0.0,
+                "max_batch_size": self._max_batch_seen,
+                "batch_size_counts": dict(sorted(self._batch_size_counts.items())),
+                "avg_queue_wait_ms": 1000 * self._wait_total / self._items if self._items else 0.0,
+                "max_queue_wait_ms": 1000 * self._wait_max,
+                "queue_depth": self.queue_depth(),
+            }
+            if reset:
+                self._reset_stats()
+        return stats
+
+    def close(self):
+        """Stop the worker thread after flushing queued requests"""
+        self._queue.put(None)
+        self._thread.join(timeout=5)
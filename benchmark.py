@@ -0,0 +1,357 @@
+"""Offline micro-benchmarks for preprocessing, inference and reply rendering.
+
+Runs entirely locally against the sample images in ``img_candel_stick/Test``
+and ``stock_images``. Telegram and Gemini are replaced by in-process stubs.
+Results are written as JSON so runs can be compared across commits:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --output new.json --compare bench.json --threshold 0.2
+
+With ``--compare``, the exit status is 1 if any timing got slower than the
+baseline by more than ``--threshold`` (relative).
+"""
+import os
+import sys
+import json
+import glob
+import time
+import asyncio
+import logging
+import argparse
+import itertools
+import platform
+import statistics
+import subprocess
+from types import SimpleNamespace
+import cv2
+import numpy as np
+
+# Constants
+img_height = 64
+img_width = 64
+
+SAMPLE_GLOBS = ('img_candel_stick/Test/*/*', 'stock_images/*')
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+_update_ids = itertools.count(1)
+
+
+def timeit(fn, repeat=20, number=1):
+    """Time ``fn`` ``repeat`` times (each call looped ``number`` times); stats in milliseconds per call"""
+    fn()  # warm caches / lazy initialisation
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) * 1000 / number)
+    samples.sort()
+    return {
+        "median_ms": round(statistics.median(samples), 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(0.95 * len(samples)))], 4),
+        "min_ms": round(samples[0], 4),
+    }
+
+
+def load_samples():
+    """Encoded bytes of every sample image"""
+    paths = sorted(path for pattern in SAMPLE_GLOBS for path in glob.glob(pattern))
+    if not paths:
+        raise FileNotFoundError(f"No sample images found under {SAMPLE_GLOBS}")
+    samples = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            samples.append(f.read())
+    return samples
+
+
+def bench_preprocessing(samples, repeat):
+    """Decode + resize + normalize throughput over the sample images"""
+    from preprocessing import prepare
+
+    def full_decode():
+        for data in samples:
+            img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            cv2.resize(img, (img_height, img_width)) / 255.0
+
+    def shared_pipeline():
+        for data in samples:
+            prepare(data)
+
+    results = {}
+    for name, fn in (("full_decode_resize", full_decode), ("prepare", shared_pipeline)):
+        stats = timeit(fn, repeat=repeat)
+        stats["images_per_sec"] = round(len(samples) / stats["median_ms"] * 1000, 1)
+        results[name] = stats
+    results["images"] = len(samples)
+    return results
+
+
+def bench_predict(model, repeat, batch_sizes=BATCH_SIZES):
+    """Model latency per batch size"""
+    rng = np.random.default_rng(0)
+    results = {}
+    for batch_size in batch_sizes:
+        batch = rng.random((batch_size, img_height, img_width, 3), dtype=np.float32)
+        stats = timeit(lambda: model.predict(batch), repeat=repeat)
+        stats["per_image_ms"] = round(stats["median_ms"] / batch_size, 4)
+        stats["images_per_sec"] = round(batch_size / stats["median_ms"] * 1000, 1)
+        results[str(batch_size)] = stats
+    return results
+
+
+def make_long_text(chars):
+    """Gemini-style markdown reply of roughly ``chars`` characters"""
+    block = (
+        "📈 **Trend**: The *ML model* predicts an upward move with `0.82` score.\n"
+        "🎯 **Key Levels**: Watch support near the recent swing low and [resistance](https://example.com).\n"
+        "⚠️ **Risk**: Use stop losses; this is **not** financial advice.\n\n"
+    )
+    return (block * (chars // len(block) + 1))[:chars]
+
+
+def bench_clean_markdown(repeat, sizes=(1000, 10000, 100000)):
+    from gemini_helper import GeminiHelper
+
+    helper = GeminiHelper(model=StubGemini())
+    return {str(size): timeit(lambda text=make_long_text(size): helper._clean_markdown(text), repeat=repeat)
+            for size in sizes}
+
+
+class StubGemini:
+    """Stand-in for the Gemini client with a configurable response latency"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.text = make_long_text(900)
+
+    def generate_content(self, prompt):
+        time.sleep(self.latency)
+        return SimpleNamespace(text=self.text)
+
+    async def generate_content_async(self, prompt):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(text=self.text)
+
+
+class StubMessage:
+    """Minimal telegram Message replacement; replies are counted, not sent"""
+
+    def __init__(self, photo=None):
+        self.photo = photo or []
+        self.replies = 0
+
+    async def reply_text(self, text, *args, **kwargs):
+        self.replies += 1
+        return self
+
+    async def edit_text(self, text, *args, **kwargs):
+        return self
+
+    async def delete(self, *args, **kwargs):
+        return True
+
+
+class StubFile:
+    def __init__(self, data):
+        self.data = data
+
+    async def download_to_memory(self, out, *args, **kwargs):
+        out.write(self.data)
+
+    async def download_as_bytearray(self, *args, **kwargs):
+        return bytearray(self.data)
+
+
+class StubBot:
+    """Serves photo bytes by file_id instead of downloading them"""
+
+    def __init__(self):
+        self.files = {}
+
+    async def get_file(self, file_id, *args, **kwargs):
+        return StubFile(self.files[file_id])
+
+
+def stub_photo_update(stub_bot, data, file_id):
+    """Photo update from a chat of its own, so per-chat rate limits never apply"""
+    from preprocessing import probe_size
+
+    width, height = probe_size(data)
+    stub_bot.files[file_id] = data
+    size = SimpleNamespace(file_id=file_id, file_unique_id=file_id, width=width, height=height,
+                           file_size=len(data))
+    update_id = next(_update_ids)
+    return SimpleNamespace(update_id=update_id, message=StubMessage([size]),
+                           effective_chat=SimpleNamespace(id=update_id), effective_user=SimpleNamespace(id=update_id))
+
+
+def bench_send_long_message(repeat, sizes=(1000, 10000, 100000)):
+    from bot import StockAnalysisBot
+
+    bot = StockAnalysisBot.__new__(StockAnalysisBot)  # send_long_message needs no model or Application
+    loop = asyncio.new_event_loop()
+    results = {}
+    for size in sizes:
+        text = make_long_text(size)
+        update = SimpleNamespace(message=StubMessage())
+        stats = timeit(lambda: loop.run_until_complete(bot.send_long_message(update, text)), repeat=repeat)
+        update.message.replies = 0
+        loop.run_until_complete(bot.send_long_message(update, text))
+        stats["messages"] = update.message.replies
+        results[str(size)] = stats
+    loop.close()
+    return results
+
+
+def bench_handle_photo(samples, repeat, concurrency, gemini_latency):
+    """End-to-end handle_photo with stubbed Telegram and Gemini, caches cleared between runs"""
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:benchmark')
+    from bot import StockAnalysisBot
+    from gemini_helper import GeminiHelper
+    from admission import AdmissionController, ACCEPT
+
+    bot = StockAnalysisBot()
+    bot.gemini = GeminiHelper(model=StubGemini(gemini_latency))
+    # Rate limits and queue bounds above the benchmark load: every photo must be analysed, not shed
+    queue = max(concurrency, len(samples)) + 1
+    bot.admission = AdmissionController(chat_rate=1e9, chat_burst=1e9, global_rate=1e9, global_burst=1e9,
+                                        max_queue=queue, degrade_queue=queue)
+    stub_bot = StubBot()
+    context = SimpleNamespace(bot=stub_bot)
+    counter = iter(range(10 ** 9))
+    loop = asyncio.new_event_loop()  # one loop throughout, like the bot's own
+
+    def clear_caches():
+        bot.prediction_cache.by_file_id.clear()
+        bot.prediction_cache.by_hash.clear()
+        bot.gemini.response_cache.memory.clear()
+
+    async def run_one(data):
+        update = stub_photo_update(stub_bot, data, f"bench-{next(counter)}")
+        await bot.handle_photo(update, context)
+
+    async def sequential():
+        for data in samples:
+            await run_one(data)
+
+    async def concurrent():
+        await asyncio.gather(*(run_one(samples[i % len(samples)]) for i in range(concurrency)))
+
+    def run(coro_fn, photos):
+        clear_caches()
+        admitted = bot.admission.counts[ACCEPT]
+        loop.run_until_complete(coro_fn())
+        admitted = bot.admission.counts[ACCEPT] - admitted
+        if admitted != photos:
+            raise RuntimeError(f"Only {admitted} of {photos} photos were admitted ({bot.admission.counts}), "
+                               f"the run would not time the analysis")
+
+    results = {"sequential": timeit(lambda: run(sequential, len(samples)), repeat=repeat),
+               "concurrent": timeit(lambda: run(concurrent, concurrency), repeat=repeat)}
+    results["sequential"]["per_photo_ms"] = round(results["sequential"]["median_ms"] / len(samples), 4)
+    results["concurrent"]["photos_per_sec"] = round(concurrency / results["concurrent"]["median_ms"] * 1000, 1)
+    results["photos"] = len(samples)
+    results["concurrency"] = concurrency
+    results["gemini_latency_s"] = gemini_latency
+    if bot.worker_pool is not None:
+        bot.worker_pool.close()
+    loop.close()
+    return results
+
+
+def environment(backend):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "cpu_count": os.cpu_count(),
+        "backend": backend,
+    }
+
+
+def _flatten(results, prefix=''):
+    """Yield (dotted name, value) for every timing in a results dict"""
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from _flatten(value, name)
+        elif key.endswith('_ms') and key != 'min_ms':
+            yield name, value
+
+
+def compare(current, baseline, threshold):
+    """List timings that got slower than the baseline by more than ``threshold``"""
+    baseline_timings = dict(_flatten(baseline.get("results", {})))
+    regressions = []
+    for name, value in _flatten(current["results"]):
+        before = baseline_timings.get(name)
+        if before and value > before * (1 + threshold):
+            regressions.append({"name": name, "baseline_ms": before, "current_ms": value,
+                                "change": round(value / before - 1, 3)})
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the offline benchmark suite")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--backend', default=None, help="keras, numpy or tflite (default: MODEL_BACKEND)")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--only', nargs='+', default=None,
+                        choices=['preprocessing', 'predict', 'clean_markdown', 'send_long_message', 'handle_photo'])
+    parser.add_argument('--concurrency', type=int, default=32, help="Concurrent photos in the handle_photo run")
+    parser.add_argument('--gemini-latency', type=float, default=0.0, help="Stub Gemini latency in seconds")
+    parser.add_argument('--compare', default=None, help="Baseline JSON to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Allowed relative slowdown")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)  # keep handle_photo's per-request logs out of the timings
+    backend = (args.backend or os.getenv('MODEL_BACKEND', 'keras')).lower()
+    os.environ['MODEL_BACKEND'] = backend
+    selected = set(args.only or ['preprocessing', 'predict', 'clean_markdown', 'send_long_message', 'handle_photo'])
+
+    samples = load_samples()
+    results = {}
+    if 'preprocessing' in selected:
+        results["preprocessing"] = bench_preprocessing(samples, args.repeat)
+    if 'predict' in selected:
+        from inference import load_model
+        model = load_model(backend)
+        model.warmup()
+        results["predict"] = bench_predict(model, args.repeat)
+    if 'clean_markdown' in selected:
+        results["clean_markdown"] = bench_clean_markdown(args.repeat)
+    if 'send_long_message' in selected:
+        results["send_long_message"] = bench_send_long_message(args.repeat)
+    if 'handle_photo' in selected:
+        results["handle_photo"] = bench_handle_photo(samples, max(3, args.repeat // 4), args.concurrency,
+                                                     args.gemini_latency)
+
+    report = {"environment": environment(backend), "results": results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression['name']}: {regression['baseline_ms']}ms -> "
+                  f"{regression['current_ms']}ms (+{regression['change'] * 100:.0f}%)", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
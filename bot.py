@@ -1,14 +1,24 @@
 import os
+import time
+import asyncio
 import logging
 import cv2
-import numpy as np
-import tensorflow as tf
-from tensorflow.keras import layers, models
 from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
-from commands import BOT_COMMANDS, WELCOME_MESSAGE, HELP_MESSAGE, INFO_MESSAGE
+from commands import BOT_COMMANDS, WELCOME_REPLY, HELP_REPLY, INFO_REPLY
+from formatting import render_message, FORMAT_FALLBACKS
 from gemini_helper import GeminiHelper
+from batching import BatchPredictor
+from execution import CPUExecutor
+from model_manager import ModelManager
+from cache import PredictionCache, CachedPrediction, perceptual_hash
+from worker_pool import InferenceWorkerPool
+from metrics import REGISTRY, STAGE_SECONDS, ERRORS, CACHE_LOOKUPS, GEMINI_FALLBACKS, stage, start_log_dumper
+from admission import AdmissionController, DEGRADE, RATE_LIMITED, BUSY
+from photos import PhotoFetcher, create_http_request
+from preprocessing import decode, resize, to_tensor, prepare, prepare_image, describe
 
 # Load environment variables
 load_dotenv()
@@ -20,9 +30,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Constants
-img_height = 64
-img_width = 64
+# Update handlers kept free for commands and text when every admitted photo holds one
+COMMAND_UPDATE_SLOTS = int(os.getenv('COMMAND_UPDATE_SLOTS', 16))
 
 class StockAnalysisBot:
     def __init__(self):
@@ -30,33 +39,73 @@ class StockAnalysisBot:
         if not self.bot_token:
             raise ValueError("TELEGRAM_BOT_TOKEN not found in environment variables!")
         
-        self.application = Application.builder().token(self.bot_token).build()
-        self.model = self._create_and_load_model()
+        self.admission = AdmissionController()  # Commands never pass through it, only photo analysis
+        
+        # Concurrent updates let simultaneous photos share one batched forward pass. Every admitted
+        # photo holds an update slot while it waits, so the limit leaves room for commands on top
+        # of the admission limits. API calls and photo downloads share one pooled HTTP client
+        update_concurrency = self.admission.max_concurrency + self.admission.max_queue + COMMAND_UPDATE_SLOTS
+        builder = (
+            Application.builder()
+            .token(self.bot_token)
+            .request(create_http_request())
+            .get_updates_request(create_http_request())
+            .concurrent_updates(update_concurrency)
+            .post_init(lambda application: self._setup_commands())
+        )
+        api_base_url = os.getenv('TELEGRAM_API_BASE_URL')
+        if api_base_url:
+            # Self-hosted Bot API server or a local stand-in (see loadtest.py)
+            api_base_url = api_base_url.rstrip('/')
+            builder = builder.base_url(f"{api_base_url}/bot").base_file_url(f"{api_base_url}/file/bot")
+        self.application = builder.build()
+        
+        # INFERENCE_WORKERS > 0 scores photos in separate processes instead of in this one
+        self.worker_pool = None
+        self.batcher = None
+        self.model_manager = ModelManager()  # Swaps in new weights from disk without a restart
+        if int(os.getenv('INFERENCE_WORKERS', 0)) > 0:
+            self.worker_pool = InferenceWorkerPool(weights_path=self.model_manager.initial_path())
+            self.model_manager.worker_pool = self.worker_pool
+            self.model_manager.load_initial()
+        else:
+            self._create_and_load_model()  # Warmed up now so the first user does not eat a cold start
+            self.batcher = BatchPredictor(self.model_manager.predict)
+        self.model_manager.start_watching()
+        self.executor = CPUExecutor()  # Keeps decode/preprocess off the event loop
         self.gemini = GeminiHelper()  # Initialize Gemini helper
+        self.prediction_cache = PredictionCache()
+        self.photo_fetcher = PhotoFetcher()
+        self._register_gauges()
         self._setup_handlers()
-        self._setup_commands()
+    
+    def _register_gauges(self):
+        """Expose queue depths and in-flight work as metrics gauges"""
+        if self.worker_pool is not None:
+            REGISTRY.gauge('inference_in_flight', 'Requests waiting on inference workers',
+                           lambda: sum(worker['in_flight'] for worker in self.worker_pool.health()))
+        else:
+            REGISTRY.gauge('batch_queue_depth', 'Requests waiting for the next inference batch',
+                           self.batcher.queue_depth)
+        REGISTRY.gauge('cpu_pool_in_flight', 'Tasks submitted to the CPU pool and not yet finished',
+                       lambda: self.executor.in_flight)
     
     def _create_and_load_model(self):
-        """Create and load the candlestick model"""
-        model = models.Sequential()
-        model.add(layers.Conv2D(32, (3, 3), activation='relu', input_shape=(img_height, img_width, 3)))
-        model.add(layers.MaxPooling2D((2, 2)))
-        model.add(layers.Conv2D(64, (3, 3), activation='relu'))
-        model.add(layers.MaxPooling2D((2, 2)))
-        model.add(layers.Conv2D(64, (3, 3), activation='relu'))
-        model.add(layers.Flatten())
-        model.add(layers.Dense(64, activation='relu'))
-        model.add(layers.Dense(1, activation='sigmoid'))
-        
-        # Load pre-trained weights
+        """Create and load the candlestick model (Keras or pure-NumPy, see MODEL_BACKEND)"""
         try:
-            model.load_weights('candlestick_model_weights.h5')
-            logger.info("Model weights loaded successfully")
+            return self.model_manager.load_initial().engine
         except Exception as e:
             logger.error(f"Error loading model weights: {e}")
             raise
-        
-        return model
+    
+    def is_model_ready(self):
+        """True once the model (or every inference worker) is loaded and warmed up"""
+        return self.model_manager.ready
+    
+    @property
+    def model(self):
+        """Inference engine of the active model version (None when scoring in worker processes)"""
+        return self.model_manager.current.engine if self.model_manager.current else None
     
     def _setup_handlers(self):
         """Setup command and message handlers"""
@@ -77,48 +126,90 @@ class StockAnalysisBot:
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
-        await update.message.reply_text(WELCOME_MESSAGE, parse_mode='Markdown')
+        await self.send_rendered(update, WELCOME_REPLY)
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command"""
-        await update.message.reply_text(HELP_MESSAGE, parse_mode='Markdown')
+        await self.send_rendered(update, HELP_REPLY)
     
     async def info_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /info command"""
-        await update.message.reply_text(INFO_MESSAGE, parse_mode='Markdown')
+        await self.send_rendered(update, INFO_REPLY)
     
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /status command"""
         try:
             gemini_status = "✅ Enabled" if self.gemini.enabled else "❌ Disabled"
+            model_status = "✅ **Model Status:** Ready" if self.is_model_ready() else "⏳ **Model Status:** Warming up"
+            if self.worker_pool is not None:
+                workers = self.worker_pool.health()
+                alive = sum(worker['alive'] for worker in workers)
+                in_flight = sum(worker['in_flight'] for worker in workers)
+                inference_status = f"⚙️ **Inference Workers:** {alive}/{len(workers)} alive, {in_flight} in flight"
+            else:
+                batch_stats = self.batcher.stats()
+                inference_status = (f"📦 **Batching:** {batch_stats['batches']} batches, avg size "
+                                    f"{batch_stats['avg_batch_size']:.1f}, avg wait {batch_stats['avg_queue_wait_ms']:.1f}ms")
+            cache_stats = self.prediction_cache.stats()
+            cache_hits = cache_stats['file_id']['hits'] + cache_stats['phash']['hits']
+            gemini_cache = self.gemini.response_cache.stats()
+            download_stats = self.photo_fetcher.stats()
+            admission = self.admission.stats()
+            model_info = self.model_manager.stats()
+            loaded_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(model_info['loaded_at'])) if model_info['loaded_at'] else 'never'
             
             status_message = f"""
 🔍 **Bot Status**
 
 ✅ **Bot Status:** Running
-✅ **Model Status:** Loaded
+{model_status}
+🧠 **Model Version:** `{model_info['version']}` (loaded {loaded_at}, {model_info['reloads']} reloads)
 ✅ **Image Processing:** Ready
 ✅ **API Status:** Active
-🤖 **Gemini AI:** {gemini_status}
+🤖 **Gemini AI:** {gemini_status} ({gemini_cache['hits'] + gemini_cache['disk_hits']} cached replies)
+🗂 **Cache:** {cache_hits} hits, {cache_stats['phash']['misses']} misses, {cache_stats['file_id']['entries']} entries
+{inference_status}
+📥 **Downloads:** {download_stats['downloads']} photos, avg {download_stats['avg_bytes'] / 1024:.0f} KB, {download_stats['bytes_saved'] / 1024:.0f} KB saved
+🚦 **Admission:** {admission['active']}/{admission['max_concurrency']} in flight, {admission['waiting']}/{admission['max_queue']} queued ({admission['shed_policy']} above {admission['degrade_queue']})
+⏱ **Limits:** {admission['chat_rate']:g}/s per chat (burst {admission['chat_burst']:g}), {admission['global_rate']:g}/s global (burst {admission['global_burst']:g})
+🛑 **Shed:** {admission['rate_limited']} rate-limited, {admission['busy']} busy, {admission['degrade']} degraded
 
 📊 **Ready to analyze candlestick charts!**
             """
-            await update.message.reply_text(status_message, parse_mode='Markdown')
+            await self.send_long_message(update, status_message)
         except Exception as e:
             error_message = f"❌ **Error:** {str(e)}"
-            await update.message.reply_text(error_message, parse_mode='Markdown')
+            await self.send_long_message(update, error_message)
+    
+    def decode_image(self, photo_bytes):
+        """Decode downloaded photo bytes into an OpenCV BGR image (reduced resolution for large photos)"""
+        return decode(photo_bytes)[0]
+    
+    def preprocess_image(self, img):
+        """Resize and normalize an image into a single float32 model input tensor"""
+        return to_tensor(resize(img))
+    
+    def _encode_for_workers(self, img):
+        """Losslessly re-encode a decoded image so it can be sent to the worker pool"""
+        return cv2.imencode('.png', img)[1].tobytes()
     
     def predict_candlestick_direction(self, img):
         """Predict candlestick direction from image using ML model"""
-        img = cv2.resize(img, (img_height, img_width))
-        img = img / 255.0  # Normalize pixel values to [0, 1]
-        img = np.expand_dims(img, axis=0)  # Add batch dimension
-        prediction = self.model.predict(img)
-        return prediction[0][0]
-    
-    def get_prediction_confidence(self, prediction):
-        """Get confidence level of the ML prediction"""
-        confidence = abs(prediction - 0.5) * 2  # Convert to 0-1 scale
+        if self.worker_pool is not None:
+            return self.worker_pool.submit(self._encode_for_workers(img)).result()[0]
+        return self.batcher.predict(self.preprocess_image(img))
+    
+    async def predict_candlestick_direction_async(self, img):
+        """Predict candlestick direction, batched with other concurrent requests"""
+        if self.worker_pool is not None:
+            photo_bytes = await self.executor.run(self._encode_for_workers, img)
+            return (await self.worker_pool.analyze_async(photo_bytes))[0]
+        tensor = await self.executor.run(self.preprocess_image, img)
+        return await self.batcher.predict_async(tensor)
+    
+    def get_prediction_confidence(self, prediction, spread=0.0):
+        """Get confidence level of the ML prediction (lowered by the spread of TTA/ensemble scores)"""
+        confidence = max(0.0, abs(prediction - 0.5) - spread) * 2  # Convert to 0-1 scale
         if confidence > 0.8:
             return "High"
         elif confidence > 0.6:
@@ -129,100 +220,146 @@ class StockAnalysisBot:
     def get_image_description(self, img):
         """Get a basic description of the image for Gemini analysis"""
         try:
-            # Basic image analysis
-            height, width = img.shape[:2]
-            channels = img.shape[2] if len(img.shape) > 2 else 1
-            
-            # Simple brightness analysis
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if channels == 3 else img
-            brightness = np.mean(gray)
-            
-            description = f"Candlestick chart image ({width}x{height}, brightness: {brightness:.1f})"
-            return description
+            # Brightness is measured on the 64x64 model input, not the full photo
+            return describe(prepare_image(img))
         except Exception as e:
             logger.error(f"Error getting image description: {e}")
             return "Candlestick chart image"
     
-    async def send_long_message(self, update: Update, text: str, parse_mode='Markdown'):
-        """Send long messages by splitting them if needed"""
-        max_length = 1000  # Keep messages concise
-        
-        if len(text) <= max_length:
+    async def send_rendered(self, update: Update, parts):
+        """Send pre-rendered MessageParts, one Bot API call per part"""
+        for part in parts:
             try:
-                await update.message.reply_text(text, parse_mode=parse_mode)
-            except Exception as e:
-                # If markdown parsing fails, send as plain text
-                logger.warning(f"Markdown parsing failed, sending as plain text: {e}")
-                await update.message.reply_text(text)
-        else:
-            # Split the message
-            parts = []
-            current_part = ""
-            
-            for line in text.split('\n'):
-                if len(current_part + line + '\n') > max_length:
-                    if current_part:
-                        parts.append(current_part.strip())
-                    current_part = line + '\n'
-                else:
-                    current_part += line + '\n'
-            
-            if current_part:
-                parts.append(current_part.strip())
-            
-            # Send each part
-            for i, part in enumerate(parts):
-                try:
-                    if i == 0:
-                        await update.message.reply_text(part, parse_mode=parse_mode)
-                    else:
-                        await update.message.reply_text(f"*Continued...*\n\n{part}", parse_mode=parse_mode)
-                except Exception as e:
-                    # If markdown parsing fails, send as plain text
-                    logger.warning(f"Markdown parsing failed for part {i}, sending as plain text: {e}")
-                    if i == 0:
-                        await update.message.reply_text(part)
-                    else:
-                        await update.message.reply_text(f"Continued...\n\n{part}")
+                await update.message.reply_text(part.text, parse_mode=part.parse_mode)
+            except BadRequest as e:
+                if part.parse_mode is None or 'entities' not in str(e).lower():
+                    raise
+                # Every part passed validation, so this means the validator and Telegram disagree
+                logger.warning(f"Telegram rejected validated MarkdownV2, sending plain text: {e}")
+                FORMAT_FALLBACKS.inc('rejected')
+                await update.message.reply_text(part.plain)
+    
+    async def send_long_message(self, update: Update, text: str):
+        """Render a Markdown reply once and send it in parts of at most 1000 characters"""
+        await self.send_rendered(update, render_message(text))
+    
+    def has_cached_answer(self, photo_sizes):
+        """True if handle_photo will answer this photo from the file_id cache, before admission control"""
+        photo = self.photo_fetcher.select(photo_sizes)
+        return self.prediction_cache.has_file_id(photo.file_unique_id, self.model_manager.current.version)
     
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle photo messages - ML analysis enhanced by Gemini"""
+        started = time.perf_counter()
         try:
-            # Send processing message
-            processing_msg = await update.message.reply_text("🔄 Processing your candlestick chart...")
-            
-            # Get the largest photo size
-            photo = update.message.photo[-1]
-            
-            # Download the photo
-            file = await context.bot.get_file(photo.file_id)
-            photo_bytes = await file.download_as_bytearray()
+            # Smallest photo size that still has enough resolution for the model
+            photo = self.photo_fetcher.select(update.message.photo)
             
-            # Convert to OpenCV format
-            nparr = np.frombuffer(photo_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            # Webhook mode decides admission when the update is queued
+            decision = self.admission.take_decision(update.update_id)
             
-            if img is None:
-                await processing_msg.edit_text("❌ Error: Could not process the image. Please try again with a clearer image.")
+            # Same Telegram file seen before with the active model - answer without downloading it again
+            cached = self.prediction_cache.get_by_file_id(photo.file_unique_id, self.model_manager.current.version)
+            CACHE_LOOKUPS.inc('file_id', 'miss' if cached is None else 'hit')
+            if cached is not None:
+                await self.send_long_message(update, cached.analysis)
                 return
             
-            # Step 1: Get ML model prediction
-            prediction = self.predict_candlestick_direction(img)
-            confidence = self.get_prediction_confidence(prediction)
-            
-            # Step 2: Get image description
-            image_description = self.get_image_description(img)
-            
-            # Step 3: Enhance ML result with Gemini
-            enhanced_analysis = self.gemini.enhance_ml_result(prediction, confidence, image_description)
+            # Admission control: per-chat and global rate limits and a bounded work queue
+            if decision is None:
+                decision = self.admission.check(update.effective_chat.id)
+            if decision == RATE_LIMITED:
+                await update.message.reply_text("⏳ You're sending charts faster than I can analyze them. Please wait a few seconds and try again.")
+                return
+            if decision == BUSY:
+                await update.message.reply_text("🚦 I'm busy analyzing other charts right now. Please try again in a minute.")
+                return
             
-            # Step 4: Send the enhanced analysis (with splitting if needed)
-            await processing_msg.delete()  # Remove processing message
-            await self.send_long_message(update, enhanced_analysis, parse_mode='Markdown')
+            async with self.admission.slot():
+                await self._analyze_photo(update, context, degraded=decision == DEGRADE)
             
         except Exception as e:
+            ERRORS.inc('handle_photo')
             logger.error(f"Error processing photo: {e}")
             await update.message.reply_text("❌ Sorry, I encountered an error while processing your image. Please try again.")
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - started, 'total')
+    
+    async def _analyze_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE, degraded=False):
+        """Download, score and answer one admitted photo"""
+        # Results are cached under the version that was active when scoring started
+        version = self.model_manager.current.version
+        
+        # Send processing message while the photo downloads
+        processing_task = asyncio.create_task(update.message.reply_text("🔄 Processing your candlestick chart..."))
+        
+        # Download the selected photo size (the HTTP response bytes, not a copy)
+        photo, photo_bytes = await self.photo_fetcher.fetch(context.bot, update.message.photo)
+        if self.worker_pool is not None:
+            # Step 1 & 2: Decode, describe and score the image in an inference worker process
+            with stage('analyze'):
+                result = await self.worker_pool.analyze_async(photo_bytes)
+        else:
+            # Decode, resize, normalize and describe in one pass (in the CPU pool, not on the event loop)
+            with stage('decode'):
+                prepared = await self.executor.run(prepare, photo_bytes)
+        processing_msg = await processing_task
+        
+        if self.worker_pool is not None:
+            if result is None:
+                ERRORS.inc('decode')
+                await processing_msg.edit_text("❌ Error: Could not process the image. Please try again with a clearer image.")
+                return
+            prediction, image_description, image_hash, spread = result
+            cached = self.prediction_cache.get_by_hash(image_hash, version)
+        else:
+            if prepared is None:
+                ERRORS.inc('decode')
+                await processing_msg.edit_text("❌ Error: Could not process the image. Please try again with a clearer image.")
+                return
+            
+            # Re-uploads and re-encodes of a known chart hit on the perceptual hash
+            image_hash = perceptual_hash(prepared.tensor)
+            cached = self.prediction_cache.get_by_hash(image_hash, version)
+            
+            if cached is None:
+                # Step 1 & 2: Score the image with the ML model and describe it
+                with stage('predict'):
+                    prediction, spread = await self.batcher.score_async(prepared.tensor)
+                image_description = describe(prepared)
+        CACHE_LOOKUPS.inc('phash', 'miss' if cached is None else 'hit')
+        
+        if cached is not None:
+            self.prediction_cache.put(cached, version, file_unique_id=photo.file_unique_id)
+            await asyncio.gather(
+                processing_msg.delete(),
+                self.send_long_message(update, cached.analysis),
+            )
+            return
+        
+        confidence = self.get_prediction_confidence(prediction, spread)
+        
+        if degraded:
+            # Shedding load: ML result with the basic analysis, not cached so a later retry gets Gemini
+            enhanced_analysis = self.gemini._get_basic_analysis(prediction, confidence)
+            GEMINI_FALLBACKS.inc('shed')
+        else:
+            # Step 3: Enhance ML result with Gemini (async, concurrency-limited, with timeout)
+            with stage('gemini'):
+                enhanced_analysis = await self.gemini.enhance_ml_result_async(prediction, confidence, image_description)
+            self.prediction_cache.put(
+                CachedPrediction(float(prediction), enhanced_analysis),
+                version,
+                file_unique_id=photo.file_unique_id,
+                image_hash=image_hash,
+            )
+        
+        # Step 4: Remove processing message and send the enhanced analysis (with splitting if needed)
+        with stage('reply'):
+            await asyncio.gather(
+                processing_msg.delete(),
+                self.send_long_message(update, enhanced_analysis),
+            )
     
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle text messages"""
@@ -241,6 +378,7 @@ class StockAnalysisBot:
     def run(self):
         """Run the bot"""
         logger.info("Starting Stock Analysis Bot...")
+        start_log_dumper()  # No /metrics endpoint in polling mode, so dump metrics to the log
         self.application.run_polling()
 
 if __name__ == "__main__":
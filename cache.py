@@ -0,0 +1,251 @@
+import os
+import re
+import math
+import sys
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# What we keep for an analysed chart: the raw model score and the final reply text
+CachedPrediction = namedtuple('CachedPrediction', ['score', 'analysis'])
+
+
+class LRUCache:
+    """Thread-safe LRU cache with TTL expiry, entry and memory caps, and hit/miss/eviction counters"""
+
+    def __init__(self, max_entries=1024, ttl=3600, max_bytes=None, sizeof=sys.getsizeof):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        """True if ``key`` is cached and unexpired; unlike ``get`` it touches neither counters nor LRU order"""
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and (item[1] is None or item[1] >= time.monotonic())
+
+    def get(self, key, default=None, count_miss=True):
+        """Return the cached value (refreshing its LRU position) or ``default``"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += count_miss
+                return default
+            value, expires_at, _ = item
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += count_miss
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Insert or replace a value, evicting least recently used entries to respect the caps"""
+        size = self.sizeof(value)
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or
+                                  (self.max_bytes and self._bytes > self.max_bytes)):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def record_miss(self):
+        """Count a miss for a lookup that bypassed ``get`` (e.g. a fuzzy scan)"""
+        with self._lock:
+            self.misses += 1
+
+    def keys(self):
+        """Snapshot of the current keys (oldest first)"""
+        with self._lock:
+            return list(self._data)
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def perceptual_hash(img):
+    """64-bit difference hash (dHash) of a small BGR image, robust to re-encoding"""
+    img = np.asarray(img, dtype=np.float32)
+    gray = img @ np.array([0.114, 0.587, 0.299], dtype=np.float32) if img.ndim == 3 else img
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def _entry_size(entry):
+    return sys.getsizeof(entry.analysis) + 64
+
+
+class PredictionCache:
+    """Result cache for analysed photos.
+
+    Lookups go by Telegram ``file_unique_id`` first (which lets us skip the
+    download entirely) and fall back to a perceptual hash of the decoded
+    64x64 image, so re-uploads and re-encodes of the same chart still hit.
+    Both keys include the model version that scored the photo, so results
+    from weights that were reloaded or rolled back away are never served.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, max_bytes=None, max_hash_distance=None):
+        max_entries = max_entries or int(os.getenv('PREDICTION_CACHE_SIZE', 2048))
+        ttl = ttl if ttl is not None else float(os.getenv('PREDICTION_CACHE_TTL', 3600))
+        max_bytes = max_bytes or int(os.getenv('PREDICTION_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+        if max_hash_distance is None:
+            max_hash_distance = int(os.getenv('PHASH_MAX_DISTANCE', 2))
+        self.max_hash_distance = max_hash_distance
+
+        self.by_file_id = LRUCache(max_entries, ttl, max_bytes // 2, sizeof=_entry_size)
+        self.by_hash = LRUCache(max_entries, ttl, max_bytes // 2, sizeof=_entry_size)
+
+    def get_by_file_id(self, file_unique_id, version=None):
+        return self.by_file_id.get((version, file_unique_id))
+
+    def has_file_id(self, file_unique_id, version=None):
+        return (version, file_unique_id) in self.by_file_id
+
+    def get_by_hash(self, image_hash, version=None):
+        """Exact perceptual-hash lookup, then any hash of the same version within ``max_hash_distance`` bits"""
+        if not self.max_hash_distance:
+            return self.by_hash.get((version, image_hash))
+        entry = self.by_hash.get((version, image_hash), count_miss=False)
+        if entry is not None:
+            return entry
+        for key in reversed(self.by_hash.keys()):
+            if key[0] == version and bin(key[1] ^ image_hash).count('1') <= self.max_hash_distance:
+                entry = self.by_hash.get(key, count_miss=False)
+                if entry is not None:
+                    return entry
+        self.by_hash.record_miss()
+        return None
+
+    def put(self, entry, version=None, file_unique_id=None, image_hash=None):
+        if file_unique_id is not None:
+            self.by_file_id.put((version, file_unique_id), entry)
+        if image_hash is not None:
+            self.by_hash.put((version, image_hash), entry)
+
+    def stats(self):
+        return {"file_id": self.by_file_id.stats(), "phash": self.by_hash.stats()}
+
+
+class ResponseCache:
+    """Cache of Gemini enhancements keyed by a normalized prompt fingerprint.
+
+    Scores are bucketed (``GEMINI_SCORE_BUCKET``) so that near-identical ML
+    results share one Gemini answer. Entries live in an in-memory LRU+TTL
+    cache and, when ``GEMINI_CACHE_PATH`` is set, in SQLite so they survive
+    restarts.
+    """
+
+    def __init__(self, bucket_size=None, max_entries=None, ttl=None, db_path=None):
+        self.bucket_size = bucket_size or float(os.getenv('GEMINI_SCORE_BUCKET', 0.05))
+        max_entries = max_entries or int(os.getenv('GEMINI_CACHE_SIZE', 512))
+        self.ttl = ttl if ttl is not None else float(os.getenv('GEMINI_CACHE_TTL', 24 * 3600))
+        self.memory = LRUCache(max_entries, self.ttl)
+        self.disk_hits = 0
+
+        db_path = db_path or os.getenv('GEMINI_CACHE_PATH')
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, created REAL)"
+            )
+            self._db.commit()
+            logger.info(f"Gemini response cache persisted to {db_path}")
+
+    def bucket_score(self, score):
+        """Map a score to the midpoint of its bucket; buckets never straddle the 0.5 trend threshold"""
+        # Buckets are mirrored around 0.5 and closed towards it, so 0.5 itself (trend DOWN) lands below it
+        half = max(1, round(0.5 / self.bucket_size))
+        width = 0.5 / half
+        score = float(score)
+        index = min(max(math.ceil(round(abs(score - 0.5) / width, 9)), 1), half)
+        midpoint = (index - 0.5) * width
+        return 0.5 + midpoint if score > 0.5 else 0.5 - midpoint
+
+    @staticmethod
+    def normalize_description(description):
+        """Lowercase, collapse whitespace and round numbers to two significant figures"""
+        description = " ".join((description or "").lower().split())
+        return re.sub(r'\d+(?:\.\d+)?', lambda m: f"{float(m.group()):.2g}", description)
+
+    def fingerprint(self, trend, score, confidence, description):
+        raw = f"{trend}|{score:.4f}|{confidence}|{description}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        response = self.memory.get(key)
+        if response is not None or self._db is None:
+            return response
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT response FROM responses WHERE key = ? AND created >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        if row is not None:
+            self.disk_hits += 1
+            self.memory.put(key, row[0])
+            return row[0]
+        return None
+
+    def put(self, key, response):
+        self.memory.put(key, response)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, created) VALUES (?, ?, ?)",
+                    (key, response, time.time()),
+                )
+                self._db.commit()
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats["disk_hits"] = self.disk_hits
+        return stats
@@ -1,4 +1,5 @@
 from telegram import BotCommand
+from formatting import prerender
 
 # Define bot commands
 BOT_COMMANDS = [
@@ -103,4 +104,9 @@ INFO_MESSAGE = """
 • Confidence level explanations
 
 ⚠️ **Disclaimer:** This is for educational purposes only. Always do your own research before making investment decisions.
-""" 
\ No newline at end of file
+""" 
+
+# Rendered and validated as MarkdownV2 once, at import
+WELCOME_REPLY = prerender(WELCOME_MESSAGE)
+HELP_REPLY = prerender(HELP_MESSAGE)
+INFO_REPLY = prerender(INFO_MESSAGE)
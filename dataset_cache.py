@@ -0,0 +1,218 @@
+"""Preprocessed dataset cache: 64x64 uint8 tensors in memory-mapped .npy shards.
+
+A manifest records each source image's path, mtime, size and content hash
+together with where its tensor lives. Updating the cache only decodes new or
+changed files (they go into a fresh shard); unchanged files are reused as-is
+and readers access every shard through ``np.load(mmap_mode='r')``.
+
+Usage:
+    python dataset_cache.py [data_dir] [cache_dir]
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from preprocessing import img_height, img_width, load_uint8, to_tensor
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_CACHE_DIR = '.dataset_cache'
+
+
+def find_class_dirs(base_dir):
+    """Return the [DOWN, UP] class folders of ``base_dir``, matching their names case-insensitively"""
+    class_dirs = {}
+    for entry in os.listdir(base_dir):
+        path = os.path.join(base_dir, entry)
+        if os.path.isdir(path) and entry.lower() in ('down', 'up'):
+            class_dirs[entry.lower()] = path
+    missing = {'down', 'up'} - set(class_dirs)
+    if missing:
+        raise FileNotFoundError(f"Missing class folder(s) {sorted(missing)} in {base_dir}")
+    return [class_dirs['down'], class_dirs['up']]  # label 0 = down, 1 = up
+
+
+def list_images(base_dir):
+    """List image paths and labels without reading any pixels"""
+    paths = []
+    labels = []
+    for label, folder_path in enumerate(find_class_dirs(base_dir)):
+        for filename in sorted(os.listdir(folder_path)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(folder_path, filename))
+                labels.append(label)
+    return paths, labels
+
+
+def load_image(path):
+    """Read and resize one image file to a (64, 64, 3) uint8 BGR tensor, or None if unreadable"""
+    return load_uint8(path)
+
+
+def _file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"image_size": [img_height, img_width], "files": {}, "shards": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(cache_dir, manifest):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _shard_paths(cache_dir, shard):
+    return os.path.join(cache_dir, f"{shard}-images.npy"), os.path.join(cache_dir, f"{shard}-labels.npy")
+
+
+def update_cache(data_dir, cache_dir=DEFAULT_CACHE_DIR, workers=None):
+    """Bring the shard cache in line with ``data_dir``, decoding only new or changed images"""
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = _read_manifest(cache_dir)
+    files = manifest["files"]
+    paths, labels = list_images(data_dir)
+
+    current = {}
+    to_process = []
+    for path, label in zip(paths, labels):
+        key = os.path.relpath(path, data_dir)
+        stat = os.stat(path)
+        entry = files.get(key)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size and entry["label"] == label:
+            current[key] = entry
+            continue
+        content_hash = _file_hash(path)
+        if entry and entry["sha1"] == content_hash and entry["label"] == label:
+            # Touched but unchanged - keep the cached tensor
+            entry.update(mtime=stat.st_mtime, size=stat.st_size)
+            current[key] = entry
+            continue
+        to_process.append((key, path, label, stat, content_hash))
+
+    removed = len(set(files) - {os.path.relpath(path, data_dir) for path in paths})
+    if to_process:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            tensors = list(pool.map(lambda item: load_image(item[1]), to_process))
+
+        new_entries = []
+        new_tensors = []
+        for (key, path, label, stat, content_hash), tensor in zip(to_process, tensors):
+            if tensor is None:
+                logger.warning(f"Failed to read image: {path}")
+                continue
+            new_entries.append((key, {"mtime": stat.st_mtime, "size": stat.st_size,
+                                      "sha1": content_hash, "label": label}))
+            new_tensors.append(tensor)
+        logger.info(f"Preprocessed {len(new_tensors)} new/changed images in {time.perf_counter() - start:.2f}s")
+
+        if new_tensors:
+            # Fold the surviving rows of mostly-stale shards into the new shard (copied, not re-decoded)
+            for key, entry, tensor in _compact_sparse_shards(cache_dir, manifest, current):
+                new_entries.append((key, entry))
+                new_tensors.append(tensor)
+
+            next_id = max((int(name.split('-')[1]) for name in manifest["shards"]), default=-1) + 1
+            shard = f"shard-{next_id:05d}"
+            images_path, labels_path = _shard_paths(cache_dir, shard)
+            np.save(images_path, np.stack(new_tensors))
+            np.save(labels_path, np.array([entry["label"] for _, entry in new_entries], dtype=np.uint8))
+            manifest["shards"][shard] = {"count": len(new_tensors)}
+            for index, (key, entry) in enumerate(new_entries):
+                current[key] = dict(entry, shard=shard, index=index)
+
+    manifest["files"] = current
+    _drop_unused_shards(cache_dir, manifest)
+    _write_manifest(cache_dir, manifest)
+    logger.info(f"Dataset cache: {len(current)} images, {len(to_process)} updated, {removed} removed, "
+                f"{len(manifest['shards'])} shards")
+    return manifest
+
+
+def _compact_sparse_shards(cache_dir, manifest, current, min_live_fraction=0.5):
+    """Yield (key, entry, tensor) for live rows of shards that are mostly stale rows"""
+    live = {}
+    for key, entry in current.items():
+        live.setdefault(entry["shard"], []).append((key, entry))
+    for shard, entries in live.items():
+        if len(entries) >= min_live_fraction * manifest["shards"][shard]["count"]:
+            continue
+        images = np.load(_shard_paths(cache_dir, shard)[0], mmap_mode='r')
+        for key, entry in entries:
+            yield key, entry, np.array(images[entry["index"]])
+
+
+def _drop_unused_shards(cache_dir, manifest):
+    live = {entry["shard"] for entry in manifest["files"].values()}
+    for shard in list(manifest["shards"]):
+        if shard not in live:
+            for path in _shard_paths(cache_dir, shard):
+                if os.path.exists(path):
+                    os.remove(path)
+            del manifest["shards"][shard]
+
+
+class ShardedDataset:
+    """Read-only view of the shard cache; pixels are only paged in for the rows actually requested"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        manifest = _read_manifest(cache_dir)
+        self.shards = {}
+        for shard in manifest["shards"]:
+            images_path, _ = _shard_paths(cache_dir, shard)
+            self.shards[shard] = np.load(images_path, mmap_mode='r')
+
+        items = sorted(manifest["files"].items())
+        shard_names = sorted(self.shards)
+        shard_ids = {name: i for i, name in enumerate(shard_names)}
+        self._shard_arrays = [self.shards[name] for name in shard_names]
+        self.paths = [key for key, _ in items]
+        self.labels = np.array([entry["label"] for _, entry in items], dtype=np.float32)
+        self.hashes = [entry["sha1"] for _, entry in items]
+        self._shard_of = np.array([shard_ids[entry["shard"]] for _, entry in items], dtype=np.int32)
+        self._row_of = np.array([entry["index"] for _, entry in items], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def images(self, indices):
+        """Gather uint8 images for the given dataset indices"""
+        indices = np.asarray(indices)
+        out = np.empty((len(indices), img_height, img_width, 3), dtype=np.uint8)
+        shard_of = self._shard_of[indices]
+        for shard_id in np.unique(shard_of):
+            mask = shard_of == shard_id
+            out[mask] = self._shard_arrays[shard_id][self._row_of[indices[mask]]]
+        return out
+
+    def batches(self, indices, batch_size=32, shuffle=False, seed=None):
+        """Yield (float32 images in [0, 1], labels of shape (N, 1)) batches"""
+        indices = np.asarray(indices)
+        if shuffle:
+            indices = np.random.default_rng(seed).permutation(indices)
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            yield to_tensor(self.images(batch)), self.labels[batch].reshape(-1, 1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    update_cache(sys.argv[1] if len(sys.argv) > 1 else './img_candel_stick/Train',
+                 sys.argv[2] if len(sys.argv) > 2 else DEFAULT_CACHE_DIR)
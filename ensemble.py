@@ -0,0 +1,129 @@
+"""Test-time augmentation and ensemble scoring (opt-in).
+
+``TTA_VIEWS`` selects augmented views of every chart, e.g.
+``identity,crop,shift_left,shift_right,invert_luma`` or ``all``:
+
+- ``crop`` zooms in 10%;
+- ``shift_*`` move the chart by 3 pixels;
+- ``darker`` and ``brighter`` scale the brightness;
+- ``invert_luma`` flips the luminance but keeps the hue, so dark-theme
+  screenshots also get a light-theme view with the candle colours unchanged.
+
+The views are built with vectorised NumPy indexing from the already
+preprocessed 64x64 tensor, so the photo is decoded only once.
+
+``ENSEMBLE_WEIGHTS`` lists extra weights files that are scored next to the
+active one. Keras and NumPy combine the members into one model, so all views
+of all images go through all members in a single forward pass. TFLite runs
+each member once over the whole batch.
+
+``EnsembleEngine.predict`` returns two columns per image: the mean score
+over views and members, and their standard deviation (the spread). Every
+existing caller reads column 0, so it still gets one score per image.
+"""
+import time
+import logging
+import numpy as np
+from inference import img_height, img_width
+
+logger = logging.getLogger(__name__)
+
+SHIFT_PIXELS = 3
+CROP_SCALE = 0.9
+BRIGHTNESS = 0.2
+LUMA_WEIGHTS = np.array([0.114, 0.587, 0.299], dtype=np.float32)  # BGR, as decoded by OpenCV
+
+
+def _index(size, scale=1.0, shift=0):
+    """Source row/column for each output row/column: zoom by ``scale`` about the centre, then move by ``shift``"""
+    centre = (size - 1) / 2
+    index = np.round(centre + (np.arange(size) - centre) * scale + shift)
+    return np.clip(index, 0, size - 1).astype(np.intp)
+
+
+_ROWS = _index(img_height)
+_COLS = _index(img_width)
+
+# Geometric views as (row index, column index) gathers; edges are replicated
+GEOMETRIC_VIEWS = {
+    'crop': (_index(img_height, CROP_SCALE), _index(img_width, CROP_SCALE)),
+    'shift_left': (_ROWS, _index(img_width, shift=SHIFT_PIXELS)),
+    'shift_right': (_ROWS, _index(img_width, shift=-SHIFT_PIXELS)),
+    'shift_up': (_index(img_height, shift=SHIFT_PIXELS), _COLS),
+    'shift_down': (_index(img_height, shift=-SHIFT_PIXELS), _COLS),
+}
+VIEWS = ('identity', *GEOMETRIC_VIEWS, 'darker', 'brighter', 'invert_luma')
+
+
+def parse_views(spec):
+    """``TTA_VIEWS`` value to a tuple of view names (``identity`` always comes first)"""
+    names = [name.strip().lower() for name in (spec or '').split(',') if name.strip()]
+    if names == ['all']:
+        return VIEWS
+    unknown = sorted(set(names) - set(VIEWS))
+    if unknown:
+        raise ValueError(f"Unknown TTA_VIEWS: {', '.join(unknown)} (choose from {', '.join(VIEWS)} or all)")
+    return ('identity',) + tuple(dict.fromkeys(name for name in names if name != 'identity'))
+
+
+def ensemble_paths(spec):
+    """``ENSEMBLE_WEIGHTS`` value to a list of extra weights files"""
+    return [path.strip() for path in (spec or '').split(',') if path.strip()]
+
+
+def make_views(batch, views):
+    """(N, 64, 64, 3) float32 batch -> (len(views) * N, 64, 64, 3), grouped by view"""
+    out = np.empty((len(views),) + batch.shape, dtype=np.float32)
+    for i, view in enumerate(views):
+        if view == 'identity':
+            out[i] = batch
+        elif view in GEOMETRIC_VIEWS:
+            rows, cols = GEOMETRIC_VIEWS[view]
+            out[i] = batch[:, rows[:, np.newaxis], cols]
+        elif view == 'darker':
+            np.multiply(batch, 1 - BRIGHTNESS, out=out[i])
+        elif view == 'brighter':
+            np.minimum(batch * (1 + BRIGHTNESS), 1, out=out[i])
+        elif view == 'invert_luma':
+            # Move every pixel's luminance L to 1 - L; the colour differences between channels stay
+            shift = 1 - 2 * (batch @ LUMA_WEIGHTS)
+            np.clip(batch + shift[..., np.newaxis], 0, 1, out=out[i])
+    return out.reshape((-1,) + batch.shape[1:])
+
+
+class EnsembleEngine:
+    """Scores every view of every image with every ensemble member in one call of the wrapped engine"""
+
+    def __init__(self, engine, views, members=1):
+        self.engine = engine
+        self.views = views
+        self.members = members
+        self.warmup_seconds = None
+
+    @property
+    def ready(self):
+        return self.engine.ready
+
+    def predict(self, batch, verbose=0):
+        """Return (N, 2): mean score and its standard deviation over views and members"""
+        batch = np.asarray(batch, dtype=np.float32)
+        if batch.ndim == 3:
+            batch = batch[np.newaxis]
+        count = len(batch)
+        scores = np.asarray(self.engine.predict(make_views(batch, self.views)))
+        scores = scores.reshape(len(self.views), count, -1).transpose(1, 0, 2).reshape(count, -1)
+        return np.stack([scores.mean(axis=1), scores.std(axis=1)], axis=1)
+
+    def warmup(self, batch_sizes=(1, 8)):
+        start = time.perf_counter()
+        self.engine.warmup(batch_sizes=tuple(batch_size * len(self.views) for batch_size in batch_sizes))
+        self.warmup_seconds = time.perf_counter() - start
+
+
+def wrap(engine, views, members=1):
+    """Add test-time augmentation/ensemble aggregation to ``engine`` when either is configured"""
+    if len(views) == 1 and members == 1:
+        return engine
+    logger.info(f"Ensemble scoring: {len(views)} views ({', '.join(views)}) x {members} models "
+                f"= {len(views) * members} scores per image")
+    return EnsembleEngine(engine, views, members)
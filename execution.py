@@ -0,0 +1,34 @@
+import os
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class CPUExecutor:
+    """Sized thread pool for CPU-bound work that must not run on the asyncio event loop.
+
+    OpenCV and NumPy release the GIL for decode/resize/reduction work, so a
+    thread pool scales with core count without the pickling cost of processes.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or int(os.getenv('CPU_POOL_SIZE', os.cpu_count() or 4))
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="cpu-worker")
+        self.in_flight = 0  # only updated from event loop threads
+        logger.info(f"CPU executor started with {self.max_workers} workers")
+
+    async def run(self, fn, *args, **kwargs):
+        """Run ``fn(*args, **kwargs)`` in the pool and await its result"""
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        try:
+            return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+        finally:
+            self.in_flight -= 1
+
+    def shutdown(self, wait=True):
+        """Stop accepting work and release the worker threads"""
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,207 @@
+"""Incremental fine-tuning of the candlestick CNN on newly labelled charts.
+
+Instead of retraining from random initialization over the whole Train set,
+``finetune`` does the following:
+
+- warm-starts from the current weights;
+- trains on the labelled samples in ``new_dir`` that no earlier accepted run
+  has used yet, mixed with a random replay sample of older images (from
+  ``--replay-dir`` and earlier new samples). The replay sample keeps the
+  model from forgetting what it already knows;
+- runs a few epochs at a low learning rate, with early stopping on a
+  held-out slice of that mix;
+- scores the old and the new weights on ``img_candel_stick/Test`` and only
+  writes the new weights if Test accuracy has not dropped by more than
+  ``--tolerance``.
+
+Accepted weights are written atomically, either over ``--output`` or as a new
+timestamped file when ``--output`` is a directory (``MODEL_WEIGHTS_DIR``), so
+a running bot's model watcher picks them up and can roll back. Samples are
+only marked as used once a run is accepted. Images are read through the
+shard caches in ``dataset_cache.py``, so a daily run only decodes new files.
+
+Usage:
+    python finetune.py img_candel_stick/Confirmed
+    python finetune.py img_candel_stick/Confirmed --output weights/ --epochs 5 --replay-ratio 3
+"""
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import numpy as np
+from dataset_cache import update_cache, ShardedDataset
+from preprocessing import to_tensor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPLAY_DIR = './img_candel_stick/Train'
+DEFAULT_TEST_DIR = './img_candel_stick/Test'
+DEFAULT_CACHE_DIR = '.finetune_cache'
+STATE_NAME = 'state.json'
+
+
+def _read_state(cache_dir):
+    path = os.path.join(cache_dir, STATE_NAME)
+    if not os.path.exists(path):
+        return {"consumed": [], "runs": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_state(cache_dir, state):
+    path = os.path.join(cache_dir, STATE_NAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _load_split(data_dir, cache_dir):
+    """Refresh the shard cache of one labelled directory and open it"""
+    update_cache(data_dir, cache_dir)
+    return ShardedDataset(cache_dir)
+
+
+def latest_weights(output):
+    """Weights to warm-start from: ``output`` itself, or the newest .h5 file when it is a directory"""
+    from inference import DEFAULT_WEIGHTS_PATH
+
+    if os.path.isdir(output):
+        paths = glob.glob(os.path.join(output, '*.h5'))
+        return max(paths, key=os.path.getmtime) if paths else DEFAULT_WEIGHTS_PATH
+    return output if os.path.exists(output) else DEFAULT_WEIGHTS_PATH
+
+
+def output_path(output):
+    """Where accepted weights go: a new versioned file inside a directory, otherwise ``output`` itself"""
+    if os.path.isdir(output):
+        return os.path.join(output, f"candlestick_model_weights-ft{time.strftime('%Y%m%d-%H%M%S')}.h5")
+    return output
+
+
+def select_samples(new, replay, consumed, replay_ratio=2.0, seed=0):
+    """Unused new samples plus a random replay sample of up to ``replay_ratio`` times as many older images.
+
+    Returns (images uint8, labels, indices of ``new`` that are being consumed).
+    """
+    consumed = set(consumed)
+    fresh = np.array([i for i, digest in enumerate(new.hashes) if digest not in consumed], dtype=np.int64)
+    if not len(fresh):
+        return None, None, fresh
+    # Earlier new samples are replayed alongside the original training images
+    seen = np.array([i for i, digest in enumerate(new.hashes) if digest in consumed], dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    picked = rng.permutation(len(replay) + len(seen))[:int(round(replay_ratio * len(fresh)))]
+    replay_rows = np.sort(picked[picked < len(replay)])
+    seen_rows = np.sort(seen[picked[picked >= len(replay)] - len(replay)])
+
+    images = [new.images(fresh), replay.images(replay_rows), new.images(seen_rows)]
+    labels = [new.labels[fresh], replay.labels[replay_rows], new.labels[seen_rows]]
+    return np.concatenate(images), np.concatenate(labels), fresh
+
+
+def evaluate(model, dataset, batch_size=256):
+    """Test accuracy and loss of a Keras model over a whole ShardedDataset"""
+    indices = np.arange(len(dataset))
+    loss, accuracy = model.evaluate(to_tensor(dataset.images(indices)), dataset.labels.reshape(-1, 1),
+                                    batch_size=batch_size, verbose=0)
+    return {"accuracy": round(float(accuracy), 4), "loss": round(float(loss), 4)}
+
+
+def finetune(new_dir, weights=None, output=None, replay_dir=DEFAULT_REPLAY_DIR, test_dir=DEFAULT_TEST_DIR,
+             cache_dir=DEFAULT_CACHE_DIR, epochs=5, batch_size=32, learning_rate=1e-4, patience=2,
+             replay_ratio=2.0, tolerance=0.0, seed=5):
+    """One incremental training run; returns its report (``accepted`` says whether weights were written)"""
+    import tensorflow as tf
+    from sklearn.model_selection import train_test_split
+    from inference import DEFAULT_WEIGHTS_PATH
+    from model import create_candlestick_model, save_weights
+
+    started = time.perf_counter()
+    output = output or DEFAULT_WEIGHTS_PATH
+    weights = weights or latest_weights(output)
+    os.makedirs(cache_dir, exist_ok=True)
+    state = _read_state(cache_dir)
+
+    new = _load_split(new_dir, os.path.join(cache_dir, 'new'))
+    replay = _load_split(replay_dir, os.path.join(cache_dir, 'replay'))
+    test = _load_split(test_dir, os.path.join(cache_dir, 'test'))
+    images, labels, fresh = select_samples(new, replay, state["consumed"], replay_ratio, seed)
+    report = {"started_at": time.time(), "weights": weights, "new_samples": len(fresh), "accepted": False}
+    if images is None:
+        logger.info(f"No new samples in {new_dir}, nothing to fine-tune")
+        return report
+    report["replay_samples"] = len(images) - len(fresh)
+
+    tf.keras.utils.set_random_seed(seed)
+    model = create_candlestick_model()
+    model.load_weights(weights)
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate), loss='binary_crossentropy',
+                  metrics=['accuracy'])
+    report["before"] = evaluate(model, test)
+
+    # Early stopping watches a held-out slice of the new + replay mix, never the Test set it is gated on
+    stratify = labels if min(np.bincount(labels.astype(np.int64), minlength=2)) >= 2 else None
+    train_x, val_x, train_y, val_y = train_test_split(images, labels, test_size=0.2, random_state=seed,
+                                                      stratify=stratify)
+    early_stopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience,
+                                                      restore_best_weights=True)
+    history = model.fit(to_tensor(train_x), train_y.reshape(-1, 1), batch_size=batch_size, epochs=epochs,
+                        validation_data=(to_tensor(val_x), val_y.reshape(-1, 1)), callbacks=[early_stopping],
+                        verbose=2)
+    report["epochs"] = len(history.history['loss'])
+    report["after"] = evaluate(model, test)
+
+    change = report["after"]["accuracy"] - report["before"]["accuracy"]
+    if change >= -tolerance:
+        path = output_path(output)
+        save_weights(model, path)  # written to a temporary file and renamed, so the model watcher never sees it half-done
+        report.update(accepted=True, output=path)
+        state["consumed"] = sorted(set(state["consumed"]) | {new.hashes[i] for i in fresh})
+        logger.info(f"Test accuracy {report['before']['accuracy']:.4f} -> {report['after']['accuracy']:.4f}, "
+                    f"wrote {path}")
+    else:
+        logger.warning(f"Test accuracy dropped {report['before']['accuracy']:.4f} -> "
+                       f"{report['after']['accuracy']:.4f}, keeping {weights}")
+    report["seconds"] = round(time.perf_counter() - started, 1)
+    state["runs"].append(report)
+    _write_state(cache_dir, state)
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fine-tune the candlestick CNN on newly labelled samples")
+    parser.add_argument('new_dir', help="New labelled samples in DOWN/UP folders")
+    parser.add_argument('--weights', default=None,
+                        help="Weights to start from (default: --output, or the newest .h5 in it)")
+    parser.add_argument('--output', default=None,
+                        help="Weights file to replace, or a MODEL_WEIGHTS_DIR to add a versioned file to "
+                             "(default: candlestick_model_weights.h5)")
+    parser.add_argument('--replay-dir', default=DEFAULT_REPLAY_DIR, help="Older samples to replay")
+    parser.add_argument('--test-dir', default=DEFAULT_TEST_DIR, help="Accuracy gate for accepting the new weights")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="Shard caches and the run history")
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--learning-rate', type=float, default=1e-4)
+    parser.add_argument('--patience', type=int, default=2, help="Early stopping patience in epochs")
+    parser.add_argument('--replay-ratio', type=float, default=2.0, help="Replayed older images per new sample")
+    parser.add_argument('--tolerance', type=float, default=0.0, help="Largest Test accuracy drop still accepted")
+    parser.add_argument('--seed', type=int, default=5)
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args = parse_args()
+    report = finetune(args.new_dir, args.weights, args.output, args.replay_dir, args.test_dir, args.cache_dir,
+                      args.epochs, args.batch_size, args.learning_rate, args.patience, args.replay_ratio,
+                      args.tolerance, args.seed)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["accepted"] or not report["new_samples"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""Telegram reply formatting: everyday Markdown in, MarkdownV2 parts out.
+
+Replies are written, by us and by Gemini, in everyday Markdown: ``**bold**``,
+``*italic*``/``_italic_``, ``~~strike~~``, `` `code` ``, fenced code blocks,
+``[links](url)``, ``#`` headings and ``*``/``-`` bullets.
+
+- ``parse`` turns that into a flat list of segments. Unbalanced markers
+  become literal text.
+- ``render`` writes the segments as MarkdownV2 with every reserved character
+  escaped, so Telegram accepts the formatting.
+- ``split`` packs segments into parts of at most ``limit`` rendered
+  characters in a single pass, preferring line boundaries. An entity that
+  does not fit is closed at the end of one part and reopened in the next; it
+  is never cut open.
+- ``validate`` checks a string against Telegram's Markdown or MarkdownV2 rules
+  without sending it. ``render_message`` runs it on every part, so a renderer
+  bug degrades to plain text instead of a rejected request.
+"""
+import re
+import logging
+from collections import namedtuple
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 1000  # Keep replies concise
+TELEGRAM_MAX_LENGTH = 4096
+CONTINUED = '_Continued\\.\\.\\._\n\n'
+CONTINUED_PLAIN = 'Continued...\n\n'
+
+FORMAT_FALLBACKS = REGISTRY.counter(
+    'telegram_format_fallbacks_total', 'Reply parts sent as plain text instead of MarkdownV2', labelnames=('reason',))
+
+# One run of text with a single formatting: text, bold, italic, strike, code, pre or link (with url)
+Segment = namedtuple('Segment', ['kind', 'text', 'url'], defaults=(None,))
+# One message to send: MarkdownV2 text (or plain text when parse_mode is None) and its plain fallback
+MessagePart = namedtuple('MessagePart', ['text', 'parse_mode', 'plain'])
+
+_V2_RESERVED = '_*[]()~`>#+-=|{}.!\\'
+_CODE_RESERVED = '`\\'
+_V2_ESCAPE = str.maketrans({char: '\\' + char for char in _V2_RESERVED})
+_CODE_ESCAPE = str.maketrans({char: '\\' + char for char in _CODE_RESERVED})
+_URL_ESCAPE = str.maketrans({')': '\\)', '\\': '\\\\'})
+_WRAP = {'bold': ('*', '*'), 'italic': ('_', '_'), 'strike': ('~', '~'), 'code': ('`', '`'),
+         'pre': ('```\n', '\n```')}
+
+_INLINE = re.compile(
+    r'```(?:[\w+-]*\n)?(?P<pre>[\s\S]*?)```'
+    r'|`(?P<code>[^`\n]+)`'
+    r'|\[(?P<link>[^\]\n]+)\]\((?P<url>[^()\s]+)\)'
+    r'|\*\*(?P<bold>[^*\n]+)\*\*'
+    r'|__(?P<bold_>[^_\n]+)__'
+    r'|~~(?P<strike>[^~\n]+)~~'
+    r'|(?<![\w*\\])\*(?=[^\s*])(?P<italic>[^*\n]*[^\s*])\*(?![\w*])'
+    r'|(?<![\w\\])_(?=[^\s_])(?P<italic_>[^_\n]*[^\s_])_(?!\w)'
+)
+_KINDS = ('pre', 'code', 'link', 'bold', 'bold_', 'strike', 'italic', 'italic_')
+_HEADING = re.compile(r'^[ \t]*#{1,6}[ \t]+(.+?)[ \t#]*$', re.M)
+_BULLET = re.compile(r'^([ \t]*)[*+-][ \t]+', re.M)
+_OPENER = re.compile(r'(?<!\S)(?:\*\*|__|~~|```|[*_`\[])(?=\S)')
+
+
+def escape(text):
+    """Escape plain text for MarkdownV2"""
+    return text.translate(_V2_ESCAPE)
+
+
+def escape_code(text):
+    """Escape the contents of a MarkdownV2 code or pre entity"""
+    return text.translate(_CODE_ESCAPE)
+
+
+def escape_url(url):
+    """Escape the URL part of a MarkdownV2 inline link"""
+    return url.translate(_URL_ESCAPE)
+
+
+def _append(segments, kind, text, url=None):
+    if not text:
+        return
+    if segments and kind != 'link' and segments[-1].kind == kind:
+        # Adjacent runs with the same formatting render as one entity (avoids '_a__b_' ambiguity)
+        segments[-1] = segments[-1]._replace(text=segments[-1].text + text)
+    else:
+        segments.append(Segment(kind, text, url))
+
+
+def parse(text):
+    """Split everyday Markdown into segments; markers without a partner stay literal text"""
+    text = _BULLET.sub(r'\1• ', text)
+    text = _HEADING.sub(lambda m: m.group(1) if '*' in m.group(1) else f"**{m.group(1)}**", text)
+    segments = []
+    pos = 0
+    for match in _INLINE.finditer(text):
+        _append(segments, 'text', text[pos:match.start()])
+        for kind in _KINDS:
+            value = match.group(kind)
+            if value is not None:
+                break
+        if kind == 'pre':
+            value = value.strip('\n')
+        _append(segments, kind.rstrip('_'), value, match.group('url'))
+        pos = match.end()
+    _append(segments, 'text', text[pos:])
+    return segments
+
+
+def render_segment(segment):
+    """MarkdownV2 for one segment"""
+    kind, text, url = segment
+    if kind == 'text':
+        return escape(text)
+    if kind == 'link':
+        return f"[{escape(text)}]({escape_url(url)})"
+    start, end = _WRAP[kind]
+    body = escape_code(text) if kind in ('code', 'pre') else escape(text)
+    return f"{start}{body}{end}"
+
+
+def plain_segment(segment):
+    """Plain-text equivalent of one segment"""
+    if segment.kind == 'link' and segment.url != segment.text:
+        return f"{segment.text} ({segment.url})"
+    return segment.text
+
+
+def render(segments):
+    return ''.join(map(render_segment, segments))
+
+
+def _lines(segments):
+    """Group segments into lines; text segments are cut after each newline"""
+    line = []
+    for segment in segments:
+        if segment.kind != 'text' or '\n' not in segment.text:
+            line.append(segment)
+            continue
+        for chunk in segment.text.splitlines(keepends=True):
+            line.append(Segment('text', chunk))
+            if chunk.endswith('\n'):
+                yield line
+                line = []
+    if line:
+        yield line
+
+
+def _cut(segment, limit):
+    """Cut one segment that renders longer than ``limit`` into same-kind segments that fit, at spaces where possible"""
+    overhead = len(render_segment(segment._replace(text='')))
+    if overhead > limit // 2:
+        # A link whose URL alone eats the budget is sent as text instead
+        segment, overhead = Segment('text', plain_segment(segment)), 0
+    escaped = _CODE_RESERVED if segment.kind in ('code', 'pre') else _V2_RESERVED
+    budget = limit - overhead
+    text = segment.text
+    start = size = 0
+    last_space = -1
+    for i, char in enumerate(text):
+        width = 2 if char in escaped else 1
+        # After a cut at a space the carried-over words plus this character may still not fit,
+        # so keep cutting (by then at this character) until they do
+        while size + width > budget and start < i:
+            cut = last_space + 1 if last_space >= start else i
+            yield segment._replace(text=text[start:cut])
+            start = cut
+            size = sum(2 if c in escaped else 1 for c in text[start:i])
+        if char.isspace():
+            last_space = i
+        size += width
+    if start < len(text):
+        yield segment._replace(text=text[start:])
+
+
+def split(segments, limit=MAX_MESSAGE_LENGTH):
+    """Pack segments into parts rendering to at most ``limit`` characters; returns lists of segments"""
+    parts = []
+    current = []
+    size = 0
+    for line in _lines(segments):
+        rendered = [len(render_segment(segment)) for segment in line]
+        line_size = sum(rendered)
+        if size + line_size > limit and current:
+            parts.append(current)
+            current, size = [], 0
+        if line_size <= limit:
+            current.extend(line)
+            size += line_size
+            continue
+        # A line longer than a whole part: pack its segments, cutting the ones that do not fit at all
+        for segment, segment_size in zip(line, rendered):
+            pieces = [(segment, segment_size)] if segment_size <= limit else \
+                [(piece, len(render_segment(piece))) for piece in _cut(segment, limit)]
+            for piece, piece_size in pieces:
+                if size + piece_size > limit and current:
+                    parts.append(current)
+                    current, size = [], 0
+                current.append(piece)
+                size += piece_size
+    if current:
+        parts.append(current)
+    return parts
+
+
+def render_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Turn a Markdown reply into MessageParts that each fit in one Telegram message"""
+    parts = []
+    for segments in split(parse(text), limit - len(CONTINUED)):
+        rendered = render(segments).strip()
+        plain = ''.join(map(plain_segment, segments)).strip()
+        if not plain:
+            continue
+        if parts:
+            rendered, plain = CONTINUED + rendered, CONTINUED_PLAIN + plain
+        error = validate(rendered)
+        if not error and len(rendered) > limit:
+            error = f"part renders to {len(rendered)} characters, over the {limit} limit"
+        if error:
+            logger.warning(f"Rendered MarkdownV2 failed validation, sending plain text: {error}")
+            FORMAT_FALLBACKS.inc('invalid')
+            parts.append(MessagePart(plain, None, plain))
+        else:
+            parts.append(MessagePart(rendered, 'MarkdownV2', plain))
+    return parts
+
+
+def prerender(text, limit=TELEGRAM_MAX_LENGTH):
+    """Render a static message once (e.g. at import); raises ValueError if it would not be valid MarkdownV2"""
+    parts = render_message(text, limit)
+    if any(part.parse_mode is None for part in parts):
+        raise ValueError(f"Message does not render to valid MarkdownV2: {text[:60]!r}")
+    return parts
+
+
+def trim_dangling(text):
+    """Drop an unclosed marker (and what follows it) from the last line, e.g. after truncation"""
+    line_start = text.rfind('\n') + 1
+    line = text[line_start:]
+    covered = 0
+    for match in _INLINE.finditer(line):
+        covered = match.end()
+    # Truncation only ever leaves the opener after the last complete entity, with no partner after it
+    for opener in _OPENER.finditer(line, covered):
+        partner = ')' if opener.group() == '[' else opener.group()
+        if line.find(partner, opener.end()) < 0:
+            trimmed = text[:line_start + opener.start()].rstrip()
+            return trimmed if trimmed else text
+    return text
+
+
+def clean_markdown(text):
+    """Tidy a Markdown reply: trim a dangling marker at the end and collapse runs of blank lines"""
+    text = trim_dangling(text.rstrip())
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+def _validate_v2(text):
+    stack = []  # open '*', '_', '__', '~', '||' and '[' markers
+    n = len(text)
+    i = 0
+    while i < n:
+        char = text[i]
+        if char == '\\':
+            if i + 1 >= n:
+                return f"Character '\\' at {i} escapes nothing"
+            i += 2
+            continue
+        if char == '`':
+            marker = '```' if text.startswith('```', i) else '`'
+            if stack:
+                return f"Code entity at {i} cannot be nested inside another entity"
+            j = i + len(marker)
+            while True:
+                if j >= n:
+                    return f"Can't find end of {'pre' if marker == '```' else 'code'} entity starting at {i}"
+                if text[j] == '\\':
+                    j += 2
+                    continue
+                if text[j] == '`':
+                    if text.startswith(marker, j):
+                        break
+                    return f"Character '`' at {j} must be escaped inside a pre entity"
+                j += 1
+            i = j + len(marker)
+            continue
+        if char == '[':
+            stack.append('[')
+            i += 1
+            continue
+        if char == ']':
+            if not stack or stack[-1] != '[':
+                return f"Character ']' at {i} is reserved and must be escaped"
+            if not text.startswith('(', i + 1):
+                return f"Link text ending at {i} must be followed by '(url)'"
+            j = i + 2
+            while j < n and text[j] != ')':
+                j += 2 if text[j] == '\\' else 1
+            if j >= n:
+                return f"Can't find end of the URL starting at {i + 2}"
+            stack.pop()
+            i = j + 1
+            continue
+        marker = next((m for m in ('||', '__', '*', '_', '~') if text.startswith(m, i)), None)
+        if marker:
+            if stack and stack[-1] == marker:
+                stack.pop()
+            elif marker in stack:
+                return f"Entity '{marker}' closed at {i} overlaps another entity"
+            else:
+                stack.append(marker)
+            i += len(marker)
+            continue
+        if char in _V2_RESERVED:
+            return f"Character '{char}' at {i} is reserved and must be escaped with the preceding '\\'"
+        i += 1
+    if stack:
+        return f"Can't find end of the '{stack[-1]}' entity"
+    return None
+
+
+def _validate_legacy(text):
+    n = len(text)
+    i = 0
+    while i < n:
+        char = text[i]
+        if char == '\\' and i + 1 < n and text[i + 1] in '_*`[':
+            i += 2
+            continue
+        if char in '*_':
+            end = text.find(char, i + 1)
+        elif char == '`':
+            marker = '```' if text.startswith('```', i) else '`'
+            end = text.find(marker, i + len(marker))
+            end = end + len(marker) - 1 if end >= 0 else end
+        elif char == '[':
+            end = text.find(']', i + 1)
+            if end >= 0 and text.startswith('(', end + 1):
+                end = text.find(')', end + 2)
+        else:
+            i += 1
+            continue
+        if end < 0:
+            return f"Can't find end of the entity starting at {i}"
+        i = end + 1
+    return None
+
+
+def validate(text, parse_mode='MarkdownV2'):
+    """Check ``text`` against Telegram's entity rules for ``parse_mode``; returns None or an error description"""
+    if parse_mode == 'MarkdownV2':
+        return _validate_v2(text)
+    if parse_mode == 'Markdown':
+        return _validate_legacy(text)
+    raise ValueError(f"Unsupported parse mode: {parse_mode}")
@@ -1,8 +1,13 @@
 import os
+import asyncio
 import google.generativeai as genai
 from dotenv import load_dotenv
 import logging
-import re
+from types import SimpleNamespace
+import httpx
+from cache import ResponseCache
+from metrics import GEMINI_FALLBACKS
+from formatting import clean_markdown
 
 # Load environment variables
 load_dotenv()
@@ -11,16 +16,72 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class GeminiRestModel:
+    """Minimal client for the Gemini REST ``generateContent`` endpoint at a configurable base URL.
+
+    Used when ``GEMINI_API_BASE_URL`` is set, e.g. to go through a proxy or a
+    local stand-in server during load tests. Responses expose ``.text`` like
+    the SDK's.
+    """
+
+    def __init__(self, model_name, api_key, base_url, timeout=15):
+        self.url = f"{base_url.rstrip('/')}/v1beta/models/{model_name}:generateContent"
+        self.params = {'key': api_key}
+        self.timeout = timeout
+        self._client = None
+        self._async_client = None
+
+    @staticmethod
+    def _body(prompt):
+        return {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+
+    @staticmethod
+    def _parse(response):
+        response.raise_for_status()
+        candidates = response.json().get("candidates") or [{}]
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return SimpleNamespace(text="".join(part.get("text", "") for part in parts))
+
+    def generate_content(self, prompt):
+        if self._client is None:
+            self._client = httpx.Client(timeout=self.timeout)
+        return self._parse(self._client.post(self.url, params=self.params, json=self._body(prompt)))
+
+    async def generate_content_async(self, prompt):
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(timeout=self.timeout)
+        return self._parse(await self._async_client.post(self.url, params=self.params, json=self._body(prompt)))
+
+
 class GeminiHelper:
-    def __init__(self):
+    def __init__(self, model=None):
         self.api_key = os.getenv('GEMINI_API_KEY')
         logger.info(f"Gemini API Key found: {'Yes' if self.api_key else 'No'}")
         
+        # Cap concurrent Gemini round-trips and bound how long a reply may take
+        self.max_concurrency = int(os.getenv('GEMINI_MAX_CONCURRENCY', 8))
+        self.timeout = float(os.getenv('GEMINI_TIMEOUT', 15))
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.response_cache = ResponseCache()
+        
+        if model is not None:
+            # Injected client (e.g. a local stub) - skip API configuration
+            self.model = model
+            self.enabled = True
+            return
+        
         if not self.api_key:
             logger.warning("GEMINI_API_KEY not found. Gemini features will be disabled.")
             self.enabled = False
             return
         
+        base_url = os.getenv('GEMINI_API_BASE_URL')
+        if base_url:
+            self.model = GeminiRestModel('gemini-2.0-flash', self.api_key, base_url, self.timeout)
+            self.enabled = True
+            logger.info(f"Gemini AI using REST endpoint {base_url}")
+            return
+        
         try:
             genai.configure(api_key=self.api_key)
             # Use gemini-2.0-flash for text analysis
@@ -37,17 +98,75 @@ class GeminiHelper:
         
         if not self.enabled:
             logger.warning("Gemini is disabled, using basic analysis")
+            GEMINI_FALLBACKS.inc('disabled')
             return self._get_basic_analysis(prediction, confidence)
         
         try:
-            trend = "UP (Bullish)" if prediction > 0.5 else "DOWN (Bearish)"
+            cache_key, prompt = self._prepare_request(prediction, confidence, image_description)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Using cached Gemini response")
+                return cached
             
-            prompt = f"""
+            logger.info("Sending request to Gemini API...")
+            response = self.model.generate_content(prompt)
+            logger.info("Received response from Gemini API")
+            
+            return self._process_response(response, prediction, confidence, cache_key)
+            
+        except Exception as e:
+            logger.error(f"Error enhancing ML result: {e}")
+            GEMINI_FALLBACKS.inc('error')
+            return self._get_basic_analysis(prediction, confidence)
+    
+    async def enhance_ml_result_async(self, prediction, confidence, image_description=""):
+        """Async variant of enhance_ml_result that never blocks the event loop"""
+        logger.info(f"Enhancing ML result - Prediction: {prediction}, Confidence: {confidence}")
+        
+        if not self.enabled:
+            logger.warning("Gemini is disabled, using basic analysis")
+            GEMINI_FALLBACKS.inc('disabled')
+            return self._get_basic_analysis(prediction, confidence)
+        
+        try:
+            cache_key, prompt = self._prepare_request(prediction, confidence, image_description)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Using cached Gemini response")
+                return cached
+            
+            async with self._semaphore:
+                logger.info("Sending async request to Gemini API...")
+                response = await asyncio.wait_for(self.model.generate_content_async(prompt), timeout=self.timeout)
+            logger.info("Received response from Gemini API")
+            
+            return self._process_response(response, prediction, confidence, cache_key)
+            
+        except asyncio.TimeoutError:
+            logger.warning(f"Gemini request timed out after {self.timeout}s, using basic analysis")
+            GEMINI_FALLBACKS.inc('timeout')
+            return self._get_basic_analysis(prediction, confidence)
+        except Exception as e:
+            logger.error(f"Error enhancing ML result: {e}")
+            GEMINI_FALLBACKS.inc('error')
+            return self._get_basic_analysis(prediction, confidence)
+    
+    def _prepare_request(self, prediction, confidence, image_description=""):
+        """Return (cache key, prompt); the key uses the normalized description, the prompt the original one"""
+        trend = "UP (Bullish)" if prediction > 0.5 else "DOWN (Bearish)"
+        score = self.response_cache.bucket_score(prediction)
+        description = self.response_cache.normalize_description(image_description)
+        cache_key = self.response_cache.fingerprint(trend, score, confidence, description)
+        return cache_key, self._build_prompt(trend, score, confidence, image_description)
+    
+    def _build_prompt(self, trend, score, confidence, image_description=""):
+        """Build the Gemini prompt for an ML result"""
+        return f"""
 You are a professional stock market analyst. The ML model has analyzed a candlestick chart and provided these results:
 
 **ML Model Results:**
 - Prediction: {trend}
-- Score: {prediction:.3f}
+- Score: {score:.3f}
 - Confidence: {confidence}
 - Chart: {image_description if image_description else "Candlestick chart"}
 
@@ -64,40 +183,25 @@ Format in markdown.
 
 Remember: This is for educational purposes only.
             """
-            
-            logger.info("Sending request to Gemini API...")
-            response = self.model.generate_content(prompt)
-            logger.info("Received response from Gemini API")
-            
-            if response and response.text:
-                # Limit response length for Telegram and clean up formatting
-                response_text = response.text[:1000]  # Keep responses concise
-                response_text = self._clean_markdown(response_text)
-                logger.info(f"Gemini response length: {len(response_text)} characters")
-                return response_text
-            else:
-                logger.error("Empty response from Gemini API")
-                return self._get_basic_analysis(prediction, confidence)
-            
-        except Exception as e:
-            logger.error(f"Error enhancing ML result: {e}")
+    
+    def _process_response(self, response, prediction, confidence, cache_key=None):
+        """Turn a Gemini response into Telegram-ready text, falling back to basic analysis"""
+        if response and response.text:
+            # Limit response length for Telegram and clean up formatting
+            response_text = response.text[:1000]  # Keep responses concise
+            response_text = self._clean_markdown(response_text)
+            logger.info(f"Gemini response length: {len(response_text)} characters")
+            if cache_key is not None:
+                self.response_cache.put(cache_key, response_text)
+            return response_text
+        else:
+            logger.error("Empty response from Gemini API")
+            GEMINI_FALLBACKS.inc('empty_response')
             return self._get_basic_analysis(prediction, confidence)
     
     def _clean_markdown(self, text):
-        """Clean up markdown formatting to prevent Telegram parsing errors"""
-        # Remove any incomplete markdown formatting
-        text = re.sub(r'\*\*[^*]*$', '', text)  # Remove incomplete bold
-        text = re.sub(r'\*[^*]*$', '', text)    # Remove incomplete italic
-        text = re.sub(r'`[^`]*$', '', text)     # Remove incomplete code
-        text = re.sub(r'\[[^\]]*$', '', text)   # Remove incomplete links
-        
-        # Ensure proper line breaks
-        text = text.replace('\n\n\n', '\n\n')
-        
-        # Remove any trailing incomplete formatting
-        text = text.strip()
-        
-        return text
+        """Drop formatting left unclosed by truncation; escaping happens when the reply is rendered"""
+        return clean_markdown(text)
     
     def _get_basic_analysis(self, prediction, confidence):
         """Basic analysis when Gemini is not available"""
@@ -0,0 +1,178 @@
+import os
+import time
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Constants
+img_height = 64
+img_width = 64
+
+DEFAULT_WEIGHTS_PATH = 'candlestick_model_weights.h5'
+DEFAULT_TFLITE_PATH = 'candlestick_model_int8.tflite'
+
+
+def create_keras_model(weights_path=DEFAULT_WEIGHTS_PATH):
+    """Create the candlestick CNN in Keras and load its weights"""
+    # Imported lazily so the NumPy backend never pulls in TensorFlow
+    from tensorflow.keras import layers, models
+
+    model = models.Sequential()
+    model.add(layers.Conv2D(32, (3, 3), activation='relu', input_shape=(img_height, img_width, 3)))
+    model.add(layers.MaxPooling2D((2, 2)))
+    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
+    model.add(layers.MaxPooling2D((2, 2)))
+    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
+    model.add(layers.Flatten())
+    model.add(layers.Dense(64, activation='relu'))
+    model.add(layers.Dense(1, activation='sigmoid'))
+    model.load_weights(weights_path)
+    return model
+
+
+def create_keras_ensemble(weights_paths):
+    """One Keras model that runs every member on the same input and concatenates their scores into (N, M)"""
+    from tensorflow.keras import layers, models
+
+    members = [create_keras_model(path) for path in weights_paths]
+    inputs = layers.Input(shape=(img_height, img_width, 3))
+    return models.Model(inputs, layers.Concatenate()([member(inputs) for member in members]))
+
+
+def _tflite_interpreter_class():
+    """Standalone LiteRT/TFLite runtime if installed, otherwise the interpreter bundled with TensorFlow"""
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+class TFLiteModel:
+    """``predict`` on a quantized (int8/float16) .tflite export of the candlestick CNN (see quantize.py)"""
+
+    def __init__(self, path, num_threads=None):
+        self.path = path
+        self.interpreter = _tflite_interpreter_class()(model_path=path, num_threads=num_threads)
+        self._input = self.interpreter.get_input_details()[0]['index']
+        self._output = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        self._lock = threading.Lock()  # the interpreter holds per-call state
+
+    @classmethod
+    def load(cls, path=None):
+        num_threads = os.getenv('TFLITE_NUM_THREADS')
+        model = cls(path or DEFAULT_TFLITE_PATH, int(num_threads) if num_threads else None)
+        logger.info(f"TFLite model loaded from {model.path}")
+        return model
+
+    def predict(self, x, verbose=0, **kwargs):
+        """Return scores of shape (N, 1); the interpreter is re-planned only when N changes"""
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim == 3:
+            x = x[np.newaxis]
+        with self._lock:
+            if x.shape[0] != self._batch_size:
+                self.interpreter.resize_tensor_input(self._input, x.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = x.shape[0]
+            self.interpreter.set_tensor(self._input, x)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output).copy()
+
+    __call__ = predict
+
+
+class TFLiteEnsemble:
+    """TFLite members cannot share one graph; each scores the whole batch once, giving (N, M)"""
+
+    def __init__(self, members):
+        self.members = members
+
+    def predict(self, x, verbose=0, **kwargs):
+        return np.concatenate([member.predict(x) for member in self.members], axis=1)
+
+    __call__ = predict
+
+
+class InferenceEngine:
+    """Low-overhead prediction wrapper around a loaded candlestick model.
+
+    For Keras models ``predict`` goes through a ``tf.function`` with a fixed
+    (N, 64, 64, 3) float32 signature, which skips the data adapter that
+    ``model.predict`` builds on every call and traces exactly once.
+    ``warmup`` runs that trace ahead of time and flips ``ready``.
+    """
+
+    def __init__(self, model, backend):
+        self.model = model
+        self.backend = backend
+        self.ready = False
+        self.warmup_seconds = None
+
+        if backend == 'keras':
+            import tensorflow as tf
+
+            self._call = tf.function(
+                lambda x: model(x, training=False),
+                input_signature=[tf.TensorSpec(shape=(None, img_height, img_width, 3), dtype=tf.float32)],
+            )
+        else:
+            self._call = model.predict
+
+    def predict(self, batch, verbose=0):
+        """Return scores of shape (N, 1) for a (N, 64, 64, 3) batch"""
+        batch = np.asarray(batch, dtype=np.float32)
+        if batch.ndim == 3:
+            batch = batch[np.newaxis]
+        return np.asarray(self._call(batch))
+
+    def warmup(self, batch_sizes=(1, 8)):
+        """Run dummy batches so the first real request does not pay for tracing/initialisation"""
+        start = time.perf_counter()
+        for batch_size in batch_sizes:
+            self.predict(np.zeros((batch_size, img_height, img_width, 3), dtype=np.float32))
+        self.warmup_seconds = time.perf_counter() - start
+        self.ready = True
+        logger.info(f"Model warm-up finished in {self.warmup_seconds:.2f}s")
+
+
+def load_model(backend=None, weights_path=None):
+    """Load the candlestick model for serving.
+
+    ``backend`` is ``keras`` (default), ``numpy`` or ``tflite`` (quantized
+    export); either way the model is returned wrapped in an ``InferenceEngine``.
+    ``ENSEMBLE_WEIGHTS`` adds more weights files as ensemble members and
+    ``TTA_VIEWS`` scores augmented views of each image; with either set, the
+    engine is wrapped in an ``ensemble.EnsembleEngine``.
+    """
+    from ensemble import parse_views, ensemble_paths, wrap
+
+    backend = (backend or os.getenv('MODEL_BACKEND', 'keras')).lower()
+    weights_path = weights_path or os.getenv('MODEL_WEIGHTS_PATH')
+    extra_weights = ensemble_paths(os.getenv('ENSEMBLE_WEIGHTS'))
+    views = parse_views(os.getenv('TTA_VIEWS'))
+
+    if backend == 'numpy':
+        from numpy_model import NumpyCandlestickModel, StackedNumpyModel
+        model = NumpyCandlestickModel.load(weights_path)
+        if extra_weights:
+            model = StackedNumpyModel([model] + [NumpyCandlestickModel.load(path) for path in extra_weights])
+    elif backend == 'tflite':
+        model = TFLiteModel.load(weights_path)
+        if extra_weights:
+            model = TFLiteEnsemble([model] + [TFLiteModel.load(path) for path in extra_weights])
+    elif backend == 'keras':
+        weights_path = weights_path or DEFAULT_WEIGHTS_PATH
+        model = create_keras_ensemble([weights_path] + extra_weights) if extra_weights else create_keras_model(weights_path)
+    else:
+        raise ValueError(f"Unknown MODEL_BACKEND: {backend}")
+
+    logger.info(f"Model weights loaded successfully ({backend} backend)")
+    return wrap(InferenceEngine(model, backend), views, 1 + len(extra_weights))
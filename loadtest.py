@@ -0,0 +1,482 @@
+"""Local load test for the webhook deployment (``app.py``).
+
+Starts stand-in servers for the Telegram Bot API and for Gemini (each with
+configurable latency), launches ``app.py`` pointed at them through
+``TELEGRAM_API_BASE_URL`` / ``GEMINI_API_BASE_URL``, and posts synthetic
+Telegram updates (photos, commands, plain text) to ``/webhook`` following a
+constant, ramp or burst schedule. Nothing leaves the machine.
+
+Reported: offered vs achieved rate, webhook status codes and latency
+percentiles, and end-to-end latency (webhook POST -> last reply the bot sent
+to that chat) per update type, with error and timeout rates.
+
+Usage:
+    python loadtest.py --profile constant --rate 20 --duration 30
+    python loadtest.py --profile ramp --rate 5 --peak-rate 100 --duration 60
+    python loadtest.py --profile burst --burst-size 200 --burst-interval 10 --duration 30
+    python loadtest.py --target http://127.0.0.1:5000 --telegram-port 8081 --gemini-port 8082 ...
+    # ...then start the app with TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 and GEMINI_API_BASE_URL=http://127.0.0.1:8082
+"""
+import os
+import sys
+import json
+import glob
+import time
+import random
+import asyncio
+import argparse
+import threading
+import subprocess
+from collections import Counter, defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+import cv2
+import httpx
+import numpy as np
+
+SAMPLE_GLOBS = ('img_candel_stick/Test/*/*', 'stock_images/*')
+PHOTO_SIDES = (90, 320, 800, 1280)  # longest side of the sizes Telegram generates
+CHAT_ID_BASE = 10_000_000
+BOT_TOKEN = '123456:LOADTEST'
+
+
+def percentiles(values):
+    """p50/p90/p99/max in milliseconds for a list of seconds"""
+    if not values:
+        return {}
+    values = np.asarray(values) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p90_ms": round(float(np.percentile(values, 90)), 2),
+        "p99_ms": round(float(np.percentile(values, 99)), 2),
+        "max_ms": round(float(values.max()), 2),
+    }
+
+
+class PhotoLibrary:
+    """Sample charts pre-encoded as JPEGs at each Telegram photo size"""
+
+    def __init__(self):
+        paths = sorted(path for pattern in SAMPLE_GLOBS for path in glob.glob(pattern))
+        self.photos = []  # [{side: (width, height, jpeg bytes)}]
+        for path in paths:
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+            if img is None:
+                continue
+            sizes = {}
+            for side in PHOTO_SIDES:
+                scale = min(1.0, side / max(img.shape[:2]))
+                resized = cv2.resize(img, (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale))),
+                                     interpolation=cv2.INTER_AREA)
+                sizes[side] = (resized.shape[1], resized.shape[0], cv2.imencode('.jpg', resized)[1].tobytes())
+            self.photos.append(sizes)
+        if not self.photos:
+            raise FileNotFoundError(f"No sample images found under {SAMPLE_GLOBS}")
+
+    def photo_sizes(self, index, unique_id):
+        return [{"file_id": f"photo-{index}-{side}", "file_unique_id": f"{unique_id}-{side}",
+                 "width": width, "height": height, "file_size": len(data)}
+                for side, (width, height, data) in self.photos[index].items()]
+
+    def file_bytes(self, file_id):
+        _, index, side = file_id.split('-')
+        return self.photos[int(index)][int(side)][2]
+
+
+class StandInServer:
+    """Threaded HTTP server whose handler sleeps ``latency`` seconds before answering"""
+
+    def __init__(self, handle, latency=0.0, port=0):
+        self.latency = latency
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                if server.latency:
+                    time.sleep(server.latency)
+                status, content_type, payload = handle(self.command, self.path, self.headers, body)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+class TelegramStandIn:
+    """Bot API stand-in: answers the methods the bot uses and records every reply per chat"""
+
+    def __init__(self, library, latency=0.0, port=0):
+        self.library = library
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.replies = defaultdict(list)  # chat_id -> [(time, text)]
+        self.message_ids = iter(range(1, 10 ** 9))
+        self.server = StandInServer(self.handle, latency, port)
+        self.url = self.server.url
+
+    @staticmethod
+    def _params(headers, body):
+        if 'json' in (headers.get('Content-Type') or ''):
+            return json.loads(body or b'{}')
+        params = {key: values[0] for key, values in parse_qs(body.decode('utf-8', 'replace')).items()}
+        for key, value in params.items():
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                pass
+        return params
+
+    def _message(self, chat_id, text):
+        return {"message_id": next(self.message_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": text}
+
+    def handle(self, command, path, headers, body):
+        parts = urlparse(path).path.strip('/').split('/')
+        if parts[0] == 'file':
+            # /file/bot<token>/<file_path>
+            with self.lock:
+                self.calls['download'] += 1
+            return 200, 'image/jpeg', self.library.file_bytes(os.path.basename(parts[-1]))
+
+        method = parts[-1]
+        params = self._params(headers, body)
+        with self.lock:
+            self.calls[method] += 1
+        if method == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "Load Test", "username": "loadtest_bot",
+                      "can_join_groups": False, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif method == 'getFile':
+            file_id = params.get('file_id')
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"photos/{file_id}",
+                      "file_size": len(self.library.file_bytes(file_id))}
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            text = params.get('text', '')
+            with self.lock:
+                self.replies[chat_id].append((time.perf_counter(), text))
+            result = self._message(chat_id, text)
+        else:
+            result = True  # setMyCommands, deleteMessage, setWebhook, ...
+        return 200, 'application/json', json.dumps({"ok": True, "result": result}).encode()
+
+
+class GeminiStandIn:
+    """Gemini ``generateContent`` stand-in returning a canned analysis"""
+
+    TEXT = ("📈 **Trend**: Load-test analysis of the predicted move.\n"
+            "🎯 **Key Levels**: Watch recent support and resistance.\n"
+            "⚠️ **Risk**: Use stop losses.\n"
+            "💡 **Action**: Wait for confirmation.")
+
+    def __init__(self, latency=0.0, port=0):
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.server = StandInServer(self.handle, latency, port)
+        self.url = self.server.url
+
+    def handle(self, command, path, headers, body):
+        with self.lock:
+            self.calls += 1
+        response = {"candidates": [{"content": {"role": "model", "parts": [{"text": self.TEXT}]},
+                                    "finishReason": "STOP"}]}
+        return 200, 'application/json', json.dumps(response).encode()
+
+
+class UpdateFactory:
+    """Builds realistic webhook payloads; every update gets its own chat so replies can be matched"""
+
+    COMMANDS = ('/start', '/help', '/info', '/status')  # /analyze is only a menu entry - it has no handler
+    TEXTS = ('hello', 'thanks!', 'what does this chart mean?', 'hi there')
+
+    def __init__(self, library, mix, repeat_photos=0.0, seed=0):
+        self.library = library
+        self.kinds, self.weights = zip(*mix.items())
+        self.repeat_photos = repeat_photos
+        self.rng = random.Random(seed)
+        self.update_ids = iter(range(1, 10 ** 9))
+
+    def make(self):
+        update_id = next(self.update_ids)
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        chat_id = CHAT_ID_BASE + update_id
+        user = {"id": chat_id, "is_bot": False, "first_name": "Load", "username": f"user{update_id}"}
+        message = {"message_id": update_id, "date": int(time.time()), "from": user,
+                   "chat": {"id": chat_id, "type": "private", "first_name": "Load"}}
+        if kind == 'photo':
+            index = self.rng.randrange(len(self.library.photos))
+            # Re-sent photos keep their file_unique_id, so they can hit the bot's caches
+            unique_id = f"p{index}" if self.rng.random() < self.repeat_photos else f"u{update_id}"
+            message["photo"] = self.library.photo_sizes(index, unique_id)
+        elif kind == 'command':
+            command = self.rng.choice(self.COMMANDS)
+            message["text"] = command
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        else:
+            message["text"] = self.rng.choice(self.TEXTS)
+        return kind, chat_id, {"update_id": update_id, "message": message}
+
+
+def schedule(args):
+    """Offsets (seconds from start) at which updates are sent"""
+    times = []
+    if args.profile == 'constant':
+        times = [i / args.rate for i in range(int(args.rate * args.duration))]
+    elif args.profile == 'ramp':
+        t = 0.0
+        while t < args.duration:
+            times.append(t)
+            rate = args.rate + (args.peak_rate - args.rate) * t / args.duration
+            t += 1.0 / max(rate, 1e-3)
+    elif args.profile == 'burst':
+        t = 0.0
+        while t < args.duration:
+            times.extend([t] * args.burst_size)
+            t += args.burst_interval
+    return times
+
+
+async def run_load(target, factory, offsets, timeout):
+    """Post updates at the scheduled offsets; returns per-update records"""
+    records = []
+    limits = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        async def post(kind, chat_id, payload):
+            record = {"kind": kind, "chat_id": chat_id, "sent": time.perf_counter()}
+            try:
+                response = await client.post(f"{target}/webhook", json=payload)
+                record["status"] = response.status_code
+            except httpx.HTTPError as e:
+                record["status"] = type(e).__name__
+            record["webhook_latency"] = time.perf_counter() - record["sent"]
+            records.append(record)
+
+        tasks = []
+        start = time.perf_counter()
+        for offset in offsets:
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(*factory.make())))
+        await asyncio.gather(*tasks)
+        return records, time.perf_counter() - start
+
+
+def wait_for_replies(telegram, records, drain):
+    """Wait until every accepted update got its final reply (or ``drain`` seconds pass)"""
+    expected = {r["chat_id"]: r for r in records if r["status"] == 200}
+    deadline = time.perf_counter() + drain
+    while time.perf_counter() < deadline:
+        with telegram.lock:
+            done = all(_final_reply(r["kind"], telegram.replies.get(chat_id)) for chat_id, r in expected.items())
+        if done:
+            break
+        time.sleep(0.2)
+
+
+def _final_reply(kind, replies):
+    """The reply that completes an update (photos first get a 'Processing...' message)"""
+    if not replies:
+        return None
+    if kind == 'photo':
+        finals = [reply for reply in replies if not reply[1].startswith('🔄')]
+        return finals[-1] if finals else None
+    return replies[-1]
+
+
+def build_report(args, records, elapsed, telegram, gemini):
+    status_counts = Counter(str(r["status"]) for r in records)
+    accepted = [r for r in records if r["status"] == 200]
+    by_kind = defaultdict(list)
+    outcomes = defaultdict(Counter)
+    with telegram.lock:
+        for record in accepted:
+            final = _final_reply(record["kind"], telegram.replies.get(record["chat_id"]))
+            if final is None:
+                outcomes[record["kind"]]["timed_out"] += 1
+                continue
+            outcomes[record["kind"]]["error_reply" if final[1].startswith('❌') else "ok"] += 1
+            by_kind[record["kind"]].append(final[0] - record["sent"])
+
+    end_to_end = {}
+    for kind in sorted(set(by_kind) | set(outcomes)):
+        total = sum(outcomes[kind].values())
+        end_to_end[kind] = dict(outcomes[kind], total=total,
+                                error_rate=round((total - outcomes[kind]["ok"]) / total, 4) if total else 0.0,
+                                **percentiles(by_kind[kind]))
+    completed = sum(len(v) for v in by_kind.values())
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != 'output'},
+        "sent": len(records),
+        "duration_s": round(elapsed, 2),
+        "offered_rate": round(len(records) / elapsed, 2) if elapsed else 0.0,
+        "accepted_rate": round(len(accepted) / elapsed, 2) if elapsed else 0.0,
+        "webhook": {
+            "status_counts": dict(status_counts),
+            "error_rate": round(1 - len(accepted) / len(records), 4) if records else 0.0,
+            **percentiles([r["webhook_latency"] for r in records]),
+        },
+        "end_to_end": end_to_end,
+        "completed": completed,
+        "completed_rate": round(completed / elapsed, 2) if elapsed else 0.0,
+        "telegram_api_calls": dict(telegram.calls),
+        "gemini_calls": gemini.calls,
+    }
+
+
+def start_app(args, telegram, gemini):
+    """Launch app.py against the stand-ins and wait for /health"""
+    env = dict(os.environ,
+               TELEGRAM_BOT_TOKEN=BOT_TOKEN,
+               TELEGRAM_API_BASE_URL=telegram.url,
+               GEMINI_API_KEY='loadtest',
+               GEMINI_API_BASE_URL=gemini.url,
+               PORT=str(args.app_port),
+               FLASK_DEBUG='false')
+    log = open(args.app_log, 'w') if args.app_log else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, 'app.py'], env=env, stdout=log, stderr=subprocess.STDOUT)
+    target = f"http://127.0.0.1:{args.app_port}"
+    try:
+        wait_healthy(target, args.startup_timeout, process)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process, target
+
+
+def wait_healthy(target, timeout, process=None):
+    """Poll ``target``/health until it answers 200 (or ``process`` exits)"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"app.py exited with code {process.returncode} (see --app-log)")
+        try:
+            if httpx.get(f"{target}/health", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{target} did not become healthy in time")
+
+
+def warm_up(target, factory, telegram, timeout):
+    """Send one photo and one text update and wait for the replies (creates the bot, loads the model)"""
+    photo_factory = UpdateFactory(factory.library, {'photo': 1.0}, seed=-1)
+    photo_factory.update_ids = iter(range(900_000_000, 10 ** 9))
+    text_factory = UpdateFactory(factory.library, {'text': 1.0}, seed=-1)
+    text_factory.update_ids = iter(range(800_000_000, 900_000_000))
+    pending = [photo_factory.make(), text_factory.make()]
+    for _, _, payload in pending:
+        httpx.post(f"{target}/webhook", json=payload, timeout=timeout)
+    wait_for_replies(telegram, [{"kind": kind, "chat_id": chat_id, "status": 200} for kind, chat_id, _ in pending],
+                     timeout)
+    with telegram.lock:
+        for _, chat_id, _ in pending:
+            telegram.replies.pop(chat_id, None)
+        telegram.calls.clear()
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        kind, weight = item.split('=')
+        if kind not in ('photo', 'command', 'text'):
+            raise argparse.ArgumentTypeError(f"Unknown update type: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load-test the /webhook endpoint with synthetic Telegram updates")
+    parser.add_argument('--profile', choices=['constant', 'ramp', 'burst'], default='constant')
+    parser.add_argument('--rate', type=float, default=10, help="Updates/sec (start rate for ramp)")
+    parser.add_argument('--peak-rate', type=float, default=100, help="Final rate for the ramp profile")
+    parser.add_argument('--burst-size', type=int, default=100)
+    parser.add_argument('--burst-interval', type=float, default=10)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('photo=0.7,command=0.15,text=0.15'))
+    parser.add_argument('--repeat-photos', type=float, default=0.0,
+                        help="Fraction of photos re-sent with a known file_unique_id (cache hits)")
+    parser.add_argument('--telegram-latency', type=float, default=0.03, help="Bot API stand-in latency (s)")
+    parser.add_argument('--gemini-latency', type=float, default=1.0, help="Gemini stand-in latency (s)")
+    parser.add_argument('--target', default=None, help="Use an already running app instead of starting app.py")
+    parser.add_argument('--telegram-port', type=int, default=0,
+                        help="Port for the Bot API stand-in (default: any free port; required with --target)")
+    parser.add_argument('--gemini-port', type=int, default=0,
+                        help="Port for the Gemini stand-in (default: any free port; required with --target)")
+    parser.add_argument('--app-port', type=int, default=5055)
+    parser.add_argument('--app-log', default=None, help="Write the spawned app's output to this file")
+    parser.add_argument('--startup-timeout', type=float, default=120)
+    parser.add_argument('--request-timeout', type=float, default=30)
+    parser.add_argument('--drain', type=float, default=60, help="Seconds to wait for outstanding replies")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="Also write the report JSON to this file")
+    args = parser.parse_args()
+    if args.target and not (args.telegram_port and args.gemini_port):
+        # The running app was configured with the stand-in URLs up front, so their ports must be fixed
+        parser.error("--target requires --telegram-port and --gemini-port")
+    return args
+
+
+def main():
+    args = parse_args()
+    library = PhotoLibrary()
+    telegram = TelegramStandIn(library, args.telegram_latency, args.telegram_port)
+    gemini = GeminiStandIn(args.gemini_latency, args.gemini_port)
+    factory = UpdateFactory(library, args.mix, args.repeat_photos, args.seed)
+
+    process = None
+    if args.target:
+        target = args.target.rstrip('/')
+        print(f"Using running app at {target}; it must use TELEGRAM_BOT_TOKEN={BOT_TOKEN}, "
+              f"TELEGRAM_API_BASE_URL={telegram.url} and GEMINI_API_BASE_URL={gemini.url}", file=sys.stderr)
+        # The app calls the Bot API on startup, so it may only be started once the stand-ins are up
+        wait_healthy(target, args.startup_timeout)
+    else:
+        process, target = start_app(args, telegram, gemini)
+    try:
+        warm_up(target, factory, telegram, args.startup_timeout)
+        offsets = schedule(args)
+        print(f"Sending {len(offsets)} updates ({args.profile} profile) to {target}/webhook", file=sys.stderr)
+        records, elapsed = asyncio.run(run_load(target, factory, offsets, args.request_timeout))
+        wait_for_replies(telegram, records, args.drain)
+        report = build_report(args, records, elapsed, telegram, gemini)
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        telegram.server.close()
+        gemini.server.close()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,67 @@
-import streamlit as st
-import cv2
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras import layers, models
+import streamlit as st
+from cache import LRUCache
+from model_manager import ModelManager
+from preprocessing import prepare, BatchBuffer
+
+# Uploads shown as thumbnails below the results table
+MAX_PREVIEWS = int(os.getenv('STREAMLIT_MAX_PREVIEWS', 24))
 
-# Constants
-img_height = 64
-img_width = 64  # You can adjust these values based on your image size
+# Load the model once per server process, not on every script rerun
+# (MODEL_BACKEND=numpy serves without TensorFlow, tflite serves the quantized model)
+@st.cache_resource
+def get_model_manager():
+    manager = ModelManager()
+    manager.load_initial()
+    manager.start_watching()
+    return manager
 
-# Define the model architecture
-def create_candlestick_model():
-    model = models.Sequential()
-    model.add(layers.Conv2D(32, (3, 3), activation='relu', input_shape=(img_height, img_width, 3)))
-    model.add(layers.MaxPooling2D((2, 2)))
-    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
-    model.add(layers.MaxPooling2D((2, 2)))
-    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
-    model.add(layers.Flatten())
-    model.add(layers.Dense(64, activation='relu'))
-    model.add(layers.Dense(1, activation='sigmoid'))
-    return model
+# Scores keyed by (upload content hash, model version), shared by every session
+@st.cache_resource
+def get_score_cache():
+    return LRUCache(max_entries=int(os.getenv('PREDICTION_CACHE_SIZE', 2048)), ttl=None)
 
-# Load pre-trained model weights
-model = create_candlestick_model()
-model.load_weights('candlestick_model_weights.h5')
+# Score uploads in one batched forward pass; already seen uploads are not decoded again
+def score_uploads(uploads, manager, cache):
+    """``uploads`` is a list of (name, bytes); returns one result row per upload"""
+    version = manager.current.version
+    keys = [(hashlib.sha256(data).hexdigest(), version) for _, data in uploads]
+    scores = {key: cache.get(key) for key in keys}
+    cached = {key for key, score in scores.items() if score is not None}
 
-# Function to predict candlestick direction
-def predict_candlestick_direction(img):
-    img = cv2.resize(img, (img_height, img_width))
-    img = img / 255.0  # Normalize pixel values to [0, 1]
-    img = np.expand_dims(img, axis=0)  # Add batch dimension
-    prediction = model.predict(img)
-    return prediction[0][0]
+    pending = {}  # key -> bytes, so duplicate uploads are scored once
+    for key, (_, data) in zip(keys, uploads):
+        if scores[key] is None:
+            pending.setdefault(key, data)
+    if pending:
+        pending_keys = list(pending)
+        buffer = BatchBuffer(len(pending_keys))
+        # Decode straight into the batch buffer; cv2 releases the GIL so this runs in parallel
+        with ThreadPoolExecutor() as pool:
+            prepared = list(pool.map(lambda i: prepare(pending[pending_keys[i]], out=buffer.array[i]),
+                                     range(len(pending_keys))))
+        ok = np.array([image is not None for image in prepared])
+        if ok.any():
+            batch_scores = manager.predict(buffer.array[ok])[:, 0]
+            for key, score in zip((key for key, good in zip(pending_keys, ok) if good), batch_scores):
+                scores[key] = float(score)
+                cache.put(key, float(score))
+
+    rows = []
+    for key, (name, _) in zip(keys, uploads):
+        score = scores[key]
+        rows.append({
+            "file": name,
+            "trend": None if score is None else ("UP" if score > 0.5 else "DOWN"),
+            "score": None if score is None else round(score, 4),
+            "confidence": None if score is None else round(abs(score - 0.5) * 2, 4),
+            "cached": key in cached,
+            "error": "Could not decode image" if score is None else None,
+        })
+    return rows
 
 # Function to analyze stock trend based on prediction
 def analyze_stock_trend(prediction):
@@ -47,18 +77,34 @@ def main():
     choice = st.sidebar.selectbox("Choose an option", ["Upload Image", "Exit"])
 
     if choice == "Upload Image":
-        st.subheader("Upload Image")
-        uploaded_file = st.file_uploader("Choose an image", type=["jpg", "jpeg", "png"])
+        st.subheader("Upload Images")
+        uploaded_files = st.file_uploader("Choose one or more images", type=["jpg", "jpeg", "png"],
+                                          accept_multiple_files=True)
+
+        if uploaded_files:
+            uploads = [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+            rows = score_uploads(uploads, get_model_manager(), get_score_cache())
+
+            if len(rows) == 1:
+                st.image(uploads[0][1], caption="Uploaded Image", use_column_width=True)
+                st.subheader("Analysis Result:")
+                if rows[0]["error"]:
+                    st.error(rows[0]["error"])
+                else:
+                    st.write(analyze_stock_trend(rows[0]["score"]))
+            else:
+                up = sum(row["trend"] == "UP" for row in rows)
+                down = sum(row["trend"] == "DOWN" for row in rows)
+                failed = len(rows) - up - down
+                st.subheader(f"Analysis Results ({len(rows)} images)")
+                st.write(f"{up} predicted up, {down} predicted down" + (f", {failed} unreadable" if failed else ""))
+                st.dataframe(rows, use_container_width=True)
 
-        if uploaded_file is not None:
-            image = cv2.imdecode(np.fromstring(uploaded_file.read(), np.uint8), cv2.IMREAD_COLOR)
-            st.image(image, caption="Uploaded Image", use_column_width=True)
-            
-            prediction = predict_candlestick_direction(image)
-            trend_analysis = analyze_stock_trend(prediction)
-            
-            st.subheader("Analysis Result:")
-            st.write(trend_analysis)
+                with st.expander("Show images"):
+                    shown = uploads[:MAX_PREVIEWS]
+                    st.image([data for _, data in shown], caption=[name for name, _ in shown], width=160)
+                    if len(uploads) > MAX_PREVIEWS:
+                        st.caption(f"First {MAX_PREVIEWS} of {len(uploads)} images shown")
 
     elif choice == "Exit":
         st.write("Thank you for using the Stock Trend Analysis Chatbot!")
@@ -0,0 +1,208 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from sub-millisecond preprocessing up to slow Gemini calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in items]
+
+    def snapshot(self):
+        with self._lock:
+            return {'/'.join(labels) or 'total': value for labels, value in sorted(self._values.items())}
+
+
+class Histogram:
+    """Fixed-bucket histogram (cumulative on export), optionally split by label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        lines = []
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+    def snapshot(self):
+        """Count, mean and approximate p50/p95 (bucket upper bounds) per label set"""
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        summary = {}
+        for labels, series in items:
+            counts, total = series[:-1], series[-1]
+            count = sum(counts)
+            summary['/'.join(labels) or 'total'] = {
+                "count": count,
+                "mean_ms": round(total / count * 1000, 2) if count else 0.0,
+                "p50_ms": self._quantile(counts, count, 0.5),
+                "p95_ms": self._quantile(counts, count, 0.95),
+            }
+        return summary
+
+    def _quantile(self, counts, count, q):
+        running = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            running += bucket_count
+            if count and running >= q * count:
+                return bound * 1000
+        return 0.0
+
+
+class Gauge:
+    """Value read from a callback at export time (e.g. a queue depth)"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, fn=None):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def value(self):
+        try:
+            return self.fn() if self.fn else 0
+        except Exception:
+            return 0
+
+    def render(self):
+        return [f"{self.name} {self.value()}"]
+
+    def snapshot(self):
+        return self.value()
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name, help_text, fn=None):
+        gauge = self._register(Gauge(name, help_text))
+        if fn is not None:
+            gauge.set_function(fn)
+        return gauge
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in list(self._metrics.values())}
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'bot_stage_seconds', 'Time spent in each photo handling stage', labelnames=('stage',))
+ERRORS = REGISTRY.counter('bot_errors_total', 'Errors by stage', labelnames=('stage',))
+CACHE_LOOKUPS = REGISTRY.counter(
+    'bot_cache_lookups_total', 'Prediction cache lookups', labelnames=('cache', 'result'))
+GEMINI_FALLBACKS = REGISTRY.counter(
+    'gemini_fallbacks_total', 'Replies that fell back to basic analysis', labelnames=('reason',))
+
+
+def stage(name):
+    """Context manager timing one stage into ``bot_stage_seconds``"""
+    return STAGE_SECONDS.time(name)
+
+
+def start_log_dumper(interval=None, registry=REGISTRY):
+    """Log a metrics snapshot every ``interval`` seconds (``METRICS_LOG_INTERVAL``; 0 disables)"""
+    interval = interval if interval is not None else float(os.getenv('METRICS_LOG_INTERVAL', 60))
+    if interval <= 0:
+        return None
+
+    def _loop():
+        while True:
+            time.sleep(interval)
+            logger.info(f"Metrics: {registry.snapshot()}")
+
+    thread = threading.Thread(target=_loop, name="metrics-log", daemon=True)
+    thread.start()
+    return thread
@@ -1,65 +1,142 @@
 import os
-import cv2
+import argparse
+import itertools
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers, models
 from sklearn.model_selection import train_test_split
+from numpy_model import write_h5_weights
+from preprocessing import load_uint8
+from dataset_cache import list_images, update_cache, ShardedDataset
+from quantize import convert
 
 # Define image dimensions
 img_height = 64
 img_width = 64
 
-# Define the model architecture
-def create_candlestick_model():
+AUTOTUNE = tf.data.AUTOTUNE
+
+# Define the model architecture (the defaults are the architecture served by bot.py)
+def create_candlestick_model(filters=(32, 64, 64), dense_units=64):
     model = models.Sequential()
-    model.add(layers.Conv2D(32, (3, 3), activation='relu', input_shape=(img_height, img_width, 3)))
+    model.add(layers.Conv2D(filters[0], (3, 3), activation='relu', input_shape=(img_height, img_width, 3)))
     model.add(layers.MaxPooling2D((2, 2)))
-    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
+    model.add(layers.Conv2D(filters[1], (3, 3), activation='relu'))
     model.add(layers.MaxPooling2D((2, 2)))
-    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
+    model.add(layers.Conv2D(filters[2], (3, 3), activation='relu'))
     model.add(layers.Flatten())
-    model.add(layers.Dense(64, activation='relu'))
+    model.add(layers.Dense(dense_units, activation='relu'))
     model.add(layers.Dense(1, activation='sigmoid'))
     return model
 
-# Load and preprocess images and labels
-def load_data(base_dir):
-    images = []
-    labels = []
-    for label, folder in enumerate(['down', 'up']):
-        folder_path = os.path.join(base_dir, folder)
-        for filename in os.listdir(folder_path):
-            if filename.endswith('.png'):
-                img_path = os.path.join(folder_path, filename)
-                img = cv2.imread(img_path)
-                if img is None:
-                    print(f"Failed to read image: {img_path}")
-                    continue
-                img = cv2.resize(img, (img_height, img_width))
-                img = img / 255.0
-                images.append(img)
-                labels.append(label)
-    return np.array(images), np.array(labels).reshape(-1, 1)
-
-# Load all data
-base_directory = './img_candel_stick/Train'
-all_images, all_labels = load_data(base_directory)
-
-# Split the data into training and validation sets
-train_images, val_images, train_labels, val_labels = train_test_split(
-    all_images, all_labels, test_size=0.2, random_state=5
-)
-
-# Create and compile the model
-model = create_candlestick_model()
-model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
-
-# Train the model
-model.fit(train_images, train_labels, epochs=10, validation_data=(val_images, val_labels))
-
-# Evaluate the model on the validation set
-loss, accuracy = model.evaluate(val_images, val_labels)
-print(f"Validation Loss: {loss}, Validation Accuracy: {accuracy}")
-
-# Save the trained model weights
-model.save_weights('candlestick_model_weights.h5')
+# Decode and resize one image to uint8 BGR with the exact preprocessing used at serving time.
+# Unreadable files are reported and flagged, so build_dataset can skip them like the original loader did
+def _load_uint8(path):
+    img = load_uint8(path.decode('utf-8'))
+    if img is None:
+        print(f"Failed to read image: {path.decode('utf-8')}")
+        return np.zeros((img_height, img_width, 3), np.uint8), False
+    return img, True
+
+def decode_and_resize(path):
+    img, ok = tf.numpy_function(_load_uint8, [path], (tf.uint8, tf.bool))
+    img.set_shape((img_height, img_width, 3))
+    ok.set_shape(())
+    return img, ok
+
+# Build a streaming input pipeline: parallel decode, optional cache, shuffle, batch, prefetch
+def build_dataset(paths, labels, batch_size=32, shuffle=False, cache=None, seed=None):
+    ds = tf.data.Dataset.from_tensor_slices((paths, tf.reshape(tf.cast(labels, tf.float32), (-1, 1))))
+    ds = ds.map(lambda path, label: (*decode_and_resize(path), label), num_parallel_calls=AUTOTUNE)
+    ds = ds.filter(lambda img, ok, label: ok)  # skip unreadable images instead of aborting the run
+    ds = ds.map(lambda img, ok, label: (img, label))
+    if cache is not None:
+        # uint8 keeps the cache 8x smaller than float64; '' caches in memory, a path caches on disk
+        ds = ds.cache(cache)
+    if shuffle:
+        ds = ds.shuffle(buffer_size=min(len(paths), 10000), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+    ds = ds.map(lambda img, label: (tf.cast(img, tf.float32) * (1.0 / 255.0), label), num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
+
+# Stream batches from the memory-mapped shard cache (only the rows of each batch are read)
+def build_shard_dataset(dataset, indices, batch_size=32, shuffle=False, seed=0):
+    seeds = itertools.count(seed)  # new shuffle order every epoch
+    signature = (
+        tf.TensorSpec(shape=(None, img_height, img_width, 3), dtype=tf.float32),
+        tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+    )
+    ds = tf.data.Dataset.from_generator(
+        lambda: dataset.batches(indices, batch_size, shuffle=shuffle, seed=next(seeds)),
+        output_signature=signature,
+    )
+    return ds.prefetch(AUTOTUNE)
+
+# Save weights in the legacy Keras HDF5 layout that bot.py / numpy_model.py load
+def save_weights(model, path):
+    layer_weights = [(layer.name, [(f"{layer.name}/{w.name}", w.numpy()) for w in layer.weights])
+                     for layer in model.layers]
+    write_h5_weights(path, layer_weights)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the candlestick CNN")
+    parser.add_argument('--data-dir', default='./img_candel_stick/Train')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--cache', default=None,
+                        help="Cache decoded images: 'memory' or a file path prefix (default: no cache)")
+    parser.add_argument('--shard-cache', default=None,
+                        help="Preprocess into memory-mapped shards in this directory (only new/changed "
+                             "images are decoded) and train from them")
+    parser.add_argument('--output', default='candlestick_model_weights.h5')
+    parser.add_argument('--quantize', nargs='+', default=[], choices=['int8', 'float16', 'dynamic'],
+                        help="Also write quantized .tflite variants (int8 is calibrated on --data-dir)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    if args.shard_cache:
+        # Bring the shard cache up to date, then read tensors from it zero-copy
+        update_cache(args.data_dir, args.shard_cache)
+        dataset = ShardedDataset(args.shard_cache)
+        train_idx, val_idx = train_test_split(
+            np.arange(len(dataset)), test_size=0.2, random_state=5
+        )
+        train_ds = build_shard_dataset(dataset, train_idx, args.batch_size, shuffle=True, seed=5)
+        val_ds = build_shard_dataset(dataset, val_idx, args.batch_size)
+    else:
+        cache = '' if args.cache == 'memory' else args.cache
+
+        # List all data (pixels are only read while streaming)
+        all_paths, all_labels = list_images(args.data_dir)
+
+        # Split the data into training and validation sets
+        train_paths, val_paths, train_labels, val_labels = train_test_split(
+            all_paths, all_labels, test_size=0.2, random_state=5
+        )
+        train_ds = build_dataset(train_paths, train_labels, args.batch_size, shuffle=True, cache=cache, seed=5)
+        val_cache = f"{cache}_val" if cache else cache
+        val_ds = build_dataset(val_paths, val_labels, args.batch_size, cache=val_cache)
+
+    # Create and compile the model
+    model = create_candlestick_model()
+    model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
+
+    # Train the model
+    model.fit(train_ds, epochs=args.epochs, validation_data=val_ds)
+
+    # Evaluate the model on the validation set
+    loss, accuracy = model.evaluate(val_ds)
+    print(f"Validation Loss: {loss}, Validation Accuracy: {accuracy}")
+
+    # Save the trained model weights
+    save_weights(model, args.output)
+
+    # Post-training quantized variants for MODEL_BACKEND=tflite (compare them with quantize.py compare)
+    for mode in args.quantize:
+        output = f"{os.path.splitext(args.output)[0]}_{mode}.tflite"
+        convert(args.output, output, mode, data_dir=args.data_dir)
+
+if __name__ == "__main__":
+    main()
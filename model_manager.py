@@ -0,0 +1,326 @@
+"""Hot-reloadable model weights for the serving processes.
+
+``ModelManager`` watches the weights file (``MODEL_WEIGHTS_PATH``) or a whole
+directory of weights files (``MODEL_WEIGHTS_DIR``, newest file wins). When a
+new file appears it is copied into ``MODEL_VERSIONS_DIR`` under a
+content-addressed name, then loaded and warmed up in a background thread
+while the current model keeps serving. Once it is ready, the new engine
+replaces the old one in a single assignment. Batches already running finish
+on the old model, and the next batch uses the new one.
+
+The last ``MODEL_HISTORY`` versions stay in memory, so ``rollback`` is
+instant. With an inference worker pool, the workers are reloaded one at a
+time instead.
+
+Several processes (the bot, the Streamlit app, webhook workers) can share
+``MODEL_VERSIONS_DIR``. Each one keeps its snapshots in a subdirectory of
+its own and holds a lock on a file inside it for as long as it runs. A
+process only prunes its own snapshots, and removes other subdirectories
+only once their lock is free, i.e. their process has exited.
+"""
+import os
+import re
+import glob
+import time
+import shutil
+import hashlib
+import tempfile
+import logging
+import threading
+from collections import namedtuple
+from metrics import REGISTRY, ERRORS
+
+logger = logging.getLogger(__name__)
+
+WEIGHT_SUFFIXES = {'keras': ('.h5',), 'numpy': ('.npz', '.h5'), 'tflite': ('.tflite',)}
+
+# Snapshot file names written by _snapshot: {stem}-{first 12 hex digits of the SHA-256}{suffix}
+SNAPSHOT_NAME = re.compile(r'.+-[0-9a-f]{12}\.(h5|npz|tflite)')
+
+# One loaded set of weights: engine is None when the model lives in worker processes
+ModelVersion = namedtuple('ModelVersion', ['version', 'path', 'source', 'loaded_at', 'load_seconds', 'engine'])
+
+RELOADS = REGISTRY.counter('model_reloads_total', 'Model weight reloads and rollbacks', labelnames=('result',))
+
+
+def _try_lock(f):
+    """Take a non-blocking exclusive lock on an open file; False if another process holds it"""
+    try:
+        if os.name == 'nt':
+            import msvcrt
+
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelManager:
+    """Serves the active model version and swaps in new weights without a restart"""
+
+    def __init__(self, backend=None, weights_path=None, weights_dir=None, worker_pool=None,
+                 poll_interval=None, history=None, versions_dir=None):
+        from numpy_model import DEFAULT_NPZ_PATH
+        from inference import DEFAULT_WEIGHTS_PATH, DEFAULT_TFLITE_PATH
+
+        self.backend = (backend or os.getenv('MODEL_BACKEND', 'keras')).lower()
+        if self.backend not in WEIGHT_SUFFIXES:
+            raise ValueError(f"Unknown MODEL_BACKEND: {self.backend}")
+        self.weights_dir = weights_dir or os.getenv('MODEL_WEIGHTS_DIR')
+        self.weights_path = weights_path or os.getenv('MODEL_WEIGHTS_PATH')
+        if not self.weights_path:
+            if self.backend == 'tflite':
+                self.weights_path = DEFAULT_TFLITE_PATH
+            elif self.backend == 'numpy' and os.path.exists(DEFAULT_NPZ_PATH):
+                self.weights_path = DEFAULT_NPZ_PATH
+            else:
+                self.weights_path = DEFAULT_WEIGHTS_PATH
+        self.worker_pool = worker_pool
+        if poll_interval is None:
+            poll_interval = float(os.getenv('MODEL_RELOAD_INTERVAL', 10))
+        self.poll_interval = poll_interval
+        self.history_size = history or int(os.getenv('MODEL_HISTORY', 3))
+        self.versions_dir = versions_dir or os.getenv('MODEL_VERSIONS_DIR', '.model_versions')
+        self._own_dir = None  # this process's subdirectory of versions_dir, created on the first snapshot
+        self._own_lock = None
+
+        self._active = None
+        self._history = []  # older versions, most recent last
+        self._lock = threading.Lock()  # serialises reloads and rollbacks, never taken by predict
+        self._seen = None  # (path, mtime, size) of the newest source file already handled
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+        self._watcher = None
+        self._stopped = threading.Event()
+
+        REGISTRY.gauge('model_loaded_timestamp_seconds', 'When the active model version was loaded',
+                       lambda: self._active.loaded_at if self._active else 0)
+
+    @property
+    def current(self):
+        return self._active
+
+    @property
+    def ready(self):
+        """True once a model version is active (and, with workers, every worker is warmed up)"""
+        if self.worker_pool is not None:
+            return self._active is not None and self.worker_pool.ready
+        return self._active is not None and self._active.engine.ready
+
+    def predict(self, batch, verbose=0):
+        """Score a batch with whichever version is active when the call starts"""
+        return self._active.engine.predict(batch)
+
+    def _candidate(self):
+        """Newest weights file being watched, as (path, mtime, size), or None"""
+        if self.weights_dir:
+            paths = [path for suffix in WEIGHT_SUFFIXES[self.backend]
+                     for path in glob.glob(os.path.join(self.weights_dir, f'*{suffix}'))]
+        else:
+            paths = [self.weights_path]
+        candidates = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            candidates.append((stat.st_mtime, path, stat.st_size))
+        if not candidates:
+            return None
+        mtime, path, size = max(candidates)
+        return path, mtime, size
+
+    def _snapshot(self, source):
+        """Copy a weights file to an immutable, content-addressed path; returns (version, path)"""
+        digest = file_digest(source)
+        stem, suffix = os.path.splitext(os.path.basename(source))
+        version = f"{stem}@{digest[:12]}"
+        path = os.path.join(self._snapshot_dir(), f"{stem}-{digest[:12]}{suffix}")
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, path)
+        return version, path
+
+    def _load(self, version, path, source):
+        """Load and warm up one version (in this process or in every worker)"""
+        started = time.perf_counter()
+        engine = None
+        if self.worker_pool is not None:
+            if self.worker_pool.weights_path != path:
+                self.worker_pool.reload(path)
+        else:
+            from inference import load_model
+
+            engine = load_model(self.backend, path)
+            engine.warmup()
+        return ModelVersion(version, path, source, time.time(), time.perf_counter() - started, engine)
+
+    def _activate(self, new_version):
+        """Make ``new_version`` the active one and keep the previous one for rollback"""
+        previous, self._active = self._active, new_version
+        if previous is not None:
+            self._history.append(previous)
+            del self._history[:-self.history_size]
+        self._prune_snapshots()
+
+    def _snapshot_dir(self):
+        """This process's snapshot directory, locked while it lives; abandoned ones are removed on the way"""
+        if self._own_dir is None:
+            os.makedirs(self.versions_dir, exist_ok=True)
+            for path in glob.glob(os.path.join(self.versions_dir, 'proc-*')):
+                self._remove_if_abandoned(path)
+            own_dir = tempfile.mkdtemp(prefix='proc-', dir=self.versions_dir)
+            self._own_lock = open(os.path.join(own_dir, '.lock'), 'a+')
+            _try_lock(self._own_lock)
+            self._own_dir = own_dir
+        return self._own_dir
+
+    @staticmethod
+    def _remove_if_abandoned(path):
+        lock_path = os.path.join(path, '.lock')
+        try:
+            # A young lock file may not be locked yet: its process is still setting the directory up
+            if os.path.getmtime(lock_path) > time.time() - 60:
+                return
+            lock = open(lock_path, 'rb')
+        except OSError:
+            return
+        with lock:
+            abandoned = _try_lock(lock)
+        if abandoned:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _prune_snapshots(self):
+        """Delete this process's snapshots that are no longer active or in the history"""
+        if self._own_dir is None:
+            return
+        keep = {version.path for version in self._history + [self._active]}
+        for path in glob.glob(os.path.join(self._own_dir, '*')):
+            if path not in keep and SNAPSHOT_NAME.fullmatch(os.path.basename(path)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def initial_path(self):
+        """Versioned copy of the newest watched weights, e.g. for starting worker processes on it"""
+        candidate = self._candidate()
+        if candidate is None:
+            raise FileNotFoundError(f"No model weights found in {self.weights_dir or self.weights_path}")
+        return self._snapshot(candidate[0])[1]
+
+    def load_initial(self):
+        """Load the newest watched weights synchronously (startup)"""
+        candidate = self._candidate()
+        if candidate is None:
+            raise FileNotFoundError(f"No model weights found in {self.weights_dir or self.weights_path}")
+        with self._lock:
+            version, path = self._snapshot(candidate[0])
+            self._activate(self._load(version, path, candidate[0]))
+            self._seen = candidate
+        logger.info(f"Model version {version} active ({self._active.load_seconds:.2f}s to load)")
+        return self._active
+
+    def reload(self, source=None):
+        """Load ``source`` (default: newest watched file) and swap it in; returns the new version or None"""
+        with self._lock:
+            candidate = self._candidate()
+            source = source or (candidate[0] if candidate else None)
+            if source is None:
+                return None
+            try:
+                version, path = self._snapshot(source)
+                if self._active is not None and version == self._active.version:
+                    self._seen = candidate
+                    return None
+                logger.info(f"Loading model version {version} in the background")
+                new_version = self._load(version, path, source)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f"{os.path.basename(source)}: {e}"
+                self._seen = candidate  # do not retry the same broken file every poll
+                self._prune_snapshots()
+                RELOADS.inc('failed')
+                ERRORS.inc('model_reload')
+                current = self._active.version if self._active else None
+                logger.error(f"Model reload from {source} failed, keeping {current}: {e}")
+                return None
+            previous = self._active
+            self._activate(new_version)
+            self._seen = candidate
+            self.reloads += 1
+            self.last_error = None
+        RELOADS.inc('reloaded')
+        logger.info(f"Model version {new_version.version} active (was {previous.version if previous else None}, "
+                    f"{new_version.load_seconds:.2f}s to load)")
+        return new_version
+
+    def rollback(self):
+        """Switch back to the previous version; returns it, or None if there is none"""
+        with self._lock:
+            if not self._history:
+                return None
+            target = self._history.pop()
+            if self.worker_pool is not None:
+                try:
+                    self.worker_pool.reload(target.path)
+                except Exception:
+                    self._history.append(target)
+                    raise
+            rolled_back = self._active
+            self._active = target._replace(loaded_at=time.time())
+            self._prune_snapshots()
+        RELOADS.inc('rolled_back')
+        logger.warning(f"Rolled back model from {rolled_back.version} to {target.version}")
+        return self._active
+
+    def _watch_loop(self):
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                candidate = self._candidate()
+                if candidate is not None and candidate != self._seen:
+                    self.reload(candidate[0])
+            except Exception as e:
+                logger.error(f"Model watcher error: {e}")
+
+    def start_watching(self):
+        """Poll the weights file/directory every ``poll_interval`` seconds (0 disables)"""
+        if self.poll_interval <= 0 or self._watcher is not None:
+            return None
+        self._watcher = threading.Thread(target=self._watch_loop, name="model-watcher", daemon=True)
+        self._watcher.start()
+        logger.info(f"Watching {self.weights_dir or self.weights_path} for new model weights "
+                    f"every {self.poll_interval:g}s")
+        return self._watcher
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        active = self._active
+        return {
+            "version": active.version if active else None,
+            "source": active.source if active else None,
+            "loaded_at": active.loaded_at if active else None,
+            "load_seconds": round(active.load_seconds, 3) if active else None,
+            "previous": [version.version for version in reversed(self._history)],
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "watching": self.weights_dir or self.weights_path,
+        }
@@ -0,0 +1,254 @@
+"""Pure-NumPy inference for the candlestick CNN.
+
+Serving processes can load ``candlestick_model_weights.npz`` (or read the
+Keras ``.h5`` weights directly through h5py) and run the forward pass without
+importing TensorFlow.
+
+Usage:
+    python numpy_model.py export [weights.h5] [weights.npz]
+    python numpy_model.py check [weights.h5]    # parity + benchmark against Keras
+"""
+import os
+import re
+import sys
+import time
+import logging
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_H5_PATH = 'candlestick_model_weights.h5'
+DEFAULT_NPZ_PATH = 'candlestick_model_weights.npz'
+
+# Layer layout of create_candlestick_model: conv, pool, conv, pool, conv, flatten, dense, dense
+ARCHITECTURE = ['conv', 'pool', 'conv', 'pool', 'conv', 'flatten', 'dense', 'dense']
+
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+
+def read_h5_weights(path=DEFAULT_H5_PATH):
+    """Read (kernel, bias) pairs in layer order from a Keras weights file"""
+    import h5py
+
+    params = []
+    with h5py.File(path, 'r') as f:
+        if 'layer_names' in f.attrs:
+            # Keras 2 / tf.keras legacy layout
+            for layer_name in f.attrs['layer_names']:
+                layer_name = layer_name.decode() if isinstance(layer_name, bytes) else layer_name
+                group = f[layer_name]
+                weight_names = [n.decode() if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+                if weight_names:
+                    params.append(tuple(np.asarray(group[n], dtype=np.float32) for n in weight_names))
+        else:
+            # Keras 3 layout: layers/<name>/vars/<index>
+            for layer_name in sorted(f['layers'], key=_natural_key):
+                variables = f['layers'][layer_name]['vars']
+                if len(variables):
+                    params.append(tuple(np.asarray(variables[k], dtype=np.float32)
+                                        for k in sorted(variables, key=int)))
+    return params
+
+
+def write_h5_weights(path, layer_weights):
+    """Write weights in the legacy Keras HDF5 layout read by ``load_weights`` and ``read_h5_weights``.
+
+    ``layer_weights`` is a list of ``(layer_name, [(weight_name, array), ...])``
+    in model order. The file is written next to ``path`` and renamed into place,
+    so readers never observe a half-written file.
+    """
+    import h5py
+
+    tmp_path = f"{path}.tmp"
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _ in layer_weights]
+        f.attrs['backend'] = b'tensorflow'
+        f.attrs['keras_version'] = b'2.15.0'
+        for layer_name, weights in layer_weights:
+            group = f.create_group(layer_name)
+            group.attrs['weight_names'] = [weight_name.encode('utf8') for weight_name, _ in weights]
+            for weight_name, value in weights:
+                group.create_dataset(weight_name, data=value)
+    os.replace(tmp_path, path)
+    return path
+
+
+def export_weights(h5_path=DEFAULT_H5_PATH, npz_path=DEFAULT_NPZ_PATH):
+    """Convert Keras weights into a compact float32 .npz file"""
+    params = read_h5_weights(h5_path)
+    arrays = {}
+    for i, (kernel, bias) in enumerate(params):
+        arrays[f'layer{i}_kernel'] = kernel
+        arrays[f'layer{i}_bias'] = bias
+    np.savez(npz_path, **arrays)
+    logger.info(f"Exported {len(params)} layers from {h5_path} to {npz_path}")
+    return npz_path
+
+
+def conv2d_relu(x, kernel, bias):
+    """3x3 'valid' convolution + ReLU via im2col and a single BLAS matmul"""
+    kh, kw, _, _ = kernel.shape
+    # (N, H', W', C, kh, kw) view without copying
+    patches = sliding_window_view(x, (kh, kw), axis=(1, 2))
+    out = np.tensordot(patches, kernel, axes=([3, 4, 5], [2, 0, 1]))
+    out += bias
+    return np.maximum(out, 0, out=out)
+
+
+def max_pool2d(x, size=2):
+    """Non-overlapping max pooling (floors odd dimensions like Keras)"""
+    n, h, w, c = x.shape
+    h, w = h // size, w // size
+    x = x[:, :h * size, :w * size, :]
+    return x.reshape(n, h, size, w, size, c).max(axis=(2, 4))
+
+
+class NumpyCandlestickModel:
+    """Drop-in replacement for the Keras model's ``predict`` on (N, 64, 64, 3) inputs"""
+
+    def __init__(self, params):
+        self.params = [(np.ascontiguousarray(k, dtype=np.float32), np.asarray(b, dtype=np.float32))
+                       for k, b in params]
+
+    @classmethod
+    def load(cls, path=None):
+        """Load from an exported .npz, falling back to the Keras .h5 weights"""
+        if path is None:
+            path = DEFAULT_NPZ_PATH if os.path.exists(DEFAULT_NPZ_PATH) else DEFAULT_H5_PATH
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                count = len(data.files) // 2
+                params = [(data[f'layer{i}_kernel'], data[f'layer{i}_bias']) for i in range(count)]
+        else:
+            params = read_h5_weights(path)
+        logger.info(f"NumPy model loaded from {path}")
+        return cls(params)
+
+    def predict(self, x, verbose=0, **kwargs):
+        """Return sigmoid scores of shape (N, 1)"""
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim == 3:
+            x = x[np.newaxis]
+        weights = iter(self.params)
+        dense_layers = sum(1 for layer in ARCHITECTURE if layer == 'dense')
+        for layer in ARCHITECTURE:
+            if layer == 'conv':
+                x = conv2d_relu(x, *next(weights))
+            elif layer == 'pool':
+                x = max_pool2d(x)
+            elif layer == 'flatten':
+                x = x.reshape(x.shape[0], -1)
+            else:
+                kernel, bias = next(weights)
+                x = x @ kernel + bias
+                dense_layers -= 1
+                if dense_layers:
+                    np.maximum(x, 0, out=x)
+        return 1.0 / (1.0 + np.exp(-x))
+
+    __call__ = predict
+
+
+def stacked_conv2d_relu(x, kernels, biases):
+    """3x3 conv2d_relu for M models at once: x is (1 or M, N, H, W, C), kernels (M, 3*3*C, O)"""
+    kh = kw = 3
+    patches = sliding_window_view(x, (kh, kw), axis=(2, 3))  # (m, N, H', W', C, kh, kw)
+    m, n, h, w = patches.shape[:4]
+    patches = patches.transpose(0, 1, 2, 3, 5, 6, 4).reshape(m, n * h * w, -1)
+    out = np.matmul(patches, kernels)  # a size-1 leading axis broadcasts over the members
+    out += biases[:, np.newaxis, :]
+    np.maximum(out, 0, out=out)
+    return out.reshape(len(kernels), n, h, w, -1)
+
+
+class StackedNumpyModel:
+    """Several NumpyCandlestickModels with the same layer shapes, run as one batched forward pass.
+
+    Each layer's weights are stacked along a leading member axis, so every
+    convolution and dense layer is a single batched matmul over all members.
+    ``predict`` returns (N, M) scores, one column per member.
+    """
+
+    def __init__(self, members):
+        shapes = {tuple(kernel.shape for kernel, _ in member.params) for member in members}
+        if len(shapes) != 1:
+            raise ValueError("Ensemble members must share one architecture to be stacked")
+        self.params = []
+        for layer in zip(*(member.params for member in members)):
+            kernels = np.stack([kernel for kernel, _ in layer])
+            if kernels.ndim == 5:
+                kernels = kernels.reshape(len(members), -1, kernels.shape[-1])  # (M, kh*kw*C, O)
+            self.params.append((np.ascontiguousarray(kernels), np.stack([bias for _, bias in layer])))
+
+    def predict(self, x, verbose=0, **kwargs):
+        """Return sigmoid scores of shape (N, M)"""
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim == 3:
+            x = x[np.newaxis]
+        x = x[np.newaxis]  # shared by every member until the first convolution
+        weights = iter(self.params)
+        dense_layers = sum(1 for layer in ARCHITECTURE if layer == 'dense')
+        for layer in ARCHITECTURE:
+            if layer == 'conv':
+                x = stacked_conv2d_relu(x, *next(weights))
+            elif layer == 'pool':
+                m, n = x.shape[:2]
+                x = max_pool2d(x.reshape((m * n,) + x.shape[2:]))
+                x = x.reshape((m, n) + x.shape[1:])
+            elif layer == 'flatten':
+                x = x.reshape(x.shape[0], x.shape[1], -1)
+            else:
+                kernels, biases = next(weights)
+                x = np.matmul(x, kernels) + biases[:, np.newaxis, :]
+                dense_layers -= 1
+                if dense_layers:
+                    np.maximum(x, 0, out=x)
+        return (1.0 / (1.0 + np.exp(-x)))[..., 0].T
+
+    __call__ = predict
+
+
+def check_parity(h5_path=DEFAULT_H5_PATH, batch_sizes=(1, 8, 32, 128), repeats=20, atol=1e-4):
+    """Compare NumPy and Keras outputs and time both on random batches"""
+    from inference import create_keras_model
+
+    keras_model = create_keras_model(h5_path)
+    numpy_model = NumpyCandlestickModel.load(h5_path)
+    rng = np.random.default_rng(0)
+
+    ok = True
+    for batch_size in batch_sizes:
+        batch = rng.random((batch_size, 64, 64, 3), dtype=np.float32)
+        expected = keras_model.predict(batch, verbose=0)
+        actual = numpy_model.predict(batch)
+        max_diff = float(np.max(np.abs(expected - actual)))
+        ok &= max_diff <= atol
+
+        timings = {}
+        for name, fn in (("keras", lambda: keras_model.predict(batch, verbose=0)),
+                         ("numpy", lambda: numpy_model.predict(batch))):
+            fn()  # warm-up
+            start = time.perf_counter()
+            for _ in range(repeats):
+                fn()
+            timings[name] = 1000 * (time.perf_counter() - start) / repeats
+        print(f"batch={batch_size:4d}  max|diff|={max_diff:.2e}  "
+              f"keras={timings['keras']:.2f}ms  numpy={timings['numpy']:.2f}ms")
+
+    print("Parity OK" if ok else f"Parity FAILED (tolerance {atol})")
+    return ok
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'export'
+    if command == 'export':
+        export_weights(*sys.argv[2:4])
+    elif command == 'check':
+        sys.exit(0 if check_parity(*sys.argv[2:3]) else 1)
+    else:
+        print(__doc__)
+        sys.exit(2)
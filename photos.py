@@ -0,0 +1,100 @@
+import os
+import time
+import logging
+import threading
+from telegram.request import HTTPXRequest
+from metrics import REGISTRY, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+BYTES_FETCHED = REGISTRY.counter('photo_download_bytes_total', 'Photo bytes downloaded from Telegram')
+
+
+def create_http_request():
+    """Pooled HTTP client for Bot API calls and file downloads, tuned via environment variables"""
+    return HTTPXRequest(
+        connection_pool_size=int(os.getenv('TELEGRAM_POOL_SIZE', 64)),
+        connect_timeout=float(os.getenv('TELEGRAM_CONNECT_TIMEOUT', 5)),
+        read_timeout=float(os.getenv('TELEGRAM_READ_TIMEOUT', 10)),
+        write_timeout=float(os.getenv('TELEGRAM_WRITE_TIMEOUT', 10)),
+        pool_timeout=float(os.getenv('TELEGRAM_POOL_TIMEOUT', 5)),
+        http_version=os.getenv('TELEGRAM_HTTP_VERSION', '1.1'),
+    )
+
+
+class DownloadSink:
+    """Write target for ``File.download_to_memory`` that keeps the bytes it is handed.
+
+    The HTTP client already returns the whole file as one ``bytes`` object;
+    holding on to it (rather than copying it into a BytesIO or bytearray)
+    means a download costs no allocation beyond that response. The bytes are
+    immutable and owned by whoever references them, so decoding can run in
+    an executor thread for as long as it needs.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+        return len(chunk)
+
+    def getvalue(self):
+        return self.chunks[0] if len(self.chunks) == 1 else b''.join(self.chunks)
+
+
+class PhotoFetcher:
+    """Choose the cheapest adequate Telegram photo size and download it without extra copies.
+
+    Telegram offers every photo at several resolutions; the model only needs
+    64x64, so the smallest ``PhotoSize`` whose shorter side is at least
+    ``PHOTO_MIN_SIDE`` is downloaded instead of the largest one.
+    """
+
+    def __init__(self, min_side=None):
+        self.min_side = min_side if min_side is not None else int(os.getenv('PHOTO_MIN_SIDE', 320))
+        self._lock = threading.Lock()
+        self.downloads = 0
+        self.bytes_fetched = 0
+        self.bytes_saved = 0  # versus always downloading the largest size
+        self.download_seconds = 0.0
+
+    def select(self, photo_sizes):
+        """Smallest size meeting ``min_side`` on its shorter edge, else the largest available"""
+        sizes = sorted(photo_sizes, key=lambda p: p.width * p.height)
+        for size in sizes:
+            if min(size.width, size.height) >= self.min_side:
+                return size
+        return sizes[-1]
+
+    async def fetch(self, bot, photo_sizes):
+        """Download the selected size; returns (PhotoSize, its bytes)"""
+        photo = self.select(photo_sizes)
+        start = time.perf_counter()
+        file = await bot.get_file(photo.file_id)
+        sink = DownloadSink()
+        await file.download_to_memory(sink)
+        data = sink.getvalue()
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, 'download')
+        BYTES_FETCHED.inc(amount=len(data))
+
+        largest = max(photo_sizes, key=lambda p: p.width * p.height)
+        with self._lock:
+            self.downloads += 1
+            self.bytes_fetched += len(data)
+            self.download_seconds += elapsed
+            if largest.file_size and largest is not photo:
+                self.bytes_saved += max(0, largest.file_size - len(data))
+        logger.debug(f"Fetched {photo.width}x{photo.height} photo: {len(data)} bytes in {elapsed * 1000:.0f}ms")
+        return photo, data
+
+    def stats(self):
+        with self._lock:
+            return {
+                "downloads": self.downloads,
+                "bytes_fetched": self.bytes_fetched,
+                "avg_bytes": self.bytes_fetched / self.downloads if self.downloads else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "avg_download_ms": self.download_seconds * 1000 / self.downloads if self.downloads else 0.0,
+            }
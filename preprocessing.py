@@ -0,0 +1,150 @@
+"""Shared image preprocessing for the bot, the Streamlit app, batch scoring and training.
+
+Every caller goes through the same steps, so training and serving see
+identical model inputs:
+
+1. ``decode`` reads the image dimensions from the PNG/JPEG header and, for
+   photos much larger than 64x64, asks OpenCV for a reduced-resolution decode
+   (``IMREAD_REDUCED_COLOR_2/4/8``) instead of materialising the full image.
+2. ``resize`` shrinks it to a 64x64 uint8 BGR image.
+3. ``to_tensor`` scales that into float32 in [0, 1], optionally straight into
+   a slot of a preallocated ``BatchBuffer``.
+
+The brightness statistic for the Gemini prompt is taken from the 64x64 image.
+"""
+import os
+import struct
+from collections import namedtuple
+import cv2
+import numpy as np
+
+# Constants
+img_height = 64
+img_width = 64
+
+# A reduced decode is only used while the shorter side stays at least this large
+REDUCED_DECODE_MIN_SIDE = int(os.getenv('REDUCED_DECODE_MIN_SIDE', 256))
+
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+_SCALE = np.float32(1.0 / 255.0)
+
+# One preprocessed photo: model input, the 64x64 uint8 image, original size and mean brightness
+PreparedImage = namedtuple('PreparedImage', ['tensor', 'small', 'width', 'height', 'brightness'])
+
+
+def probe_size(data):
+    """Return (width, height) from a PNG or JPEG header without decoding, or None"""
+    data = memoryview(data)
+    if len(data) >= 24 and data[:8] == b'\x89PNG\r\n\x1a\n':
+        width, height = struct.unpack('>II', data[16:24])
+        return width, height
+    if len(data) < 4 or data[:2] != b'\xff\xd8':
+        return None
+    # Walk the JPEG segments until a start-of-frame marker
+    pos = 2
+    while pos + 9 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # segments without a length
+            pos += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    return None
+
+
+def reduced_decode_flag(width, height, min_side=None):
+    """Pick the strongest IMREAD_REDUCED_COLOR_* that keeps the shorter side >= ``min_side``"""
+    min_side = REDUCED_DECODE_MIN_SIDE if min_side is None else min_side
+    if min_side:
+        for factor, flag in _REDUCED_FLAGS:
+            if min(width, height) // factor >= min_side:
+                return flag
+    return cv2.IMREAD_COLOR
+
+
+def decode(data):
+    """Decode encoded image bytes into (BGR image, (width, height) of the original), or (None, None)"""
+    size = probe_size(data)
+    flag = reduced_decode_flag(*size) if size else cv2.IMREAD_COLOR
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if img is None:
+        return None, None
+    if size is None or flag == cv2.IMREAD_COLOR:
+        size = (img.shape[1], img.shape[0])
+    return img, size
+
+
+def read(path):
+    """Like ``decode`` but for an image file"""
+    with open(path, 'rb') as f:
+        return decode(f.read())
+
+
+def resize(img):
+    """Resize a BGR image to the 64x64 uint8 model resolution"""
+    return cv2.resize(img, (img_height, img_width))
+
+
+def to_tensor(small, out=None):
+    """Scale a 64x64 uint8 image to float32 in [0, 1], writing into ``out`` when given"""
+    return np.multiply(small, _SCALE, out=out, dtype=np.float32)
+
+
+def brightness(small):
+    """Mean grayscale intensity of a (downsampled) BGR image"""
+    return float(np.mean(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)))
+
+
+def prepare_image(img, size=None, out=None):
+    """Run resize, scaling and the brightness statistic on an already decoded image"""
+    small = resize(img)
+    width, height = size or (img.shape[1], img.shape[0])
+    return PreparedImage(to_tensor(small, out), small, width, height, brightness(small))
+
+
+def prepare(data, out=None):
+    """Decode and preprocess encoded image bytes in one pass; None if they cannot be decoded"""
+    img, size = decode(data)
+    if img is None:
+        return None
+    return prepare_image(img, size, out)
+
+
+def load_uint8(path):
+    """64x64 uint8 BGR image for a file, as cached for training; None if unreadable"""
+    img, _ = read(path)
+    return None if img is None else resize(img)
+
+
+def describe(prepared):
+    """Basic description of the image for the Gemini prompt"""
+    return f"Candlestick chart image ({prepared.width}x{prepared.height}, brightness: {prepared.brightness:.1f})"
+
+
+class BatchBuffer:
+    """Preallocated float32 (N, 64, 64, 3) buffer that batches are assembled in without np.stack"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.array = np.empty((capacity, img_height, img_width, 3), dtype=np.float32)
+
+    def fill(self, tensors):
+        """Copy tensors into the buffer and return a view of the filled rows"""
+        count = len(tensors)
+        if count > self.capacity:
+            self.capacity = count
+            self.array = np.empty((count, img_height, img_width, 3), dtype=np.float32)
+        for i, tensor in enumerate(tensors):
+            self.array[i] = tensor
+        return self.array[:count]
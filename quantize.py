@@ -0,0 +1,220 @@
+"""Post-training quantization of the candlestick CNN and a float32 vs quantized comparison.
+
+Converts the Keras weights into a TensorFlow Lite model:
+
+- ``int8``: weights and activations in int8, calibrated on a sample of
+  ``img_candel_stick/Train`` images. Input and output stay float32, so the
+  serving preprocessing is unchanged.
+- ``float16``: weights stored as float16 (half the size, float32 compute on CPU).
+- ``dynamic``: int8 weights with activations quantized on the fly.
+
+Serve the result with ``MODEL_BACKEND=tflite`` (and ``MODEL_WEIGHTS_PATH``).
+``compare`` loads each variant in a fresh process and reports accuracy on the
+Test images, per-batch latency and memory footprint against the float32 Keras
+weights.
+
+Usage:
+    python quantize.py convert --mode int8
+    python quantize.py compare candlestick_model_int8.tflite candlestick_model_float16.tflite
+    python quantize.py compare numpy:candlestick_model_weights.h5 --output quantization_report.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from preprocessing import load_uint8, to_tensor
+
+logger = logging.getLogger(__name__)
+
+MODES = ('int8', 'float16', 'dynamic')
+DEFAULT_TRAIN_DIR = './img_candel_stick/Train'
+DEFAULT_TEST_DIR = './img_candel_stick/Test'
+BASELINE = ('keras', 'candlestick_model_weights.h5')
+BATCH_SIZES = (1, 8, 32, 128)
+SUFFIX_BACKENDS = {'.tflite': 'tflite', '.npz': 'numpy', '.h5': 'keras'}
+
+
+def representative_dataset(data_dir=DEFAULT_TRAIN_DIR, samples=200, seed=0):
+    """Yield single preprocessed Train images for int8 calibration (a random, class-mixed sample)"""
+    from dataset_cache import list_images
+
+    paths, _ = list_images(data_dir)
+    rng = np.random.default_rng(seed)
+    for index in rng.permutation(len(paths))[:samples]:
+        img = load_uint8(paths[index])
+        if img is not None:
+            yield [to_tensor(img)[np.newaxis]]
+
+
+def convert(weights_path=BASELINE[1], output=None, mode='int8', data_dir=DEFAULT_TRAIN_DIR, samples=200):
+    """Write a quantized .tflite model for ``weights_path``; returns its path"""
+    import tensorflow as tf
+    from inference import create_keras_model
+
+    if mode not in MODES:
+        raise ValueError(f"Unknown quantization mode: {mode}")
+    converter = tf.lite.TFLiteConverter.from_keras_model(create_keras_model(weights_path))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'int8':
+        converter.representative_dataset = lambda: representative_dataset(data_dir, samples)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    data = converter.convert()
+
+    output = output or f'candlestick_model_{mode}.tflite'
+    tmp_path = f"{output}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, output)  # a model watcher never sees a half-written file
+    logger.info(f"Wrote {mode} model to {output} ({len(data) / 1024:.0f} KB)")
+    return output
+
+
+def _rss_bytes():
+    """Current resident set size (peak RSS where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure_variant(backend, path, test_dir=DEFAULT_TEST_DIR, batch_sizes=BATCH_SIZES, repeat=20):
+    """Accuracy, latency and memory of one model variant (meant to run in a fresh process)"""
+    from inference import load_model, _tflite_interpreter_class
+    from batch_score import ResultWriter, score_directory
+    from benchmark import bench_predict
+
+    # Import the runtime first so only the model itself counts towards its memory
+    if backend == 'keras':
+        from tensorflow.keras import layers, models  # noqa: F401
+    elif backend == 'tflite':
+        _tflite_interpreter_class()
+    before = _rss_bytes()
+    start = time.perf_counter()
+    model = load_model(backend, path)
+    model.warmup(batch_sizes=(1, max(batch_sizes)))
+    load_seconds = time.perf_counter() - start
+    loaded = _rss_bytes()
+
+    writer = ResultWriter(os.devnull, 'jsonl')
+    try:
+        evaluation = score_directory(test_dir, writer, model)
+    finally:
+        writer.close()
+    return {
+        "backend": backend,
+        "path": path,
+        "file_bytes": os.path.getsize(path),
+        "model_rss_bytes": loaded - before,
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "load_seconds": round(load_seconds, 3),
+        "accuracy": evaluation.get("accuracy"),
+        "precision_up": evaluation.get("precision_up"),
+        "recall_up": evaluation.get("recall_up"),
+        "images_per_sec": evaluation["images_per_sec"],
+        "latency": bench_predict(model, repeat, batch_sizes),
+    }
+
+
+def compare(variants, baseline=BASELINE, **kwargs):
+    """Measure the baseline and every (backend, path) variant, each in its own process"""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for backend, path in [baseline] + list(variants):
+        logger.info(f"Measuring {backend} model {path}")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.append(pool.submit(measure_variant, backend, path, **kwargs).result())
+
+    reference = results[0]
+    for result in results[1:]:
+        result["vs_baseline"] = {
+            "accuracy_change": (round(result["accuracy"] - reference["accuracy"], 4)
+                                if result["accuracy"] is not None and reference["accuracy"] is not None else None),
+            "size_ratio": round(result["file_bytes"] / reference["file_bytes"], 3),
+            "memory_ratio": (round(result["model_rss_bytes"] / reference["model_rss_bytes"], 3)
+                             if reference["model_rss_bytes"] > 0 else None),
+            "speedup": {batch_size: round(reference["latency"][batch_size]["median_ms"] / stats["median_ms"], 2)
+                        for batch_size, stats in result["latency"].items()},
+        }
+    return {"baseline": reference, "variants": results[1:]}
+
+
+def format_report(report):
+    """Plain-text table of the comparison"""
+    rows = [report["baseline"]] + report["variants"]
+    batch_sizes = list(rows[0]["latency"])
+    header = (f"{'model':40} {'accuracy':>9} {'size KB':>9} {'mem MB':>8} "
+              + ' '.join(f"{'bs=' + b + ' ms':>11}" for b in batch_sizes))
+    lines = [header, '-' * len(header)]
+    for row in rows:
+        accuracy = f"{row['accuracy']:.4f}" if row['accuracy'] is not None else '-'
+        name = f"{row['backend']}:{os.path.basename(row['path'])}"
+        lines.append(f"{name:40} {accuracy:>9} {row['file_bytes'] / 1024:>9.0f} "
+                     f"{row['model_rss_bytes'] / 2 ** 20:>8.1f} "
+                     + ' '.join(f"{row['latency'][b]['median_ms']:>11.3f}" for b in batch_sizes))
+    for row in report["variants"]:
+        delta = row["vs_baseline"]
+        speedups = ', '.join(f"bs={b}: {s}x" for b, s in delta["speedup"].items())
+        accuracy = f"{delta['accuracy_change']:+.4f}" if delta['accuracy_change'] is not None else 'n/a'
+        lines.append(f"{row['backend']}:{os.path.basename(row['path'])}: accuracy {accuracy}, "
+                     f"size x{delta['size_ratio']}, speedup {speedups}")
+    return '\n'.join(lines)
+
+
+def parse_variant(spec):
+    """``[backend:]path``; the backend defaults from the file extension"""
+    backend, sep, path = spec.partition(':')
+    if not sep or backend not in ('keras', 'numpy', 'tflite'):
+        path = spec
+        backend = SUFFIX_BACKENDS.get(os.path.splitext(path)[1])
+        if backend is None:
+            raise argparse.ArgumentTypeError(f"Cannot tell the backend of {spec}; use backend:path")
+    return backend, path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Quantize the candlestick CNN and compare variants")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help="Write a quantized .tflite model")
+    convert_parser.add_argument('--mode', choices=MODES, default='int8')
+    convert_parser.add_argument('--weights', default=BASELINE[1])
+    convert_parser.add_argument('--output', default=None, help="Default: candlestick_model_<mode>.tflite")
+    convert_parser.add_argument('--data-dir', default=DEFAULT_TRAIN_DIR, help="Calibration images for int8")
+    convert_parser.add_argument('--samples', type=int, default=200, help="Calibration images to use")
+
+    compare_parser = subparsers.add_parser('compare', help="Accuracy/latency/memory against the float32 model")
+    compare_parser.add_argument('variants', nargs='+', type=parse_variant, help="[backend:]path of each variant")
+    compare_parser.add_argument('--baseline', type=parse_variant, default=BASELINE)
+    compare_parser.add_argument('--test-dir', default=DEFAULT_TEST_DIR)
+    compare_parser.add_argument('--batch-sizes', type=int, nargs='+', default=list(BATCH_SIZES))
+    compare_parser.add_argument('--repeat', type=int, default=20)
+    compare_parser.add_argument('--output', default=None, help="Also write the report JSON to this file")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args = parse_args()
+    if args.command == 'convert':
+        convert(args.weights, args.output, args.mode, args.data_dir, args.samples)
+        return
+
+    report = compare(args.variants, args.baseline, test_dir=args.test_dir,
+                     batch_sizes=tuple(args.batch_sizes), repeat=args.repeat)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
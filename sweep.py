@@ -0,0 +1,255 @@
+"""K-fold cross-validated hyperparameter sweep for the candlestick CNN.
+
+Every configuration (conv filter counts, dense width, learning rate, epochs)
+is trained once per fold of a stratified k-fold split of the Train set. The
+(configuration, fold) trials run in parallel in a pool of spawned processes.
+Each process is limited to ``--threads`` TensorFlow/BLAS threads, so
+``workers x threads`` stays within the machine's cores instead of every
+trial grabbing all of them.
+
+Images are preprocessed once into the shard cache from ``dataset_cache.py``.
+Every worker memory-maps the same shards, so no trial decodes an image and
+the pages are shared through the OS page cache.
+
+Inference cost does not depend on the trained weights. It is measured
+afterwards, one configuration at a time in a single worker, so the
+latencies are not skewed by the training that ran alongside them. The
+leaderboard ranks configurations by mean validation accuracy and shows
+parameters, MFLOPs per image and predict latency next to it. Rows on the
+accuracy/MFLOPs Pareto front are marked.
+
+Usage:
+    python sweep.py --folds 5 --filters 32,64,64 16,32,32 --dense-units 32 64 --learning-rate 1e-3 3e-4
+    python sweep.py --search random --trials 12 --epochs 5 10 20 --workers 4 --threads 2
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from dataset_cache import DEFAULT_CACHE_DIR, update_cache, ShardedDataset
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATA_DIR = './img_candel_stick/Train'
+LATENCY_BATCH_SIZES = (1, 32)
+
+_datasets = {}  # cache_dir -> ShardedDataset, opened once per worker process
+
+
+def limit_threads(threads):
+    """Cap TensorFlow and BLAS threads in this process (must run before TensorFlow starts executing)"""
+    for name in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS'):
+        os.environ[name] = str(threads)
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def _dataset(cache_dir):
+    if cache_dir not in _datasets:
+        _datasets[cache_dir] = ShardedDataset(cache_dir)
+    return _datasets[cache_dir]
+
+
+def search_space(filters, dense_units, learning_rates, epochs):
+    """Every combination of the given values, as config dicts"""
+    return [{"filters": list(f), "dense_units": d, "learning_rate": lr, "epochs": e}
+            for f, d, lr, e in itertools.product(filters, dense_units, learning_rates, epochs)]
+
+
+def sample_configs(space, trials, seed=0):
+    """``trials`` distinct configs drawn at random from ``space``"""
+    return random.Random(seed).sample(space, min(trials, len(space)))
+
+
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+
+def estimate_flops(model):
+    """Multiply-adds x 2 for one image through the conv and dense layers"""
+    flops = 0
+    for layer in model.layers:
+        config = layer.get_config()
+        if 'kernel_size' in config:
+            _, height, width, channels_out = layer.output.shape
+            kernel_h, kernel_w = config['kernel_size']
+            flops += 2 * height * width * kernel_h * kernel_w * layer.input.shape[-1] * channels_out
+        elif 'units' in config:
+            flops += 2 * layer.input.shape[-1] * config['units']
+    return flops
+
+
+def run_trial(cache_dir, config, fold, train_idx, val_idx, batch_size=32, seed=5):
+    """Train one config on one fold's training indices; returns its validation scores"""
+    import tensorflow as tf
+    from model import create_candlestick_model, build_shard_dataset
+
+    dataset = _dataset(cache_dir)
+    tf.keras.utils.set_random_seed(seed + fold)
+    model = create_candlestick_model(config["filters"], config["dense_units"])
+    model.compile(optimizer=tf.keras.optimizers.Adam(config["learning_rate"]), loss='binary_crossentropy',
+                  metrics=['accuracy'])
+    started = time.perf_counter()
+    model.fit(build_shard_dataset(dataset, train_idx, batch_size, shuffle=True, seed=seed + fold),
+              epochs=config["epochs"], verbose=0)
+    train_seconds = time.perf_counter() - started
+    loss, accuracy = model.evaluate(build_shard_dataset(dataset, val_idx, batch_size), verbose=0)
+    return {"config": config, "fold": fold, "val_accuracy": float(accuracy), "val_loss": float(loss),
+            "train_seconds": round(train_seconds, 2)}
+
+
+def measure_cost(config, batch_sizes=LATENCY_BATCH_SIZES, repeat=20):
+    """Parameters, MFLOPs per image and median predict latency of a config (weights do not matter)"""
+    from model import create_candlestick_model, img_height, img_width
+
+    model = create_candlestick_model(config["filters"], config["dense_units"])
+    latency = {}
+    for batch_size in batch_sizes:
+        batch = np.random.default_rng(0).random((batch_size, img_height, img_width, 3), dtype=np.float32)
+        model.predict_on_batch(batch)  # warm-up
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model.predict_on_batch(batch)
+            timings.append(time.perf_counter() - start)
+        latency[str(batch_size)] = round(float(np.median(timings)) * 1000, 3)
+    return {"params": model.count_params(), "mflops": round(estimate_flops(model) / 1e6, 2), "latency_ms": latency}
+
+
+def leaderboard(trials, costs):
+    """One row per config, best mean validation accuracy first"""
+    by_config = {}
+    for trial in trials:
+        by_config.setdefault(config_key(trial["config"]), []).append(trial)
+    rows = []
+    for key, results in by_config.items():
+        accuracies = [result["val_accuracy"] for result in results]
+        rows.append({
+            **json.loads(key),
+            "folds": len(results),
+            "mean_accuracy": round(float(np.mean(accuracies)), 4),
+            "std_accuracy": round(float(np.std(accuracies)), 4),
+            "mean_loss": round(float(np.mean([result["val_loss"] for result in results])), 4),
+            "train_seconds": round(float(np.mean([result["train_seconds"] for result in results])), 2),
+            **costs[key],
+        })
+    rows.sort(key=lambda row: (-row["mean_accuracy"], row["mflops"]))
+    # Pareto front: no other config is at least as accurate and cheaper
+    for row in rows:
+        row["pareto"] = not any(other["mean_accuracy"] >= row["mean_accuracy"] and other["mflops"] < row["mflops"]
+                                for other in rows)
+    return rows
+
+
+def format_leaderboard(rows):
+    """Plain-text table of the leaderboard"""
+    batch_sizes = list(rows[0]["latency_ms"]) if rows else []
+    header = (f"{'#':>3} {'filters':>12} {'dense':>5} {'lr':>8} {'epochs':>6} {'accuracy':>15} {'params':>9} "
+              f"{'MFLOPs':>8} " + ' '.join(f"{'bs=' + b + ' ms':>10}" for b in batch_sizes) + "  pareto")
+    lines = [header, '-' * len(header)]
+    for rank, row in enumerate(rows, 1):
+        accuracy = f"{row['mean_accuracy']:.4f}±{row['std_accuracy']:.4f}"
+        lines.append(f"{rank:>3} {','.join(map(str, row['filters'])):>12} {row['dense_units']:>5} "
+                     f"{row['learning_rate']:>8g} {row['epochs']:>6} {accuracy:>15} {row['params']:>9} "
+                     f"{row['mflops']:>8.2f} " + ' '.join(f"{row['latency_ms'][b]:>10.3f}" for b in batch_sizes)
+                     + ("  *" if row["pareto"] else ""))
+    return '\n'.join(lines)
+
+
+def sweep(configs, data_dir=DEFAULT_DATA_DIR, cache_dir=DEFAULT_CACHE_DIR, folds=5, workers=None, threads=1,
+          batch_size=32, seed=5):
+    """Cross-validate every config in parallel; returns the trials and the leaderboard"""
+    from sklearn.model_selection import StratifiedKFold
+
+    update_cache(data_dir, cache_dir)  # decode once, before any worker starts
+    labels = ShardedDataset(cache_dir).labels
+    splits = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed).split(labels, labels))
+    workers = workers or max(1, (os.cpu_count() or 1) // threads)
+    context = multiprocessing.get_context('spawn')
+    logger.info(f"Sweeping {len(configs)} configs x {folds} folds on {len(labels)} images "
+                f"with {workers} workers x {threads} threads")
+
+    started = time.perf_counter()
+    trials = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=limit_threads, initargs=(threads,)) as pool:
+        futures = [pool.submit(run_trial, cache_dir, config, fold, train_idx, val_idx, batch_size, seed)
+                   for config in configs for fold, (train_idx, val_idx) in enumerate(splits)]
+        for future in as_completed(futures):
+            trial = future.result()
+            trials.append(trial)
+            logger.info(f"[{len(trials)}/{len(futures)}] fold {trial['fold']} {config_key(trial['config'])}: "
+                        f"accuracy {trial['val_accuracy']:.4f} ({trial['train_seconds']:.1f}s)")
+    elapsed = time.perf_counter() - started
+
+    # Inference cost, measured one config at a time with the same thread limit
+    with ProcessPoolExecutor(max_workers=1, mp_context=context,
+                             initializer=limit_threads, initargs=(threads,)) as pool:
+        costs = {config_key(config): pool.submit(measure_cost, config).result() for config in configs}
+
+    return {
+        "data_dir": data_dir,
+        "images": len(labels),
+        "folds": folds,
+        "workers": workers,
+        "threads": threads,
+        "sweep_seconds": round(elapsed, 1),
+        "leaderboard": leaderboard(trials, costs),
+        "trials": sorted(trials, key=lambda trial: (config_key(trial["config"]), trial["fold"])),
+    }
+
+
+def _filters(value):
+    filters = tuple(int(part) for part in value.split(','))
+    if len(filters) != 3:
+        raise argparse.ArgumentTypeError(f"Expected three comma-separated filter counts, got {value}")
+    return filters
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cross-validated hyperparameter sweep for the candlestick CNN")
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="Shard cache shared by all trials")
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--filters', type=_filters, nargs='+', default=[(32, 64, 64)],
+                        help="Conv filter counts, e.g. 32,64,64 16,32,32")
+    parser.add_argument('--dense-units', type=int, nargs='+', default=[64])
+    parser.add_argument('--learning-rate', type=float, nargs='+', default=[1e-3])
+    parser.add_argument('--epochs', type=int, nargs='+', default=[10])
+    parser.add_argument('--search', choices=['grid', 'random'], default='grid')
+    parser.add_argument('--trials', type=int, default=10, help="Configs sampled by --search random")
+    parser.add_argument('--workers', type=int, default=None, help="Parallel trials (default: cores / --threads)")
+    parser.add_argument('--threads', type=int, default=1, help="TensorFlow threads per trial process")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=5)
+    parser.add_argument('--output', default='sweep_results.json')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args = parse_args()
+    configs = search_space(args.filters, args.dense_units, args.learning_rate, args.epochs)
+    if args.search == 'random':
+        configs = sample_configs(configs, args.trials, args.seed)
+
+    report = sweep(configs, args.data_dir, args.cache_dir, args.folds, args.workers, args.threads,
+                   args.batch_size, args.seed)
+    print(format_leaderboard(report["leaderboard"]))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
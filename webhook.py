@@ -0,0 +1,125 @@
+import os
+import asyncio
+import logging
+import threading
+from telegram import Update
+from metrics import REGISTRY, ERRORS
+from admission import RATE_LIMITED, BUSY
+from bot import COMMAND_UPDATE_SLOTS
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookRuntime:
+    """Long-lived event loop that processes webhook updates for a StockAnalysisBot.
+
+    The loop runs in a background thread with the bot's ``Application``
+    initialized once, so HTTP connections and async clients are reused across
+    updates. Web request handlers only deserialize the update and put it on a
+    bounded queue; a pool of consumer tasks drains the queue. Updates without
+    a photo (commands, text) go to a separate priority queue with its own
+    consumers, so they are never stuck behind photo analysis.
+
+    The photo queue is where the backlog builds up in webhook mode, so the
+    bot's admission control is decided as a photo is queued, against that
+    queue's depth. Photos that are rate limited or shed as busy go to the
+    priority queue and get their short reply straight away, as do photos the
+    bot can answer from its file_id cache (which, as in polling mode, spend
+    no admission tokens). Unless ``WEBHOOK_CONSUMERS`` says otherwise, there
+    is one photo consumer per admission slot plus ``COMMAND_UPDATE_SLOTS``,
+    the same headroom polling mode gets.
+    """
+
+    def __init__(self, bot, queue_size=None, consumers=None):
+        self.bot = bot
+        self.queue_size = queue_size or int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+        self.consumers = (consumers or int(os.getenv('WEBHOOK_CONSUMERS', 0))
+                          or bot.admission.max_concurrency + COMMAND_UPDATE_SLOTS)
+        self.priority_consumers = int(os.getenv('WEBHOOK_PRIORITY_CONSUMERS', 2))
+        self.loop = asyncio.new_event_loop()
+        self.queue = None
+        self.priority_queue = None
+        self.rejected = 0
+        self._tasks = []
+        self._thread = threading.Thread(target=self._run_loop, name="webhook-loop", daemon=True)
+        self._rejected_counter = REGISTRY.counter('webhook_rejected_total', 'Updates rejected because the queue was full')
+        REGISTRY.gauge('webhook_queue_depth', 'Updates waiting for a consumer', self.queue_depth)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        """Start the loop thread and block until the Application is initialized"""
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._startup(), self.loop).result()
+        logger.info(f"Webhook runtime started ({self.consumers} consumers, queue size {self.queue_size})")
+        if self.consumers < self.bot.admission.max_concurrency:
+            logger.warning(f"WEBHOOK_CONSUMERS ({self.consumers}) is below ADMISSION_MAX_CONCURRENCY "
+                           f"({self.bot.admission.max_concurrency}): at most {self.consumers} photos are analysed at once")
+
+    async def _startup(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.priority_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.bot.admission.backlog = self.queue.qsize
+        # Rejected photos wait in the priority queue with their decision, so either queue can hold one
+        self.bot.admission.max_decided = max(self.bot.admission.max_decided, 2 * self.queue_size)
+        await self.bot.application.initialize()
+        await self.bot._setup_commands()
+        self._tasks = [asyncio.create_task(self._consume(self.queue)) for _ in range(self.consumers)]
+        self._tasks += [asyncio.create_task(self._consume(self.priority_queue))
+                        for _ in range(self.priority_consumers)]
+
+    async def _consume(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.bot.application.process_update(update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id}: {e}")
+                ERRORS.inc('process_update')
+            finally:
+                # A decision the handler never picked up (filtered out, failed early) is not kept around
+                self.bot.admission.take_decision(update.update_id)
+                queue.task_done()
+
+    async def _enqueue(self, update):
+        message = update.effective_message
+        queue = self.priority_queue
+        if message is not None and message.photo and not self.bot.has_cached_answer(message.photo):
+            decision = self.bot.admission.decide(update.update_id, update.effective_chat.id)
+            if decision not in (RATE_LIMITED, BUSY):
+                queue = self.queue
+        try:
+            queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            self._rejected_counter.inc()
+            self.bot.admission.take_decision(update.update_id)
+            return False
+
+    def submit(self, update_data):
+        """Deserialize a webhook payload and queue it; returns False if the queue is full"""
+        update = Update.de_json(update_data, self.bot.application.bot)
+        return asyncio.run_coroutine_threadsafe(self._enqueue(update), self.loop).result()
+
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def stop(self, timeout=10):
+        """Cancel consumers, shut the Application down and stop the loop"""
+        if not self._thread.is_alive():
+            return
+
+        async def _shutdown():
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self.bot.application.shutdown()
+
+        try:
+            asyncio.run_coroutine_threadsafe(_shutdown(), self.loop).result(timeout=timeout)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout=timeout)
@@ -0,0 +1,319 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future, InvalidStateError
+from preprocessing import prepare, describe, BatchBuffer
+
+logger = logging.getLogger(__name__)
+
+def _settle(future, result=None, error=None):
+    """Complete a request's future unless it is already done; never raises into the reader or monitor thread"""
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def _analyze_bytes(photo_bytes):
+    """Decode photo bytes into (model input, description, perceptual hash), or None if undecodable"""
+    from cache import perceptual_hash
+
+    prepared = prepare(photo_bytes)
+    if prepared is None:
+        return None
+    return prepared.tensor, describe(prepared), perceptual_hash(prepared.tensor)
+
+
+def _worker_main(conn, backend, weights_path, max_batch_size):
+    """Worker process: load the model once, then score image batches received over the pipe"""
+    from inference import load_model
+
+    model = load_model(backend, weights_path)
+    model.warmup()
+    buffer = BatchBuffer(max_batch_size)
+    conn.send(('ready', os.getpid()))
+
+    while True:
+        try:
+            messages = [conn.recv()]
+            # Drain whatever else is already waiting so it shares one forward pass
+            while len(messages) < max_batch_size and conn.poll():
+                messages.append(conn.recv())
+        except (EOFError, OSError):
+            break
+
+        jobs = []
+        for request_id, kind, payload in messages:
+            if kind == 'stop':
+                return
+            if kind == 'ping':
+                conn.send((request_id, 'pong', None))
+                continue
+            if kind == 'reload':
+                # Load and warm up the new weights before dropping the old model
+                try:
+                    new_model = load_model(backend, payload)
+                    new_model.warmup()
+                    model = new_model
+                    conn.send((request_id, 'ok', payload))
+                except Exception as e:
+                    conn.send((request_id, 'error', str(e)))
+                continue
+            try:
+                jobs.append((request_id, _analyze_bytes(payload)))
+            except Exception as e:
+                conn.send((request_id, 'error', str(e)))
+
+        decoded = [(request_id, result) for request_id, result in jobs if result is not None]
+        for request_id, result in jobs:
+            if result is None:
+                conn.send((request_id, 'ok', None))
+        if not decoded:
+            continue
+
+        try:
+            outputs = model.predict(buffer.fill([result[0] for _, result in decoded]))
+        except Exception as e:
+            for request_id, _ in decoded:
+                conn.send((request_id, 'error', str(e)))
+            continue
+        for (request_id, (_, description, image_hash)), row in zip(decoded, outputs):
+            # A second column is the spread of test-time augmentation/ensemble scores
+            spread = float(row[1]) if len(row) > 1 else 0.0
+            conn.send((request_id, 'ok', (float(row[0]), description, image_hash, spread)))
+
+
+class _Worker:
+    """Front-end handle for one worker process"""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.pending = {}  # request_id -> Future
+        self.ready = False
+        self.reloading = False
+        self.restarts = -1
+        self.failed_starts = 0  # consecutive deaths before becoming ready
+        self.next_restart = 0.0
+        self.last_pong = time.monotonic()
+        self.send_lock = threading.Lock()
+
+    @property
+    def load(self):
+        return len(self.pending)
+
+
+class InferenceWorkerPool:
+    """Pool of N inference processes, each holding its own copy of the candlestick model.
+
+    Image bytes are sent to workers over local pipes; workers decode,
+    preprocess and score them (batching whatever arrives together) and send
+    back ``(score, description, image_hash, spread)``. A monitor thread pings the
+    workers and restarts any that crash or stop answering. ``reload`` swaps
+    in new weights one worker at a time, so the others keep serving.
+    """
+
+    def __init__(self, num_workers=None, dispatch=None, backend=None, weights_path=None,
+                 max_batch_size=None, health_interval=None):
+        self.num_workers = num_workers or int(os.getenv('INFERENCE_WORKERS', 2))
+        self.dispatch = (dispatch or os.getenv('INFERENCE_DISPATCH', 'least_loaded')).lower()
+        if self.dispatch not in ('round_robin', 'least_loaded'):
+            raise ValueError(f"Unknown INFERENCE_DISPATCH: {self.dispatch}")
+        self.backend = backend
+        self.weights_path = weights_path
+        self.max_batch_size = max_batch_size or int(os.getenv('BATCH_MAX_SIZE', 32))
+        self.health_interval = health_interval or float(os.getenv('INFERENCE_HEALTH_INTERVAL', 5))
+        self.reload_timeout = float(os.getenv('MODEL_RELOAD_TIMEOUT', 120))
+
+        self._ctx = multiprocessing.get_context('spawn')
+        self._ids = itertools.count()
+        self._round_robin = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.workers = [_Worker(i) for i in range(self.num_workers)]
+        for worker in self.workers:
+            self._spawn(worker)
+
+        self._monitor = threading.Thread(target=self._monitor_loop, name="worker-monitor", daemon=True)
+        self._monitor.start()
+        logger.info(f"Inference worker pool started ({self.num_workers} workers, {self.dispatch} dispatch)")
+
+    @property
+    def ready(self):
+        """True once every worker has loaded and warmed up its model"""
+        return all(worker.ready for worker in self.workers)
+
+    def _spawn(self, worker):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(child_conn, self.backend, self.weights_path, self.max_batch_size),
+            name=f"inference-worker-{worker.index}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+
+        worker.process = process
+        worker.conn = parent_conn
+        worker.ready = False
+        worker.restarts += 1
+        worker.last_pong = time.monotonic()
+        threading.Thread(target=self._reader_loop, args=(worker, parent_conn),
+                         name=f"worker-reader-{worker.index}", daemon=True).start()
+
+    def _reader_loop(self, worker, conn):
+        """Resolve pending futures with results coming back from one worker"""
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'ready':
+                worker.ready = True
+                worker.failed_starts = 0
+                logger.info(f"Inference worker {worker.index} ready (pid {message[1]})")
+                continue
+            request_id, status, payload = message
+            if status == 'pong':
+                worker.last_pong = time.monotonic()
+                continue
+            future = worker.pending.pop(request_id, None)
+            if future is None:
+                continue
+            if status == 'ok':
+                _settle(future, payload)
+            else:
+                _settle(future, error=RuntimeError(f"Inference worker error: {payload}"))
+
+    def _choose_worker(self):
+        with self._lock:
+            candidates = [w for w in self.workers
+                          if w.ready and not w.reloading and w.process.is_alive()] or self.workers
+            if self.dispatch == 'least_loaded':
+                return min(candidates, key=lambda w: w.load)
+            return candidates[next(self._round_robin) % len(candidates)]
+
+    def _send(self, worker, message):
+        with worker.send_lock:
+            worker.conn.send(message)
+
+    def submit(self, photo_bytes):
+        """Send image bytes to a worker; the Future resolves to (score, description, image_hash, spread) or None"""
+        if self._closed:
+            raise RuntimeError("Inference worker pool is closed")
+        worker = self._choose_worker()
+        request_id = next(self._ids)
+        future = Future()
+        # The request goes straight to a worker, so there is nothing left to cancel: a caller that
+        # gives up (asyncio.wrap_future cancelling its side) leaves the result to be dropped
+        future.set_running_or_notify_cancel()
+        worker.pending[request_id] = future
+        try:
+            self._send(worker, (request_id, 'predict', bytes(photo_bytes)))
+        except (OSError, ValueError) as e:
+            worker.pending.pop(request_id, None)
+            _settle(future, error=RuntimeError(f"Inference worker {worker.index} unavailable: {e}"))
+        return future
+
+    async def analyze_async(self, photo_bytes):
+        return await asyncio.wrap_future(self.submit(photo_bytes))
+
+    def _reload_worker(self, worker, weights_path):
+        request_id = next(self._ids)
+        future = Future()
+        worker.reloading = True
+        worker.pending[request_id] = future
+        try:
+            self._send(worker, (request_id, 'reload', weights_path))
+            future.result(timeout=self.reload_timeout)
+        finally:
+            worker.pending.pop(request_id, None)
+            worker.reloading = False
+
+    def reload(self, weights_path):
+        """Load new weights into every worker, one at a time; all workers stay on the old ones on failure"""
+        previous = self.weights_path
+        reloaded = []
+        try:
+            for worker in self.workers:
+                self._reload_worker(worker, weights_path)
+                reloaded.append(worker)
+        except Exception as e:
+            logger.error(f"Worker reload to {weights_path} failed, restoring {previous}: {e}")
+            for worker in reloaded:
+                try:
+                    self._reload_worker(worker, previous)
+                except Exception as restore_error:
+                    self._restart(worker, f"could not restore weights ({restore_error})")
+            raise
+        # Restarted workers come back on the new weights too
+        self.weights_path = weights_path
+        logger.info(f"All {len(self.workers)} inference workers now serve {weights_path}")
+
+    def _monitor_loop(self):
+        while not self._closed:
+            time.sleep(self.health_interval)
+            for worker in self.workers:
+                if self._closed:
+                    return
+                alive = worker.process.is_alive()
+                # Generous grace period: a busy worker answers pings between batches
+                stale = worker.ready and time.monotonic() - worker.last_pong > 6 * self.health_interval
+                if alive and not stale:
+                    try:
+                        self._send(worker, (None, 'ping', None))
+                    except (OSError, ValueError):
+                        alive = False
+                if not alive or stale:
+                    self._restart(worker, "crashed" if not alive else "unresponsive")
+
+    def _restart(self, worker, reason):
+        now = time.monotonic()
+        if not worker.ready:
+            # Died while loading - back off so a broken model file does not cause a restart storm
+            if now < worker.next_restart:
+                return
+            worker.failed_starts += 1
+            worker.next_restart = now + min(60, self.health_interval * 2 ** worker.failed_starts)
+        logger.warning(f"Inference worker {worker.index} {reason}, restarting")
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.conn.close()
+        pending, worker.pending = worker.pending, {}
+        for future in pending.values():
+            _settle(future, error=RuntimeError(f"Inference worker {worker.index} {reason}"))
+        self._spawn(worker)
+
+    def health(self):
+        """Per-worker liveness, readiness, load and restart counts"""
+        return [{
+            "worker": worker.index,
+            "pid": worker.process.pid,
+            "alive": worker.process.is_alive(),
+            "ready": worker.ready,
+            "in_flight": worker.load,
+            "restarts": worker.restarts,
+        } for worker in self.workers]
+
+    def close(self):
+        """Ask workers to stop and wait for them to exit"""
+        self._closed = True
+        for worker in self.workers:
+            try:
+                self._send(worker, (None, 'stop', None))
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.kill()